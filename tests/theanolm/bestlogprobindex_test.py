@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import unittest
+import random
+
+from theanolm.scoring.lattice import Lattice
+from theanolm.scoring.bestlogprobindex import BestLogprobIndex
+
+class TestBestLogprobIndex(unittest.TestCase):
+    def setUp(self):
+        pass
+
+    def tearDown(self):
+        pass
+
+    def _linear_best_logprob(self, node, sorted_nodes):
+        if node.time is None:
+            node_ids = [iter_node.id for iter_node in sorted_nodes]
+            time_begin = node_ids.index(node.id)
+        else:
+            for time_begin, iter_node in enumerate(sorted_nodes):
+                if (iter_node.time is not None) and \
+                   (iter_node.time >= node.time):
+                    break
+        return max((iter_node.best_logprob
+                    for iter_node in sorted_nodes[time_begin:]
+                    if iter_node.best_logprob is not None),
+                   default=float('-inf'))
+
+    def test_best_logprob(self):
+        nodes = [Lattice.Node(id) for id in range(5)]
+        nodes[0].time = 0.0
+        nodes[1].time = 1.0
+        nodes[2].time = 1.0
+        nodes[3].time = None
+        nodes[4].time = 3.0
+        nodes[0].best_logprob = -10.0
+        nodes[2].best_logprob = -30.0
+        index = BestLogprobIndex(nodes)
+        self.assertEqual(index.best_logprob(nodes[0]), -10.0)
+        self.assertEqual(index.best_logprob(nodes[1]), -30.0)
+        self.assertEqual(index.best_logprob(nodes[2]), -30.0)
+        self.assertEqual(index.best_logprob(nodes[3]), float('-inf'))
+        self.assertEqual(index.best_logprob(nodes[4]), float('-inf'))
+        # A log probability of -inf gives a threshold of -inf.
+        index.update(nodes[4], float('-inf'))
+        self.assertEqual(index.best_logprob(nodes[4]) - 1.0, float('-inf'))
+        index.update(nodes[4], -50.0)
+        self.assertEqual(index.best_logprob(nodes[3]), -50.0)
+        index.update(nodes[1], -20.0)
+        self.assertEqual(index.best_logprob(nodes[2]), -20.0)
+        index.update(nodes[1], -25.0)
+        self.assertEqual(index.best_logprob(nodes[2]), -20.0)
+
+    def test_random(self):
+        random.seed(1)
+        nodes = [Lattice.Node(id) for id in range(200)]
+        time = 0.0
+        for node in nodes:
+            if random.random() < 0.1:
+                node.time = None
+            else:
+                # Times are mostly increasing in topological order.
+                time += random.uniform(-1.0, 2.0)
+                node.time = time
+        index = BestLogprobIndex(nodes)
+        for _ in range(1000):
+            node = random.choice(nodes)
+            logprob = random.uniform(-1000.0, 0.0)
+            if (node.best_logprob is None) or (logprob > node.best_logprob):
+                node.best_logprob = logprob
+            index.update(node, logprob)
+            node = random.choice(nodes)
+            self.assertEqual(index.best_logprob(node),
+                             self._linear_best_logprob(node, nodes))
+
+if __name__ == '__main__':
+    unittest.main()
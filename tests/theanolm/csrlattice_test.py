@@ -0,0 +1,202 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import unittest
+import os
+from io import StringIO
+
+import numpy
+
+from theanolm.backend import InputError
+from theanolm.scoring.slflattice import SLFLattice
+from theanolm.scoring.kaldilattice import KaldiLattice, read_kaldi_vocabulary
+from theanolm.scoring.csrlattice import CSRLattice
+
+class TestCSRLattice(unittest.TestCase):
+    def setUp(self):
+        script_path = os.path.dirname(os.path.realpath(__file__))
+        self.slf_path = os.path.join(script_path, 'lattice.slf')
+        self.lat_path = os.path.join(script_path, 'lattice.lat')
+        self.wordmap_path = os.path.join(script_path, 'words.txt')
+
+    def tearDown(self):
+        pass
+
+    def _assert_lattices_equal(self, lattice, csr_lattice):
+        self.assertEqual(csr_lattice.utterance_id, lattice.utterance_id)
+        self.assertEqual(csr_lattice.lm_scale, lattice.lm_scale)
+        self.assertEqual(csr_lattice.wi_penalty, lattice.wi_penalty)
+        self.assertEqual(len(csr_lattice.nodes), len(lattice.nodes))
+        self.assertEqual(len(csr_lattice.links), len(lattice.links))
+        self.assertEqual(csr_lattice.initial_node.id, lattice.initial_node.id)
+        for node, csr_node in zip(lattice.nodes, csr_lattice.nodes):
+            self.assertEqual(csr_node.id, node.id)
+            self.assertEqual(csr_node.time, node.time)
+            self.assertEqual(csr_node.final, node.final)
+            self.assertEqual([link.end_node.id for link in csr_node.out_links],
+                             [link.end_node.id for link in node.out_links])
+            self.assertEqual([link.start_node.id for link in csr_node.in_links],
+                             [link.start_node.id for link in node.in_links])
+        for link, csr_link in zip(lattice.links, csr_lattice.links):
+            self.assertEqual(csr_link.word, link.word)
+            self.assertEqual(csr_link.transitions, link.transitions)
+            if link.ac_logprob is None:
+                self.assertIsNone(csr_link.ac_logprob)
+            else:
+                self.assertAlmostEqual(csr_link.ac_logprob, link.ac_logprob,
+                                       places=2)
+            if link.lm_logprob is None:
+                self.assertIsNone(csr_link.lm_logprob)
+            else:
+                self.assertAlmostEqual(csr_link.lm_logprob, link.lm_logprob,
+                                       places=4)
+
+    def test_from_slf(self):
+        with open(self.slf_path, 'r') as slf_file:
+            lattice = SLFLattice(slf_file)
+        csr_lattice = CSRLattice(lattice)
+        self._assert_lattices_equal(lattice, csr_lattice)
+        self.assertEqual(csr_lattice.link_starts.dtype, numpy.int32)
+        self.assertEqual(csr_lattice.ac_logprobs.dtype, numpy.float32)
+        self.assertEqual([node.id for node in csr_lattice.sorted_nodes()],
+                         [node.id for node in lattice.sorted_nodes()])
+
+        # The decoder reads the lattice through lists indexed by link ID.
+        out_links, link_ends, link_words, ac_logprobs, lm_logprobs = \
+            csr_lattice.link_lists()
+        expected = lattice.link_lists()
+        self.assertEqual(out_links, expected[0])
+        self.assertEqual(link_ends, expected[1])
+        self.assertEqual(link_words, expected[2])
+        for logprobs, expected_logprobs in [(ac_logprobs, expected[3]),
+                                            (lm_logprobs, expected[4])]:
+            for logprob, expected_logprob in zip(logprobs, expected_logprobs):
+                if expected_logprob is None:
+                    self.assertIsNone(logprob)
+                else:
+                    self.assertAlmostEqual(logprob, expected_logprob, places=2)
+
+        # Views to the same node or link are equal.
+        self.assertEqual(csr_lattice.nodes[1], csr_lattice.nodes[1])
+        self.assertNotEqual(csr_lattice.nodes[1], csr_lattice.nodes[2])
+        self.assertEqual(csr_lattice.links[0].end_node.in_links[0],
+                         csr_lattice.links[0])
+        self.assertEqual(csr_lattice.nodes[-1].id, len(lattice.nodes) - 1)
+
+        # Node attributes are stored in the lattice.
+        csr_lattice.nodes[3].best_logprob = -10.0
+        self.assertEqual(csr_lattice.nodes[3].best_logprob, -10.0)
+        self.assertIsNone(csr_lattice.nodes[4].best_logprob)
+        self.assertFalse(hasattr(csr_lattice.nodes[3], 'word_to_link'))
+        csr_lattice.nodes[3].word_to_link = {'a': csr_lattice.links[0]}
+        self.assertEqual(csr_lattice.nodes[3].word_to_link['a'].id, 0)
+
+    def test_from_kaldi(self):
+        with open(self.wordmap_path, 'r') as wordmap_file:
+            word_to_id = read_kaldi_vocabulary(wordmap_file)
+        id_to_word = [None] * len(word_to_id)
+        for word, id in word_to_id.items():
+            id_to_word[id] = word
+
+        with open(self.lat_path, 'r') as lat_file:
+            lattice = KaldiLattice(lat_file.readlines(), id_to_word)
+        csr_lattice = CSRLattice(lattice)
+        self._assert_lattices_equal(lattice, csr_lattice)
+
+        buffer = StringIO()
+        lattice.write_kaldi(buffer, word_to_id)
+        csr_buffer = StringIO()
+        csr_lattice.write_kaldi(csr_buffer, word_to_id)
+        self.assertEqual(csr_buffer.getvalue(), buffer.getvalue())
+
+    def test_write_slf(self):
+        slf = ['VERSION=1.1',
+               'UTTERANCE=utterance',
+               'lmscale=14.0',
+               'start=0',
+               'N=4 L=4',
+               'I=0 t=0.0',
+               'I=1 t=0.5',
+               'I=2',
+               'I=3 t=1.25',
+               'J=0 S=0 E=1 W=a a=-1.0 l=-0.0',
+               'J=1 S=0 E=2 W=!NULL a=-3.5',
+               'J=2 S=1 E=3 W=c l=-0.25',
+               'J=3 S=2 E=3 W=c a=-1.0 l=0.0']
+        lattice = SLFLattice(slf)
+        buffer = StringIO()
+        lattice.write_slf(buffer)
+        csr_buffer = StringIO()
+        CSRLattice(lattice).write_slf(csr_buffer)
+        self.assertEqual(csr_buffer.getvalue(), buffer.getvalue())
+
+    def test_prune(self):
+        slf = ['VERSION=1.1',
+               'start=0',
+               'N=5 L=5',
+               'I=0',
+               'I=1',
+               'I=2',
+               'I=3',
+               'I=4',
+               'J=0 S=0 E=1 W=a a=-1.0 l=0.0',
+               'J=1 S=0 E=2 W=b a=-3.0 l=-2.0',
+               'J=2 S=1 E=3 W=c a=-1.0 l=0.0',
+               'J=3 S=2 E=3 W=c a=-1.0 l=0.0',
+               'J=4 S=3 E=4 W=d a=-1.0 l=-1.0']
+
+        for kwargs in [{'beam': 5.0},
+                       {'beam': 3.0},
+                       {'beam': 3.0, 'lm_scale': 0.25},
+                       {'beam': 3.0, 'wi_penalty': 1.0},
+                       {'min_posterior': 0.01},
+                       {'min_posterior': 0.02},
+                       {'beam': 0.0, 'min_posterior': 1.0}]:
+            lattice = SLFLattice(slf)
+            csr_lattice = CSRLattice(SLFLattice(slf))
+            self.assertEqual(csr_lattice.prune(**kwargs), lattice.prune(**kwargs))
+            self._assert_lattices_equal(lattice, csr_lattice)
+            self.assertEqual(csr_lattice.link_starts.tolist(),
+                             [link.start_node.id for link in lattice.links])
+            self.assertEqual(csr_lattice.link_ends.tolist(),
+                             [link.end_node.id for link in lattice.links])
+
+        csr_lattice = CSRLattice(SLFLattice(slf))
+        with self.assertRaises(InputError):
+            csr_lattice.prune(min_posterior=0.01, lm_scale=0.0)
+        self.assertEqual(csr_lattice.prune(beam=3.0, lm_scale=0.0), 0)
+
+        lattice = SLFLattice(slf)
+        csr_lattice = CSRLattice(lattice)
+        lookahead = csr_lattice.lookahead_logprobs(2.0, -1.0)
+        self.assertTrue(numpy.array_equal(
+            lookahead, lattice.lookahead_logprobs(2.0, -1.0)))
+        self.assertEqual(lookahead[1], -6.0)
+
+    def test_prune_incomplete_paths(self):
+        # The link from node 1 to node 3 has high posterior, but all the links
+        # that lead to node 1 are pruned.
+        slf = ['VERSION=1.1',
+               'start=0',
+               'end=3',
+               'N=4 L=13',
+               'I=0',
+               'I=1',
+               'I=2',
+               'I=3']
+        for link_id in range(10):
+            slf.append('J={} S=0 E=1 W=x{} a=-3.2189 l=0.0'
+                       .format(link_id, link_id))
+        slf.extend(['J=10 S=1 E=3 W=y a=0.0 l=0.0',
+                    'J=11 S=0 E=2 W=z a=-0.5108 l=0.0',
+                    'J=12 S=2 E=3 W=w a=0.0 l=0.0'])
+        lattice = SLFLattice(slf)
+        csr_lattice = CSRLattice(SLFLattice(slf))
+        self.assertEqual(csr_lattice.prune(min_posterior=0.3), 11)
+        self.assertEqual(lattice.prune(min_posterior=0.3), 11)
+        self._assert_lattices_equal(lattice, csr_lattice)
+        self.assertEqual(csr_lattice.num_nodes, 3)
+        self.assertEqual(csr_lattice.sorted_node_ids(), [0, 1, 2])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import unittest
+import io
+import os
+import time
+
+from theanolm.commands.decode import _decode_parallel
+
+class DummyBatch(object):
+    def __init__(self, num_lattices):
+        self.num_lattices = num_lattices
+
+    def sources(self):
+        for index in range(self.num_lattices):
+            yield str(index)
+
+    def read_lattice(self, source):
+        return int(source)
+
+def dummy_decode_lattice(lattice, lattice_number, output_files):
+    if lattice == 13:
+        raise ValueError("Invalid lattice.")
+    # Make the earlier lattices slower, so that they finish out of order.
+    time.sleep(0.001 * (10 - lattice % 10))
+    for multiplier, output_file in enumerate(output_files, 2):
+        output_file.write("{} {}\n".format(lattice_number,
+                                           lattice * multiplier))
+
+def dying_decode_lattice(lattice, lattice_number, output_files):
+    if lattice >= 5:
+        os._exit(1)
+    dummy_decode_lattice(lattice, lattice_number, output_files)
+
+class TestDecode(unittest.TestCase):
+    def setUp(self):
+        pass
+
+    def tearDown(self):
+        pass
+
+    def test_decode_parallel(self):
+        output_file = io.StringIO()
+        _decode_parallel(dummy_decode_lattice, DummyBatch(12), 3, [output_file])
+        expected = ''.join("{} {}\n".format(index, index * 2)
+                           for index in range(12))
+        self.assertEqual(output_file.getvalue(), expected)
+
+        output_files = [io.StringIO(), io.StringIO()]
+        _decode_parallel(dummy_decode_lattice, DummyBatch(12), 3, output_files)
+        self.assertEqual(output_files[0].getvalue(), expected)
+        expected = ''.join("{} {}\n".format(index, index * 3)
+                           for index in range(12))
+        self.assertEqual(output_files[1].getvalue(), expected)
+
+        output_file = io.StringIO()
+        with self.assertRaises(RuntimeError):
+            _decode_parallel(dummy_decode_lattice, DummyBatch(20), 3,
+                             [output_file])
+
+        # When all the workers die, the task queue stays full.
+        output_file = io.StringIO()
+        with self.assertRaises(RuntimeError):
+            _decode_parallel(dying_decode_lattice, DummyBatch(100), 3,
+                             [output_file])
+
+if __name__ == '__main__':
+    unittest.main()
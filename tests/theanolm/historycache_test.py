@@ -0,0 +1,58 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import unittest
+
+import numpy
+
+from theanolm.scoring.historycache import HistoryCache
+
+class TestHistoryCache(unittest.TestCase):
+    def setUp(self):
+        pass
+
+    def tearDown(self):
+        pass
+
+    def _add(self, cache, key):
+        hidden = [numpy.zeros((1, 1, 10), dtype='float32')]
+        return cache.add(key, hidden, 0)
+
+    def test_get(self):
+        cache = HistoryCache()
+        self.assertIsNone(cache.get((1, 2)))
+        entry = self._add(cache, (1, 2))
+        self.assertIs(cache.get((1, 2)), entry)
+        self.assertEqual(cache.hits, 1)
+        self.assertEqual(cache.misses, 1)
+        self.assertEqual(cache.size, 40)
+
+        self.assertIsNone(cache.get_logprob(entry, 3))
+        cache.add_logprob(entry, 3, -1.5)
+        self.assertEqual(cache.get_logprob(entry, 3), -1.5)
+        self.assertEqual(cache.logprob_hits, 1)
+        self.assertEqual(cache.logprob_misses, 1)
+        self.assertGreater(cache.size, 40)
+
+        cache.clear()
+        self.assertEqual(len(cache), 0)
+        self.assertEqual(cache.size, 0)
+        self.assertIsNone(cache.get((1, 2)))
+
+    def test_evict(self):
+        cache = HistoryCache(max_size=100)
+        self._add(cache, (1,))
+        self._add(cache, (2,))
+        self.assertEqual(len(cache), 2)
+        # Mark (1,) as recently used, so that (2,) will be evicted.
+        cache.get((1,))
+        self._add(cache, (3,))
+        self.assertEqual(len(cache), 2)
+        self.assertEqual(cache.evictions, 1)
+        self.assertIsNotNone(cache.get((1,)))
+        self.assertIsNone(cache.get((2,)))
+        self.assertIsNotNone(cache.get((3,)))
+        self.assertLessEqual(cache.size, 100)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -257,6 +257,47 @@ class TestIterators(unittest.TestCase):
         word_counts = self._compute_word_counts(iterator)
         self._assert_shortlist_counts(word_counts)
 
+    def test_bucketing(self):
+        iterator = LinearBatchIterator([self.sentences1_file,
+                                        self.sentences2_file],
+                                       self.vocabulary,
+                                       batch_size=2,
+                                       bucket_window=4)
+        self.assertEqual(len(iterator), 5)
+        sequence_indices = []
+        batch_lengths = []
+        for word_ids, file_ids, mask in iterator:
+            sequence_indices.append(iterator.sequence_indices)
+            batch_lengths.append(word_ids.shape[0])
+        self.assertEqual(sequence_indices,
+                         [[3, 0], [1, 2], [4, 7], [5, 6], [8, 9]])
+        self.assertEqual(batch_lengths, [4, 5, 3, 5, 5])
+
+        # The second epoch gives the same batches.
+        sequence_indices = [iterator.sequence_indices for _ in iterator]
+        self.assertEqual(sequence_indices,
+                         [[3, 0], [1, 2], [4, 7], [5, 6], [8, 9]])
+
+        # Two sequences of length four fit in a mini-batch, but not two
+        # sequences of length five.
+        iterator = LinearBatchIterator([self.sentences1_file,
+                                        self.sentences2_file],
+                                       self.vocabulary,
+                                       batch_size=2,
+                                       bucket_window=4,
+                                       max_batch_tokens=8)
+        self.assertEqual(len(iterator), 8)
+        sequence_indices = [iterator.sequence_indices for _ in iterator]
+        self.assertEqual(sequence_indices,
+                         [[3, 0], [1], [2], [4, 7], [5], [6], [8], [9]])
+
+        # Without bucketing the sequences are in the input order.
+        iterator = ScoringBatchIterator(self.sentences1_file,
+                                        self.vocabulary,
+                                        batch_size=2)
+        sequence_indices = [iterator.sequence_indices for _ in iterator]
+        self.assertEqual(sequence_indices, [[0, 1], [2, 3], [4]])
+
     def test_scoring_batch_iterator(self):
         iterator = ScoringBatchIterator(self.sentences1_file,
                                         self.vocabulary,
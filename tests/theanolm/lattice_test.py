@@ -6,6 +6,7 @@ import os
 import math
 from io import StringIO
 
+from theanolm.backend import InputError
 from theanolm.scoring.lattice import Lattice
 from theanolm.scoring.slflattice import SLFLattice
 from theanolm.scoring.slflattice import _split_slf_field, _split_slf_line
@@ -31,6 +32,13 @@ class TestLattice(unittest.TestCase):
         self.assertEqual(fields[2], 'WORD="QUOTE')
         self.assertEqual(fields[3], "WORD='CAUSE")
 
+        # Lines without quotes are split without shlex.
+        fields = _split_slf_line("J=1\tS=0  E=12 W=it's a=-1.5e2 l=-2\r\n")
+        self.assertEqual(fields, ['J=1', 'S=0', 'E=12', "W=it's", 'a=-1.5e2',
+                                  'l=-2'])
+        self.assertEqual(_split_slf_line('\n'), [])
+        self.assertEqual(_split_slf_line('W=word # comment'), ['W=word'])
+
     def test_split_slf_field(self):
         lattice = SLFLattice(None)
         name, value = _split_slf_field("name=va 'lue")
@@ -241,6 +249,84 @@ class TestLattice(unittest.TestCase):
         lattice = SLFLattice(buffer.getvalue().splitlines())
         self._assert_lattice_is_correct(lattice)
 
+    def test_prune(self):
+        slf = ['VERSION=1.1',
+               'start=0',
+               'N=4 L=4',
+               'I=0',
+               'I=1',
+               'I=2',
+               'I=3',
+               'J=0 S=0 E=1 W=a a=-1.0 l=0.0',
+               'J=1 S=0 E=2 W=b a=-3.0 l=-2.0',
+               'J=2 S=1 E=3 W=c a=-1.0 l=0.0',
+               'J=3 S=2 E=3 W=c a=-1.0 l=0.0']
+
+        # The path through "b" is 4.0 worse than the best path.
+        lattice = SLFLattice(slf)
+        self.assertEqual(lattice.prune(beam=5.0), 0)
+        self.assertEqual(len(lattice.nodes), 4)
+        lattice = SLFLattice(slf)
+        self.assertEqual(lattice.prune(beam=3.0), 2)
+        self.assertEqual(len(lattice.nodes), 3)
+        self.assertEqual(len(lattice.links), 2)
+        self.assertEqual([node.id for node in lattice.nodes], [0, 1, 2])
+        self.assertEqual([link.word for link in lattice.links], ['a', 'c'])
+        self.assertTrue(lattice.nodes[2].final)
+        self.assertEqual(lattice.nodes[1].in_links, [lattice.links[0]])
+        self.assertEqual(lattice.nodes[1].out_links, [lattice.links[1]])
+
+        # A smaller LM scale or a positive word insertion penalty reduces the
+        # difference, but only the LM score is scaled.
+        lattice = SLFLattice(slf)
+        self.assertEqual(lattice.prune(beam=3.0, lm_scale=0.25), 0)
+        lattice = SLFLattice(slf)
+        self.assertEqual(lattice.prune(beam=3.0, wi_penalty=1.0), 2)
+
+        # The posterior probability of the path through "b" is
+        # exp(-6) / (exp(-2) + exp(-6)) = 0.018.
+        lattice = SLFLattice(slf)
+        self.assertEqual(lattice.prune(min_posterior=0.01), 0)
+        lattice = SLFLattice(slf)
+        self.assertEqual(lattice.prune(min_posterior=0.02), 2)
+
+        # The best path is never removed.
+        lattice = SLFLattice(slf)
+        self.assertEqual(lattice.prune(beam=0.0, min_posterior=1.0), 2)
+        self.assertEqual([link.word for link in lattice.links], ['a', 'c'])
+
+        # Posterior pruning requires a positive LM scale, but beam pruning
+        # doesn't.
+        lattice = SLFLattice(slf)
+        with self.assertRaises(InputError):
+            lattice.prune(min_posterior=0.01, lm_scale=0.0)
+        self.assertEqual(lattice.prune(beam=3.0, lm_scale=0.0), 0)
+
+    def test_prune_incomplete_paths(self):
+        # Each of the ten links from node 0 to node 1 has posterior 0.04, but
+        # the link from node 1 to node 3 has posterior 0.4. It has to be removed
+        # with the links that lead to it.
+        slf = ['VERSION=1.1',
+               'start=0',
+               'end=3',
+               'N=4 L=13',
+               'I=0',
+               'I=1',
+               'I=2',
+               'I=3']
+        for link_id in range(10):
+            slf.append('J={} S=0 E=1 W=x{} a=-3.2189 l=0.0'
+                       .format(link_id, link_id))
+        slf.extend(['J=10 S=1 E=3 W=y a=0.0 l=0.0',
+                    'J=11 S=0 E=2 W=z a=-0.5108 l=0.0',
+                    'J=12 S=2 E=3 W=w a=0.0 l=0.0'])
+        lattice = SLFLattice(slf)
+        self.assertEqual(lattice.prune(min_posterior=0.3), 11)
+        self.assertEqual([link.word for link in lattice.links], ['z', 'w'])
+        self.assertEqual(len(lattice.nodes), 3)
+        self.assertEqual([node.id for node in lattice.sorted_nodes()],
+                         [0, 1, 2])
+
     def _assert_lattice_is_correct(self, lattice):
         self.assertEqual(lattice.utterance_id, 'utterance 123')
         self.assertEqual(len(lattice.nodes), 24)
@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import unittest
+import os
+import gzip
+import shutil
+import tempfile
+
+from theanolm.backend import InputError
+from theanolm.scoring import LatticeBatch
+from theanolm.scoring.kaldilattice import KaldiLattice
+from theanolm.scoring.csrlattice import CSRLattice
+
+class TestLatticeBatch(unittest.TestCase):
+    def setUp(self):
+        script_path = os.path.dirname(os.path.realpath(__file__))
+        self.wordmap_path = os.path.join(script_path, 'words.txt')
+        self.temp_dir = tempfile.mkdtemp()
+
+        lat_path = os.path.join(script_path, 'lattice.lat')
+        with open(lat_path, 'r') as lat_file:
+            lattice_lines = lat_file.read().strip().splitlines()[1:]
+        self.archive_path = os.path.join(self.temp_dir, 'lat.1.gz')
+        with gzip.open(self.archive_path, 'wt') as archive_file:
+            for utterance_id in ['utt1', 'utt2', 'utt3']:
+                archive_file.write(utterance_id + '\n')
+                archive_file.write('\n'.join(lattice_lines) + '\n\n')
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def _read_lattices(self, **kwargs):
+        with open(self.wordmap_path, 'r') as wordmap_file:
+            batch = LatticeBatch([self.archive_path], None, 'kaldi',
+                                 wordmap_file, **kwargs)
+        return list(batch)
+
+    def test_kaldi_archive(self):
+        lattices = self._read_lattices()
+        self.assertEqual([lattice.utterance_id for lattice in lattices],
+                         ['utt1', 'utt2', 'utt3'])
+        for lattice in lattices:
+            self.assertIsInstance(lattice, KaldiLattice)
+            self.assertEqual(len(lattice.links), 39)
+
+    def test_prefetch(self):
+        # Lattice objects are parsed in a thread.
+        lattices = self._read_lattices(prefetch=1)
+        self.assertEqual([lattice.utterance_id for lattice in lattices],
+                         ['utt1', 'utt2', 'utt3'])
+        self.assertIsInstance(lattices[0], KaldiLattice)
+
+        # Compact lattices are parsed in a process.
+        lattices = self._read_lattices(prefetch=2, compact=True)
+        self.assertEqual([lattice.utterance_id for lattice in lattices],
+                         ['utt1', 'utt2', 'utt3'])
+        self.assertIsInstance(lattices[0], CSRLattice)
+        self.assertEqual(lattices[2].num_links, 39)
+
+        # Errors are raised in the consumer.
+        with gzip.open(self.archive_path, 'at') as archive_file:
+            archive_file.write('utt4\n0 1 2\n')
+        for compact in [False, True]:
+            with self.assertRaises(InputError):
+                self._read_lattices(prefetch=1, compact=compact)
+
+    def test_binary_archive(self):
+        with gzip.open(self.archive_path, 'wb') as archive_file:
+            archive_file.write(b'utt1 \0B\4\3\2\1')
+        with self.assertRaises(InputError):
+            self._read_lattices()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,179 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import unittest
+import os
+import shutil
+import tempfile
+from io import BytesIO, StringIO
+from unittest.mock import patch
+
+import numpy
+
+from theanolm.scoring import LatticeBatch
+from theanolm.scoring.slflattice import SLFLattice
+from theanolm.scoring.kaldilattice import KaldiLattice, read_kaldi_vocabulary
+from theanolm.scoring.csrlattice import CSRLattice
+from theanolm.scoring.latticecache import LatticeCache, \
+                                         write_lattice_archive, \
+                                         read_lattice_archive
+
+class TestLatticeCache(unittest.TestCase):
+    def setUp(self):
+        script_path = os.path.dirname(os.path.realpath(__file__))
+        self.slf_path = os.path.join(script_path, 'lattice.slf')
+        self.lat_path = os.path.join(script_path, 'lattice.lat')
+        self.wordmap_path = os.path.join(script_path, 'words.txt')
+        self.cache_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir)
+
+    def _assert_lattices_equal(self, lattice1, lattice2):
+        self.assertEqual(lattice1.utterance_id, lattice2.utterance_id)
+        self.assertEqual(lattice1.lm_scale, lattice2.lm_scale)
+        self.assertEqual(lattice1.wi_penalty, lattice2.wi_penalty)
+        self.assertEqual(lattice1.initial_node_id, lattice2.initial_node_id)
+        for name in ['node_times', 'node_finals', 'out_offsets', 'in_offsets',
+                     'out_link_ids', 'in_link_ids', 'link_starts', 'link_ends',
+                     'ac_logprobs', 'lm_logprobs']:
+            self.assertTrue(numpy.array_equal(getattr(lattice1, name),
+                                              getattr(lattice2, name),
+                                              equal_nan=True),
+                            name)
+        self.assertEqual([link.word for link in lattice1.links],
+                         [link.word for link in lattice2.links])
+        self.assertEqual([link.transitions for link in lattice1.links],
+                         [link.transitions for link in lattice2.links])
+
+    def test_archive(self):
+        with open(self.wordmap_path, 'r') as wordmap_file:
+            word_to_id = read_kaldi_vocabulary(wordmap_file)
+        id_to_word = [None] * len(word_to_id)
+        for word, id in word_to_id.items():
+            id_to_word[id] = word
+
+        with open(self.slf_path, 'r') as slf_file:
+            slf_lattice = CSRLattice(SLFLattice(slf_file))
+        with open(self.lat_path, 'r') as lat_file:
+            kaldi_lattice = CSRLattice(KaldiLattice(lat_file.readlines(),
+                                                    id_to_word))
+        other_lattice = CSRLattice(SLFLattice(['N=2 L=1',
+                                               'J=0 S=0 E=1 W=to a=-1.5']))
+        lattices = [slf_lattice, kaldi_lattice, other_lattice]
+
+        archive_file = BytesIO()
+        write_lattice_archive(lattices, archive_file)
+        archive_file.seek(0)
+        loaded_lattices = read_lattice_archive(archive_file)
+        self.assertEqual(len(loaded_lattices), 3)
+        for lattice, loaded_lattice in zip(lattices, loaded_lattices):
+            self._assert_lattices_equal(lattice, loaded_lattice)
+        self.assertIsNone(loaded_lattices[2].utterance_id)
+        self.assertIsNone(loaded_lattices[2].lm_scale)
+        self.assertIsNone(loaded_lattices[2].links[0].lm_logprob)
+        # The lattices share the vocabulary of the archive.
+        self.assertIs(loaded_lattices[0].words, loaded_lattices[1].words)
+
+        archive_file = BytesIO()
+        write_lattice_archive([], archive_file)
+        archive_file.seek(0)
+        self.assertEqual(read_lattice_archive(archive_file), [])
+
+    def test_lattice_batch(self):
+        batch = LatticeBatch([self.slf_path], None, 'slf',
+                             cache_dir=self.cache_dir)
+        lattices = list(batch)
+        self.assertEqual(len(os.listdir(self.cache_dir)), 1)
+        self.assertEqual(len(lattices), 1)
+        self.assertIsInstance(lattices[0], CSRLattice)
+
+        # The second time the lattice is read from the cache.
+        batch = LatticeBatch([self.slf_path], None, 'slf',
+                             cache_dir=self.cache_dir)
+        with patch.object(LatticeBatch, '_file_sources',
+                          side_effect=AssertionError):
+            sources = list(batch.sources())
+        self.assertIsInstance(sources[0], CSRLattice)
+        self.assertIs(batch.read_lattice(sources[0]), sources[0])
+        self._assert_lattices_equal(sources[0], lattices[0])
+
+    def _write_kaldi_archive(self, utterance_ids):
+        with open(self.lat_path, 'r') as lat_file:
+            lattice_lines = lat_file.read().strip().splitlines()[1:]
+        archive_path = os.path.join(self.cache_dir, 'lat.1')
+        with open(archive_path, 'w') as archive_file:
+            for utterance_id in utterance_ids:
+                archive_file.write(utterance_id + '\n')
+                archive_file.write('\n'.join(lattice_lines) + '\n\n')
+        # The archives are written in a subdirectory.
+        return archive_path, os.path.join(self.cache_dir, 'cache')
+
+    def test_fingerprint(self):
+        lat_path, cache_dir = self._write_kaldi_archive(['utt1'])
+        with open(self.wordmap_path, 'r') as wordmap_file:
+            vocabulary = wordmap_file.read()
+
+        def read_sources(vocabulary):
+            wordmap_file = StringIO(vocabulary)
+            batch = LatticeBatch([lat_path], None, 'kaldi', wordmap_file,
+                                 cache_dir=cache_dir)
+            return list(batch.sources())
+
+        lattices = read_sources(vocabulary)
+        self.assertEqual(len(os.listdir(cache_dir)), 1)
+        self.assertIn('it', [link.word for link in lattices[0].links])
+
+        # With a different vocabulary, the archive is not used.
+        other_vocabulary = vocabulary.replace('it ', 'IT ')
+        lattices = read_sources(other_vocabulary)
+        self.assertEqual(len(os.listdir(cache_dir)), 2)
+        self.assertIn('IT', [link.word for link in lattices[0].links])
+        self.assertNotIn('it', [link.word for link in lattices[0].links])
+        lattices = read_sources(vocabulary)
+        self.assertIn('it', [link.word for link in lattices[0].links])
+
+        # The fingerprint is also checked when the archive is read.
+        cache = LatticeCache(cache_dir, 'slf')
+        archive_path = os.path.join(cache_dir, os.listdir(cache_dir)[0])
+        shutil.copy(archive_path, cache.archive_path(lat_path))
+        with self.assertLogs(level='WARNING'):
+            self.assertIsNone(cache.load(lat_path))
+        self.assertNotEqual(LatticeCache.fingerprint('slf'),
+                            LatticeCache.fingerprint('kaldi', []))
+
+    def test_streaming(self):
+        lat_path, cache_dir = self._write_kaldi_archive(
+            ['utt1', 'utt2', 'utt3'])
+        with open(self.wordmap_path, 'r') as wordmap_file:
+            batch = LatticeBatch([lat_path], None, 'kaldi', wordmap_file,
+                                 cache_dir=cache_dir)
+
+        # Each lattice is yielded as soon as it has been parsed.
+        parsed = []
+        parse_lattice = batch._parse_lattice
+        def counting_parse_lattice(source):
+            parsed.append(source)
+            return parse_lattice(source)
+        batch._parse_lattice = counting_parse_lattice
+        sources = batch.sources()
+        self.assertEqual(next(sources).utterance_id, 'utt1')
+        self.assertEqual(len(parsed), 1)
+
+        # An archive is not written, if the file is not read to the end.
+        sources.close()
+        self.assertEqual(os.listdir(cache_dir), [])
+
+        lattices = list(batch.sources())
+        self.assertEqual(len(parsed), 4)
+        self.assertEqual(len(os.listdir(cache_dir)), 1)
+        with patch.object(LatticeBatch, '_file_sources',
+                          side_effect=AssertionError):
+            cached_lattices = list(batch.sources())
+        self.assertEqual([lattice.utterance_id for lattice in cached_lattices],
+                         ['utt1', 'utt2', 'utt3'])
+        for lattice, cached_lattice in zip(lattices, cached_lattices):
+            self._assert_lattices_equal(lattice, cached_lattice)
+
+if __name__ == '__main__':
+    unittest.main()
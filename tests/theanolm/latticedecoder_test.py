@@ -15,6 +15,10 @@ from theanolm.network import RecurrentState
 from theanolm.scoring import LatticeDecoder
 from theanolm.scoring.slflattice import SLFLattice
 from theanolm.scoring.lattice import Lattice
+from theanolm.scoring.csrlattice import CSRLattice
+from theanolm.scoring.bestlogprobindex import BestLogprobIndex
+from theanolm.scoring.statepool import StatePool
+from theanolm.scoring.wordhistory import WordHistory
 
 class DummyNetwork(object):
     """A dummy network for testing the lattice decoder that always outputs
@@ -33,10 +37,21 @@ class DummyNetwork(object):
         self.recurrent_state_size = [3]
         self.projection_vector = projection_vector
 
-    def target_probs(self):
         num_time_steps = self.input_word_ids.shape[0]
         num_sequences = self.input_word_ids.shape[1]
-        result = self.projection_vector[self.input_word_ids.flatten()]
+        self.hidden = self.projection_vector[self.input_word_ids.flatten()]
+        self.hidden = self.hidden.reshape([num_time_steps,
+                                           num_sequences,
+                                           1],
+                                          ndim=3)
+
+    def output_layer_inputs(self):
+        return [self.hidden]
+
+    def target_probs(self):
+        num_time_steps = self.hidden.shape[0]
+        num_sequences = self.hidden.shape[1]
+        result = self.hidden.flatten()
         result += self.projection_vector[self.target_class_ids.flatten()]
         result = result.reshape([num_time_steps,
                                  num_sequences],
@@ -72,6 +87,9 @@ class DummyLatticeDecoder(LatticeDecoder):
         self._tokens[3][0].total_logprob = -100.0
         self._tokens[3][0].recombination_hash = 1
         self._sorted_nodes[3].best_logprob = -100.0
+        self._best_logprob_index = BestLogprobIndex(self._sorted_nodes)
+        self._lookahead_logprobs = None
+        self._lattice_sweep_settings = []
         self._prune_extra_limit = None
         self._abs_min_beam = 0
         self._abs_min_max_tokens = 0
@@ -137,9 +155,9 @@ class TestLatticeDecoder(unittest.TestCase):
         history = (1, 2, 3)
         token1 = LatticeDecoder.Token(history)
         token2 = LatticeDecoder.Token.copy(token1)
-        token2.history = token2.history + (4,)
-        self.assertSequenceEqual(token1.history, (1, 2, 3))
-        self.assertSequenceEqual(token2.history, (1, 2, 3, 4))
+        token2.history = WordHistory(4, token2.history)
+        self.assertSequenceEqual(token1.history.words(), (1, 2, 3))
+        self.assertSequenceEqual(token2.history.words(), (1, 2, 3, 4))
 
     def test_recompute_hash(self):
         token1 = LatticeDecoder.Token(history=(1, 12, 203, 3004, 23455))
@@ -198,7 +216,17 @@ class TestLatticeDecoder(unittest.TestCase):
         # ln(exp(-1000) * (0.75 * exp(-1002) + 0.25 * exp(-1001)))
         assert_almost_equal(token.total_logprob, -2001.64263, decimal=4)
 
-    def test_append_word(self):
+    def _append_word(self, decoder, tokens, target_word):
+        # Appends the word to all the tokens, like the decoder does with the
+        # results of _append_words().
+        logprobs, states = decoder._append_words(tokens, [(target_word, None)])
+        self.assertEqual(logprobs.shape, (1, len(tokens)))
+        for token, logprob, state in zip(tokens, logprobs[0], states):
+            token.history = WordHistory(target_word, token.history)
+            token.state = state
+            token.nn_lm_logprob += logprob
+
+    def test_append_words(self):
         decoding_options = {
             'nnlm_weight': 1.0,
             'lm_scale': 1.0,
@@ -212,33 +240,35 @@ class TestLatticeDecoder(unittest.TestCase):
             'recombination_order': None,
         }
 
+        decoder = LatticeDecoder(self.network, decoding_options)
+        state_pool = decoder._state_pool
         initial_state = RecurrentState(self.network.recurrent_state_size)
+        initial_state = state_pool.add(initial_state)[0]
         token1 = LatticeDecoder.Token(history=(self.sos_id,), state=initial_state)
         token2 = LatticeDecoder.Token(history=(self.sos_id, self.yksi_id), state=initial_state)
-        decoder = LatticeDecoder(self.network, decoding_options)
 
-        self.assertSequenceEqual(token1.history, (self.sos_id,))
-        self.assertSequenceEqual(token2.history, (self.sos_id, self.yksi_id))
-        assert_equal(token1.state.get(0), numpy.zeros(shape=(1,1,3)).astype(theano.config.floatX))
-        assert_equal(token2.state.get(0), numpy.zeros(shape=(1,1,3)).astype(theano.config.floatX))
+        self.assertSequenceEqual(token1.history.words(), (self.sos_id,))
+        self.assertSequenceEqual(token2.history.words(), (self.sos_id, self.yksi_id))
+        assert_equal(state_pool.get([token1.state]).get(0), numpy.zeros(shape=(1,1,3)).astype(theano.config.floatX))
+        assert_equal(state_pool.get([token2.state]).get(0), numpy.zeros(shape=(1,1,3)).astype(theano.config.floatX))
         self.assertEqual(token1.nn_lm_logprob, 0.0)
         self.assertEqual(token2.nn_lm_logprob, 0.0)
 
-        decoder._append_word([token1, token2], self.kaksi_id)
-        self.assertSequenceEqual(token1.history, (self.sos_id, self.kaksi_id))
-        self.assertSequenceEqual(token2.history, (self.sos_id, self.yksi_id, self.kaksi_id))
-        assert_equal(token1.state.get(0), numpy.ones(shape=(1,1,3)).astype(theano.config.floatX))
-        assert_equal(token2.state.get(0), numpy.ones(shape=(1,1,3)).astype(theano.config.floatX))
+        self._append_word(decoder, [token1, token2], self.kaksi_id)
+        self.assertSequenceEqual(token1.history.words(), (self.sos_id, self.kaksi_id))
+        self.assertSequenceEqual(token2.history.words(), (self.sos_id, self.yksi_id, self.kaksi_id))
+        assert_equal(state_pool.get([token1.state]).get(0), numpy.ones(shape=(1,1,3)).astype(theano.config.floatX))
+        assert_equal(state_pool.get([token2.state]).get(0), numpy.ones(shape=(1,1,3)).astype(theano.config.floatX))
         token1_nn_lm_logprob = math.log(self.sos_prob + self.kaksi_prob)
         token2_nn_lm_logprob = math.log(self.yksi_prob + self.kaksi_prob)
         self.assertAlmostEqual(token1.nn_lm_logprob, token1_nn_lm_logprob)
         self.assertAlmostEqual(token2.nn_lm_logprob, token2_nn_lm_logprob)
 
-        decoder._append_word([token1, token2], self.eos_id)
-        self.assertSequenceEqual(token1.history, (self.sos_id, self.kaksi_id, self.eos_id))
-        self.assertSequenceEqual(token2.history, (self.sos_id, self.yksi_id, self.kaksi_id, self.eos_id))
-        assert_equal(token1.state.get(0), numpy.ones(shape=(1,1,3)).astype(theano.config.floatX) * 2)
-        assert_equal(token2.state.get(0), numpy.ones(shape=(1,1,3)).astype(theano.config.floatX) * 2)
+        self._append_word(decoder, [token1, token2], self.eos_id)
+        self.assertSequenceEqual(token1.history.words(), (self.sos_id, self.kaksi_id, self.eos_id))
+        self.assertSequenceEqual(token2.history.words(), (self.sos_id, self.yksi_id, self.kaksi_id, self.eos_id))
+        assert_equal(state_pool.get([token1.state]).get(0), numpy.ones(shape=(1,1,3)).astype(theano.config.floatX) * 2)
+        assert_equal(state_pool.get([token2.state]).get(0), numpy.ones(shape=(1,1,3)).astype(theano.config.floatX) * 2)
         token1_nn_lm_logprob += math.log(self.kaksi_prob + self.eos_prob)
         token2_nn_lm_logprob += math.log(self.kaksi_prob + self.eos_prob)
         self.assertAlmostEqual(token1.nn_lm_logprob, token1_nn_lm_logprob)
@@ -252,22 +282,108 @@ class TestLatticeDecoder(unittest.TestCase):
 
         decoding_options['use_shortlist'] = True
         decoder = LatticeDecoder(self.network, decoding_options)
-        decoder._append_word([token1, token2], self.oos1_id)
-        self.assertSequenceEqual(token1.history, [self.sos_id, self.kaksi_id, self.eos_id, self.oos1_id])
-        self.assertSequenceEqual(token2.history, [self.sos_id, self.yksi_id, self.kaksi_id, self.eos_id, self.oos1_id])
+        decoder._state_pool = state_pool
+        self._append_word(decoder, [token1, token2], self.oos1_id)
+        self.assertSequenceEqual(token1.history.words(), [self.sos_id, self.kaksi_id, self.eos_id, self.oos1_id])
+        self.assertSequenceEqual(token2.history.words(), [self.sos_id, self.yksi_id, self.kaksi_id, self.eos_id, self.oos1_id])
         token1_nn_lm_logprob += math.log((self.eos_prob + self.unk_prob) / 3)
         token2_nn_lm_logprob += math.log((self.eos_prob + self.unk_prob) / 3)
         self.assertAlmostEqual(token1.nn_lm_logprob, token1_nn_lm_logprob)
         self.assertAlmostEqual(token2.nn_lm_logprob, token2_nn_lm_logprob)
 
-        decoder._append_word([token1, token2], self.oos2_id)
-        self.assertSequenceEqual(token1.history, [self.sos_id, self.kaksi_id, self.eos_id, self.oos1_id, self.oos2_id])
-        self.assertSequenceEqual(token2.history, [self.sos_id, self.yksi_id, self.kaksi_id, self.eos_id, self.oos1_id, self.oos2_id])
+        self._append_word(decoder, [token1, token2], self.oos2_id)
+        self.assertSequenceEqual(token1.history.words(), [self.sos_id, self.kaksi_id, self.eos_id, self.oos1_id, self.oos2_id])
+        self.assertSequenceEqual(token2.history.words(), [self.sos_id, self.yksi_id, self.kaksi_id, self.eos_id, self.oos1_id, self.oos2_id])
         token1_nn_lm_logprob += math.log((self.unk_prob + self.unk_prob) / 3 * 2)
         token2_nn_lm_logprob += math.log((self.unk_prob + self.unk_prob) / 3 * 2)
         self.assertAlmostEqual(token1.nn_lm_logprob, token1_nn_lm_logprob)
         self.assertAlmostEqual(token2.nn_lm_logprob, token2_nn_lm_logprob)
 
+        # Several targets, each computed only for a range of the tokens.
+        token3 = LatticeDecoder.Token(history=(self.sos_id,), state=initial_state)
+        tokens = [token1, token2, token3]
+        logprobs, states = decoder._append_words(
+            tokens, [(self.kaksi_id, None), (self.eos_id, None)],
+            [slice(0, 1), slice(2, 3)])
+        self.assertEqual(logprobs.shape, (2, 3))
+        # The last word of token1 is OOS, so the input is <unk>.
+        self.assertAlmostEqual(logprobs[0][0],
+                               math.log(self.unk_prob + self.kaksi_prob))
+        self.assertAlmostEqual(logprobs[1][2],
+                               math.log(self.sos_prob + self.eos_prob))
+        for target_index, token_index in [(0, 1), (0, 2), (1, 0), (1, 1)]:
+            self.assertEqual(logprobs[target_index][token_index], -numpy.inf)
+        # The state is not updated for token2, which is not needed.
+        self.assertIsNotNone(states[0])
+        self.assertIsNone(states[1])
+        assert_equal(state_pool.get([states[2]]).get(0),
+                     numpy.ones(shape=(1,1,3)).astype(theano.config.floatX))
+
+    def test_propagate(self):
+        decoding_options = {
+            'nnlm_weight': 1.0,
+            'lm_scale': 1.0,
+            'wi_penalty': 0.0,
+            'unk_penalty': None,
+            'use_shortlist': False,
+            'unk_from_lattice': False,
+            'linear_interpolation': False,
+            'max_tokens_per_node': None,
+            'beam': None,
+            'recombination_order': None,
+        }
+        decoder = LatticeDecoder(self.network, decoding_options)
+
+        initial_state = RecurrentState(self.network.recurrent_state_size)
+        initial_state = decoder._state_pool.add(initial_state)[0]
+        token1 = LatticeDecoder.Token(history=(self.sos_id,), state=initial_state)
+        token2 = LatticeDecoder.Token(history=(self.sos_id, self.yksi_id), state=initial_state)
+        lattice = Lattice()
+        lattice.nodes = [Lattice.Node(id) for id in range(4)]
+        lattice.links = [Lattice.Link(lattice.nodes[0], lattice.nodes[1], 'yksi'),
+                         Lattice.Link(lattice.nodes[0], lattice.nodes[2], 'kaksi'),
+                         Lattice.Link(lattice.nodes[0], lattice.nodes[3], None,
+                                      lm_logprob=-1.0)]
+        lattice.nodes[0].out_links = list(lattice.links)
+        decoder._set_lattice(lattice)
+        decoder._best_logprob_index = BestLogprobIndex(lattice.nodes)
+
+        num_state_calls = 0
+        num_target_calls = 0
+        predict_state = decoder._step_predictor.predict_state
+        target_logprobs = decoder._step_predictor.target_logprobs
+        def counting_predict_state(*args):
+            nonlocal num_state_calls
+            num_state_calls += 1
+            return predict_state(*args)
+        def counting_target_logprobs(*args):
+            nonlocal num_target_calls
+            num_target_calls += 1
+            return target_logprobs(*args)
+        decoder._step_predictor.predict_state = counting_predict_state
+        decoder._step_predictor.target_logprobs = counting_target_logprobs
+
+        result = decoder._propagate([token1, token2], [None, 0, 1, 2], 1.0, 0.0)
+        self.assertEqual(num_state_calls, 1)
+        self.assertEqual(num_target_calls, 1)
+        self.assertEqual(len(result), 4)
+        eos_tokens, yksi_tokens, kaksi_tokens, null_tokens = result
+        self.assertSequenceEqual(eos_tokens[0].history.words(), (self.sos_id, self.eos_id))
+        self.assertSequenceEqual(yksi_tokens[1].history.words(), (self.sos_id, self.yksi_id, self.yksi_id))
+        self.assertSequenceEqual(kaksi_tokens[0].history.words(), (self.sos_id, self.kaksi_id))
+        self.assertSequenceEqual(null_tokens[1].history.words(), (self.sos_id, self.yksi_id))
+        self.assertAlmostEqual(eos_tokens[0].nn_lm_logprob,
+                               math.log(self.sos_prob + self.eos_prob))
+        self.assertAlmostEqual(yksi_tokens[1].nn_lm_logprob,
+                               math.log(self.yksi_prob + self.yksi_prob))
+        self.assertAlmostEqual(kaksi_tokens[0].nn_lm_logprob,
+                               math.log(self.sos_prob + self.kaksi_prob))
+        self.assertEqual(null_tokens[0].nn_lm_logprob, 0.0)
+        self.assertAlmostEqual(null_tokens[0].lat_lm_logprob, -1.0)
+        assert_equal(decoder._state_pool.get([kaksi_tokens[1].state]).get(0), numpy.ones(shape=(1,1,3)).astype(theano.config.floatX))
+        self.assertEqual(lattice.nodes[2].best_logprob,
+                         max(token.total_logprob for token in kaksi_tokens))
+
     def test_prune(self):
         # token recombination
         decoder = DummyLatticeDecoder()
@@ -314,6 +430,22 @@ class TestLatticeDecoder(unittest.TestCase):
         self.assertEqual(len(decoder._tokens[2]), 1)
         self.assertEqual(decoder._tokens[2][0].total_logprob, -30)
 
+        # Beam pruning works also when every token has zero probability.
+        decoder = DummyLatticeDecoder()
+        decoder._max_tokens_per_node = None
+        decoder._recombination_order = None
+        decoder._beam = 10
+        for node in decoder._sorted_nodes:
+            node.best_logprob = None
+        for node_tokens in decoder._tokens:
+            for token in node_tokens:
+                token.total_logprob = -numpy.inf
+        decoder._best_logprob_index = BestLogprobIndex(decoder._sorted_nodes)
+        decoder._best_logprob_index.update(decoder._sorted_nodes[2], -numpy.inf)
+        decoder._prune(decoder._sorted_nodes[2], decoder._sorted_nodes, decoder._tokens, [])
+        self.assertEqual(len(decoder._tokens[2]), 1)
+        self.assertEqual(decoder._tokens[2][0].total_logprob, -numpy.inf)
+
         # max tokens per node
         decoder = DummyLatticeDecoder()
         decoder._beam = None
@@ -334,6 +466,66 @@ class TestLatticeDecoder(unittest.TestCase):
         self.assertEqual(len(decoder._tokens[2]), 1)
         self.assertEqual(decoder._tokens[2][0].total_logprob, -30)
 
+        # Ties are resolved in favour of the tokens that come first.
+        decoder = DummyLatticeDecoder()
+        decoder._beam = None
+        decoder._recombination_order = None
+        decoder._max_tokens_per_node = 2
+        node_tokens = decoder._tokens[2]
+        for token in node_tokens:
+            token.total_logprob = -50.0
+        node_tokens[2].recombination_hash = 2
+        recomb_tokens = []
+        decoder._prune(decoder._sorted_nodes[2], decoder._sorted_nodes, decoder._tokens, recomb_tokens)
+        self.assertEqual(decoder._tokens[2], node_tokens[:2])
+        self.assertEqual(len(recomb_tokens), 1)
+
+    def test_lookahead(self):
+        # The link from node 2 is cheap, but the rest of the path is expensive.
+        lattice = SLFLattice(['VERSION=1.1',
+                              'start=0',
+                              'N=4 L=5',
+                              'I=0 t=0.0',
+                              'I=1 t=1.0',
+                              'I=2 t=1.0',
+                              'I=3 t=2.0',
+                              'J=0 S=0 E=1 W=yksi a=-1.0 l=0.0',
+                              'J=1 S=0 E=1 W=kaksi a=-2.0 l=0.0',
+                              'J=2 S=0 E=2 W=kolme a=-0.5 l=0.0',
+                              'J=3 S=1 E=3 W=!NULL a=-1.0 l=0.0',
+                              'J=4 S=2 E=3 W=!NULL a=-100.0 l=0.0'])
+        assert_almost_equal(lattice.lookahead_logprobs(),
+                            [-2.0, -1.0, -100.0, 0.0])
+
+        decoding_options = {
+            'nnlm_weight': 0.0,
+            'lm_scale': None,
+            'wi_penalty': None,
+            'unk_penalty': None,
+            'use_shortlist': False,
+            'unk_from_lattice': False,
+            'linear_interpolation': True,
+            'max_tokens_per_node': None,
+            'beam': 1.5,
+            'recombination_order': None
+        }
+
+        # Without look-ahead, "kaksi" is compared to "kolme" at the same time.
+        decoder = LatticeDecoder(self.network, decoding_options)
+        tokens = decoder.decode(lattice)[0]
+        paths = [' '.join(token.history_words(self.vocabulary))
+                 for token in tokens]
+        self.assertListEqual(paths, ['<s> yksi </s>'])
+
+        decoding_options['lookahead'] = True
+        decoder = LatticeDecoder(self.network, decoding_options)
+        tokens = decoder.decode(lattice)[0]
+        paths = [' '.join(token.history_words(self.vocabulary))
+                 for token in tokens]
+        self.assertListEqual(paths, ['<s> yksi </s>', '<s> kaksi </s>'])
+        self.assertAlmostEqual(tokens[0].total_logprob, -2.0)
+        self.assertAlmostEqual(tokens[1].total_logprob, -3.0)
+
     def test_decode(self):
         vocabulary = Vocabulary.from_word_counts({
             'to': 1,
@@ -393,6 +585,11 @@ class TestLatticeDecoder(unittest.TestCase):
         paths = [' '.join(token.history_words(vocabulary)) for token in tokens]
         self.assertListEqual(paths, all_paths)
 
+        # A compact lattice gives the same paths.
+        csr_tokens = decoder.decode(CSRLattice(self.lattice))[0]
+        paths = [' '.join(token.history_words(vocabulary)) for token in csr_tokens]
+        self.assertListEqual(paths, all_paths)
+
         token = tokens[0]
         history = ' '.join(token.history_words(vocabulary))
         self.assertAlmostEqual(token.ac_logprob / log_scale, -8686.28, places=2)
@@ -409,5 +606,128 @@ class TestLatticeDecoder(unittest.TestCase):
         self.assertAlmostEqual(token.lat_lm_logprob / log_scale, -178.00, places=2)
         self.assertAlmostEqual(token.nn_lm_logprob, math.log(0.1) * 5)
 
+        decoding_options['cache_size'] = 1.0
+        decoder = LatticeDecoder(network, decoding_options)
+        cached_tokens = decoder.decode(self.lattice)[0]
+        paths = [' '.join(token.history_words(vocabulary)) for token in cached_tokens]
+        self.assertListEqual(paths, all_paths)
+        for token, cached_token in zip(tokens, cached_tokens):
+            self.assertAlmostEqual(token.nn_lm_logprob, cached_token.nn_lm_logprob)
+            self.assertAlmostEqual(token.total_logprob, cached_token.total_logprob)
+        self.assertGreater(decoder._history_cache.hits, 0)
+
+        # Force the state pool to release states during decoding.
+        for cache_size in (None, 1.0):
+            decoding_options['cache_size'] = cache_size
+            decoder = LatticeDecoder(network, decoding_options)
+            decoder._state_pool = StatePool(network.recurrent_state_size,
+                                            initial_capacity=1)
+            # The dummy network increments the state by one after every word.
+            propagate = decoder._propagate
+            def checking_propagate(tokens, *args):
+                states = decoder._state_pool.get([token.state for token in tokens]).get(0)
+                lengths = [len(token.history) - 1 for token in tokens]
+                assert_equal(states[0, :, 0], lengths)
+                return propagate(tokens, *args)
+            decoder._propagate = checking_propagate
+            small_pool_tokens = decoder.decode(self.lattice)[0]
+            paths = [' '.join(token.history_words(vocabulary)) for token in small_pool_tokens]
+            self.assertListEqual(paths, all_paths)
+            for token, small_pool_token in zip(tokens, small_pool_tokens):
+                self.assertAlmostEqual(token.total_logprob, small_pool_token.total_logprob)
+
+        # Propagating the nodes at the same time in batches should give the
+        # same result with fewer calls to the network.
+        def count_calls(decoder):
+            counter = {'calls': 0}
+            predict_state = decoder._step_predictor.predict_state
+            def counting_predict_state(*args):
+                counter['calls'] += 1
+                return predict_state(*args)
+            decoder._step_predictor.predict_state = counting_predict_state
+            return counter
+
+        decoding_options['cache_size'] = None
+        decoder = LatticeDecoder(network, decoding_options)
+        counter = count_calls(decoder)
+        decoder.decode(self.lattice)
+        num_calls = counter['calls']
+        decoding_options['batch_nodes'] = True
+        decoder = LatticeDecoder(network, decoding_options)
+        counter = count_calls(decoder)
+        batch_tokens = decoder.decode(self.lattice)[0]
+        self.assertLess(counter['calls'], num_calls)
+        paths = [' '.join(token.history_words(vocabulary)) for token in batch_tokens]
+        self.assertListEqual(paths, all_paths)
+        for token, batch_token in zip(tokens, batch_tokens):
+            self.assertAlmostEqual(token.nn_lm_logprob, batch_token.nn_lm_logprob)
+            self.assertAlmostEqual(token.total_logprob, batch_token.total_logprob)
+
+        # Limiting the number of active tokens should keep the best path.
+        decoding_options['batch_nodes'] = False
+        decoding_options['max_active_tokens'] = 3
+        decoder = LatticeDecoder(network, decoding_options)
+        prune_active_tokens = decoder._prune_active_tokens
+        def checking_prune_active_tokens(tokens, active_node_ids):
+            prune_active_tokens(tokens, active_node_ids)
+            num_tokens = sum(len(tokens[node_id]) for node_id in active_node_ids)
+            self.assertLessEqual(num_tokens, max(3, len(active_node_ids)))
+        decoder._prune_active_tokens = checking_prune_active_tokens
+        active_tokens = decoder.decode(self.lattice)[0]
+        self.assertGreater(decoder._num_active_pruned, 0)
+        self.assertLess(len(active_tokens), len(all_paths))
+        self.assertEqual(' '.join(active_tokens[0].history_words(vocabulary)),
+                         all_paths[0])
+        self.assertAlmostEqual(active_tokens[0].total_logprob,
+                               tokens[0].total_logprob)
+        del decoding_options['max_active_tokens']
+
+        # Ranking the final tokens with other parameters should give the same
+        # result as recomputing the total log probabilities.
+        settings = [(0.0, 1.0, 0.0), (0.5, 2.0, -1.0), (1.0, 10.0, 5.0)]
+        sweep_tokens = decoder.rescore_tokens(tokens, settings, 5)
+        self.assertEqual(len(sweep_tokens), 3)
+        for (nnlm_weight, lm_scale, wi_penalty), rescored_tokens in \
+            zip(settings, sweep_tokens):
+            expected_tokens = []
+            for token in tokens:
+                token = LatticeDecoder.Token.copy(token)
+                token.recompute_total(nnlm_weight, lm_scale, wi_penalty, True)
+                expected_tokens.append(token)
+            expected_tokens.sort(key=lambda token: token.total_logprob,
+                                 reverse=True)
+            self.assertEqual(len(rescored_tokens), 5)
+            for expected, rescored in zip(expected_tokens, rescored_tokens):
+                self.assertEqual(expected.history.words(),
+                                 rescored.history.words())
+                self.assertAlmostEqual(expected.total_logprob,
+                                       rescored.total_logprob)
+                self.assertAlmostEqual(expected.graph_logprob,
+                                       rescored.graph_logprob)
+
+        # With sweep settings, recombination keeps the best token with every
+        # setting, so ranking the final tokens gives the same best path as
+        # decoding with each setting.
+        decoding_options['recombination_order'] = 1
+        settings = [(0.0, None, None), (1.0, 1.0, 100.0), (0.5, 0.1, 50.0)]
+        decoding_options['sweep_settings'] = settings
+        decoder = LatticeDecoder(network, decoding_options)
+        sweep_tokens = decoder.decode(self.lattice)[0]
+        del decoding_options['sweep_settings']
+        for nnlm_weight, lm_scale, wi_penalty in settings:
+            decoding_options['nnlm_weight'] = nnlm_weight
+            decoding_options['lm_scale'] = lm_scale
+            decoding_options['wi_penalty'] = wi_penalty
+            decoder = LatticeDecoder(network, decoding_options)
+            expected = decoder.decode(self.lattice)[0][0]
+            lm_scale, wi_penalty = decoder._lattice_settings(
+                self.lattice, lm_scale, wi_penalty)
+            rescored = decoder.rescore_tokens(
+                sweep_tokens, [(nnlm_weight, lm_scale, wi_penalty)], 1)[0][0]
+            self.assertEqual(expected.history.words(),
+                             rescored.history.words())
+            self.assertAlmostEqual(expected.total_logprob,
+                                   rescored.total_logprob, places=2)
+
 if __name__ == '__main__':
     unittest.main()
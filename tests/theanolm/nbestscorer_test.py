@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import unittest
+import os
+
+import numpy
+import theano
+from theano import tensor
+
+from theanolm import Vocabulary
+from theanolm.scoring import NBestScorer
+
+class DummyNetwork(object):
+    """A dummy network for testing the n-best scorer that always outputs
+    projection of input word + projection of output class.
+    """
+
+    def __init__(self, vocabulary, projection_vector):
+        self.vocabulary = vocabulary
+        self.input_word_ids = tensor.matrix('input_word_ids', dtype='int64')
+        self.input_class_ids = tensor.matrix('input_class_ids', dtype='int64')
+        self.target_class_ids = tensor.matrix('target_class_ids', dtype='int64')
+        self.is_training = tensor.scalar('is_training', dtype='int8')
+        self.recurrent_state_input = [tensor.tensor3('recurrent_state_1', dtype=theano.config.floatX)]
+        self.recurrent_state_output = [self.recurrent_state_input[0] + 1]
+        self.recurrent_state_size = [3]
+        self.projection_vector = projection_vector
+
+        num_time_steps = self.input_word_ids.shape[0]
+        num_sequences = self.input_word_ids.shape[1]
+        self.hidden = self.projection_vector[self.input_word_ids.flatten()]
+        self.hidden = self.hidden.reshape([num_time_steps,
+                                           num_sequences,
+                                           1],
+                                          ndim=3)
+
+    def output_layer_inputs(self):
+        return [self.hidden]
+
+    def target_probs(self):
+        num_time_steps = self.hidden.shape[0]
+        num_sequences = self.hidden.shape[1]
+        result = self.hidden.flatten()
+        result += self.projection_vector[self.target_class_ids.flatten()]
+        result = result.reshape([num_time_steps,
+                                 num_sequences],
+                                ndim=2)
+        return result
+
+class TestNBestScorer(unittest.TestCase):
+    def setUp(self):
+        script_path = os.path.dirname(os.path.realpath(__file__))
+        vocabulary_path = os.path.join(script_path, 'vocabulary.txt')
+        with open(vocabulary_path) as vocabulary_file:
+            self.vocabulary = Vocabulary.from_file(vocabulary_file, 'words')
+        self.projection_vector = numpy.linspace(
+            0.01, 0.4, self.vocabulary.num_words()).astype(theano.config.floatX)
+        self.dummy_network = DummyNetwork(self.vocabulary,
+                                          theano.shared(self.projection_vector))
+
+    def tearDown(self):
+        pass
+
+    def _sequence_logprob(self, line):
+        words = ['<s>'] + line.split() + ['</s>']
+        word_ids = self.vocabulary.words_to_ids(words)
+        class_ids = [self.vocabulary.word_id_to_class_id[word_id]
+                     for word_id in word_ids]
+        return sum(numpy.log(self.projection_vector[word_ids[index]] +
+                             self.projection_vector[class_ids[index + 1]])
+                   for index in range(len(word_ids) - 1))
+
+    def test_score_hypotheses(self):
+        scorer = NBestScorer(self.dummy_network)
+        lines = ['yksi kaksi kolme',
+                 'yksi kaksi neljä',
+                 'yksi viisi',
+                 '',
+                 'yksi kaksi kolme']
+        logprobs = scorer.score_hypotheses(lines)
+        self.assertEqual(len(logprobs), 5)
+        for line, logprob in zip(lines, logprobs):
+            self.assertAlmostEqual(logprob, self._sequence_logprob(line),
+                                   places=5)
+        # The network is run once for each prefix that is followed by a word:
+        # <s>, yksi, kaksi, kolme, neljä, and viisi.
+        self.assertEqual(scorer.num_steps, 6)
+        self.assertEqual(scorer.num_words, 21)
+        self.assertEqual(scorer.score_hypotheses([]), [])
+
+if __name__ == '__main__':
+    unittest.main()
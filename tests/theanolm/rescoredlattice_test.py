@@ -0,0 +1,51 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import unittest
+
+from theanolm.backend import InputError
+from theanolm.scoring.slflattice import SLFLattice
+from theanolm.scoring.rescoredlattice import RescoredLattice
+
+class TestRescoredLattice(unittest.TestCase):
+    def setUp(self):
+        self.lattice = RescoredLattice.__new__(RescoredLattice)
+
+    def test_add_word_maps(self):
+        # A chain of null link diamonds has an exponential number of paths.
+        num_diamonds = 30
+        lines = ['N={} L={}'.format(num_diamonds * 3 + 2, num_diamonds * 4 + 1)]
+        link_id = 0
+        for index in range(num_diamonds):
+            start = index * 3
+            end = start + 3
+            for from_id, to_id in [(start, start + 1), (start, start + 2),
+                                   (start + 1, end), (start + 2, end)]:
+                lines.append('J={} S={} E={} W=!NULL a=-1'
+                             .format(link_id, from_id, to_id))
+                link_id += 1
+        lines.append('J={} S={} E={} W=word a=-2 l=-3'
+                     .format(link_id, num_diamonds * 3, num_diamonds * 3 + 1))
+        original_lattice = SLFLattice(lines)
+
+        closures = self.lattice._add_word_maps(original_lattice.nodes)
+        initial_node = original_lattice.initial_node
+        self.assertEqual(list(initial_node.word_to_link), ['word'])
+        self.assertIs(initial_node.word_to_link['word'],
+                      initial_node.out_links[1])
+        end_node, ac_logprob, lm_logprob, _ = closures[initial_node.id]['word']
+        self.assertEqual(end_node.id, num_diamonds * 3 + 1)
+        self.assertAlmostEqual(ac_logprob, -2 - 2 * num_diamonds)
+        self.assertAlmostEqual(lm_logprob, -3)
+
+    def test_null_link_cycle(self):
+        original_lattice = SLFLattice(['N=4 L=4',
+                                       'J=0 S=0 E=1 W=!NULL',
+                                       'J=1 S=1 E=2 W=!NULL',
+                                       'J=2 S=2 E=1 W=!NULL',
+                                       'J=3 S=2 E=3 W=word'])
+        with self.assertRaises(InputError):
+            self.lattice._add_word_maps(original_lattice.nodes)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -3,9 +3,10 @@
 
 import unittest
 
-from numpy.testing import assert_almost_equal
+import numpy
+from numpy.testing import assert_almost_equal, assert_equal
 
-from theanolm.commands.score import _merge_subwords
+from theanolm.commands.score import _merge_subwords, _sequence_statistics
 
 class TestScore(unittest.TestCase):
     def setUp(self):
@@ -55,5 +56,24 @@ class TestScore(unittest.TestCase):
         self.assertIsNone(word_logprobs[2])
         self.assertAlmostEqual(word_logprobs[3], 0.5)
 
+    def test_sequence_statistics(self):
+        logprobs = numpy.ma.masked_array(
+            [[-1.0, -2.0, -3.0],
+             [-numpy.inf, 0.0, -4.0],
+             [-5.0, 0.0, 0.0]],
+            mask=[[False, False, False],
+                  [False, True, False],
+                  [False, True, True]])
+        mask = numpy.array([[1, 1, 1],
+                            [1, 1, 1],
+                            [1, 1, 1],
+                            [1, 1, 0]])
+        seq_logprobs, num_probs, num_unks, num_zeroprobs = \
+            _sequence_statistics(logprobs, mask)
+        assert_almost_equal(seq_logprobs, [-6.0, -2.0, -7.0])
+        assert_equal(num_probs, [2, 1, 2])
+        assert_equal(num_unks, [0, 2, 0])
+        assert_equal(num_zeroprobs, [1, 0, 0])
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import unittest
+import os
+import shutil
+import tempfile
+
+import numpy
+
+from theanolm.scoring import ScoreCache
+
+class TestScoreCache(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def test_get(self):
+        cache = ScoreCache()
+        key = cache.key(numpy.array([1, 2, 3]))
+        self.assertEqual(key, cache.key([1, 2, 3]))
+        self.assertNotEqual(key, cache.key([1, 2]))
+        self.assertIsNone(cache.get(key))
+        cache.add(key, -1.5)
+        self.assertEqual(cache.get(key), -1.5)
+        self.assertEqual(cache.hits, 1)
+        self.assertEqual(cache.misses, 1)
+        self.assertAlmostEqual(cache.hit_rate(), 0.5)
+        self.assertAlmostEqual(ScoreCache().hit_rate(), 0.0)
+
+    def test_evict(self):
+        cache = ScoreCache(max_size=2)
+        cache.add(cache.key([1]), -1.0)
+        cache.add(cache.key([2]), -2.0)
+        # Mark [1] as recently used, so that [2] will be evicted.
+        cache.get(cache.key([1]))
+        cache.add(cache.key([3]), -3.0)
+        self.assertEqual(len(cache), 2)
+        self.assertEqual(cache.evictions, 1)
+        self.assertIsNotNone(cache.get(cache.key([1])))
+        self.assertIsNone(cache.get(cache.key([2])))
+        self.assertIsNotNone(cache.get(cache.key([3])))
+
+    def test_save_load(self):
+        path = os.path.join(self.temp_dir, 'scores.npz')
+        cache = ScoreCache(fingerprint='model 1')
+        cache.add(cache.key([1, 2]), numpy.float32(-1.5))
+        cache.add(cache.key([3, 4, 5]), numpy.float32(-2.5))
+        cache.add(cache.key([]), numpy.float32(0.0))
+        cache.get(cache.key([1, 2]))
+        cache.save(path)
+
+        cache = ScoreCache(fingerprint='model 1')
+        cache.load(path)
+        self.assertEqual(len(cache), 3)
+        self.assertEqual(cache.get(cache.key([3, 4, 5])), -2.5)
+        self.assertEqual(cache.get(cache.key([1, 2])), -1.5)
+        self.assertEqual(cache.get(cache.key([])), 0.0)
+
+        # The least recently used sentence is evicted when the cache is loaded
+        # with a smaller limit.
+        cache = ScoreCache(max_size=2, fingerprint='model 1')
+        cache.load(path)
+        self.assertEqual(len(cache), 2)
+        self.assertIsNone(cache.get(cache.key([3, 4, 5])))
+
+        # A file written using a different model is not used.
+        cache = ScoreCache(fingerprint='model 2')
+        cache.load(path)
+        self.assertEqual(len(cache), 0)
+        cache.load(os.path.join(self.temp_dir, 'missing.npz'))
+        self.assertEqual(len(cache), 0)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Measures the time it takes to parse a large synthetic SLF lattice.
+
+Compares the current parser to the reference implementation that splits every
+line using shlex and creates the links one at a time. Run as
+``python slflattice_benchmark.py [--links N] [--repeats R]``.
+"""
+
+import argparse
+import random
+import time
+from io import StringIO
+from unittest.mock import patch
+
+from theanolm.scoring import slflattice
+from theanolm.scoring.slflattice import SLFLattice
+
+class ShlexSLFLattice(SLFLattice):
+    """SLF lattice that is parsed the way it was before the fast path was
+    added.
+    """
+
+    def _read_slf_links(self, link_fields):
+        for link_id, fields in link_fields:
+            super()._read_slf_links([(link_id, fields)])
+
+def generate_lattice(num_links, links_per_node=5, seed=1):
+    """Generates a random SLF lattice.
+
+    :type num_links: int
+    :param num_links: number of links in the lattice
+
+    :type links_per_node: int
+    :param links_per_node: average number of outgoing links per node
+
+    :type seed: int
+    :param seed: seed for the random number generator
+
+    :rtype: str
+    :returns: the lattice in SLF format
+    """
+
+    rng = random.Random(seed)
+    num_nodes = num_links // links_per_node + 2
+    lines = ['VERSION=1.1',
+             'UTTERANCE=synthetic',
+             'base=10.0',
+             'lmscale=14.00',
+             'wdpenalty=0.00',
+             'start=0',
+             'end={}'.format(num_nodes - 1),
+             'NODES={}\tLINKS={}'.format(num_nodes, num_links)]
+    for node_id in range(num_nodes):
+        lines.append('I={}\tt={:.2f}'.format(node_id, node_id * 0.01))
+    for link_id in range(num_links):
+        # Link every node to the next one, so that all the nodes are connected.
+        start_id = link_id % (num_nodes - 1)
+        if link_id < num_nodes - 1:
+            end_id = start_id + 1
+        else:
+            end_id = rng.randint(start_id + 1, min(start_id + 10, num_nodes - 1))
+        lines.append('J={}\tS={}\tE={}\tW=word{}\ta={:.3f}\tl={:.3f}'.format(
+            link_id, start_id, end_id, rng.randint(0, 9999),
+            -rng.uniform(0, 1000), -rng.uniform(0, 10)))
+    return '\n'.join(lines) + '\n'
+
+def measure(lattice_class, lattice_text, repeats):
+    """Parses a lattice repeatedly and returns the best time.
+
+    :type lattice_class: class
+    :param lattice_class: the class that is used to parse the lattice
+
+    :type lattice_text: str
+    :param lattice_text: lattice in SLF format
+
+    :type repeats: int
+    :param repeats: number of times to parse the lattice
+
+    :rtype: float
+    :returns: the shortest time in seconds
+    """
+
+    best_time = None
+    for _ in range(repeats):
+        start_time = time.perf_counter()
+        lattice_class(StringIO(lattice_text))
+        elapsed_time = time.perf_counter() - start_time
+        if (best_time is None) or (elapsed_time < best_time):
+            best_time = elapsed_time
+    return best_time
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--links', type=int, default=100000)
+    parser.add_argument('--repeats', type=int, default=3)
+    args = parser.parse_args()
+
+    lattice_text = generate_lattice(args.links)
+    fast_time = measure(SLFLattice, lattice_text, args.repeats)
+    with patch.object(slflattice, '_split_slf_line',
+                      slflattice._shlex_split_slf_line):
+        reference_time = measure(ShlexSLFLattice, lattice_text, args.repeats)
+    print("{} links".format(args.links))
+    print("shlex parser: {:.3f} s".format(reference_time))
+    print("fast parser:  {:.3f} s".format(fast_time))
+    print("speedup:      {:.1f}x".format(reference_time / fast_time))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,58 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import unittest
+
+import numpy
+from numpy.testing import assert_equal
+
+from theanolm.network import RecurrentState
+from theanolm.scoring.statepool import StatePool
+
+class TestStatePool(unittest.TestCase):
+    def setUp(self):
+        pass
+
+    def tearDown(self):
+        pass
+
+    def _state(self, values, sizes):
+        state_variables = [numpy.array([[[value] * size for value in values]])
+                           for size in sizes]
+        return RecurrentState(sizes, len(values), state_variables)
+
+    def test_add_get(self):
+        pool = StatePool([2, 3], initial_capacity=2)
+        indices1 = pool.add(self._state([1, 2], [2, 3]))
+        assert_equal(indices1, [0, 1])
+        indices2 = pool.add(self._state([3, 4, 5], [2, 3]))
+        assert_equal(indices2, [2, 3, 4])
+        self.assertEqual(len(pool), 5)
+        self.assertGreaterEqual(pool.capacity, 5)
+
+        state = pool.get([4, 0, 4])
+        self.assertEqual(state.num_sequences, 3)
+        assert_equal(state.get(0), [[[5, 5], [1, 1], [5, 5]]])
+        assert_equal(state.get(1), [[[5, 5, 5], [1, 1, 1], [5, 5, 5]]])
+
+        capacity = pool.capacity
+        pool.clear()
+        self.assertEqual(len(pool), 0)
+        self.assertEqual(pool.capacity, capacity)
+        assert_equal(pool.add(self._state([6], [2, 3])), [0])
+        assert_equal(pool.get([0]).get(0), [[[6, 6]]])
+
+    def test_compact(self):
+        pool = StatePool([2], initial_capacity=4)
+        pool.add(self._state([1, 2, 3, 4], [2]))
+        self.assertFalse(pool.has_room(1))
+        mapping = pool.compact([3, 1, 3])
+        self.assertListEqual(mapping, [-1, 0, -1, 1])
+        self.assertEqual(len(pool), 2)
+        self.assertEqual(pool.peak_num_states, 4)
+        self.assertTrue(pool.has_room(2))
+        assert_equal(pool.get([0, 1]).get(0), [[[2, 2], [4, 4]]])
+        self.assertEqual(pool.state_nbytes, pool.get([0]).get(0).nbytes)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -5,12 +5,12 @@ import unittest
 import os
 
 import numpy
-from numpy.testing import assert_almost_equal
+from numpy.testing import assert_almost_equal, assert_equal
 import theano
 from theano import tensor
 
 from theanolm import Vocabulary
-from theanolm.scoring import TextScorer
+from theanolm.scoring import TextScorer, ScoreCache
 
 class DummyNetwork(object):
     """A dummy network for testing the text scorer that always outputs
@@ -104,6 +104,27 @@ class TestTextScorer(unittest.TestCase):
         self.assertIsNone(logprobs[2][2])
         self.assertIsNone(logprobs[2][3])
 
+    def test_score_batch_masked(self):
+        # OOV and OOS words are masked, as well as the elements past the
+        # sequence end.
+        scorer = TextScorer(self.dummy_network, use_shortlist=False,
+                            exclude_unk=True)
+        word_ids = numpy.arange(15).reshape((3, 5)).T
+        class_ids, _ = self.vocabulary.get_class_memberships(word_ids)
+        membership_probs = numpy.ones_like(word_ids).astype('float32')
+        mask = numpy.ones_like(word_ids)
+        mask[3:, 0] = 0
+        logprobs = scorer.score_batch_masked(word_ids, class_ids,
+                                             membership_probs, mask)
+        self.assertEqual(logprobs.shape, (4, 3))
+        assert_equal(numpy.ma.getmaskarray(logprobs),
+                     [[False, False, False],
+                      [False, False, True],
+                      [True, False, True],
+                      [True, False, True]])
+        assert_almost_equal(logprobs[:2, 0],
+                            numpy.log(word_ids[1:3, 0] / 100.0))
+
     def test_score_sequence(self):
         # Network predicts <unk> probability.
         scorer = TextScorer(self.dummy_network, use_shortlist=False)
@@ -145,5 +166,54 @@ class TestTextScorer(unittest.TestCase):
         correct = numpy.log(correct).sum()
         self.assertAlmostEqual(logprob, correct, places=5)
 
+    def test_score_lines(self):
+        scorer = TextScorer(self.dummy_network, use_shortlist=False)
+        lines = ['kaksi kolme kymmenen',
+                 '',
+                 '<s> neljä </s>',
+                 'viisi kuusi seitsemän kahdeksan yhdeksän']
+        logprobs = scorer.score_lines(lines, self.vocabulary)
+        self.assertEqual(len(logprobs), 4)
+        self.assertIsNone(logprobs[1])
+        for line, logprob in zip(lines, logprobs):
+            if line:
+                self.assertAlmostEqual(
+                    logprob, scorer.score_line(line, self.vocabulary), places=5)
+        self.assertEqual(scorer.score_lines(['', ''], self.vocabulary),
+                         [None, None])
+
+    def test_score_cache(self):
+        cache = ScoreCache()
+        scorer = TextScorer(self.dummy_network, use_shortlist=False,
+                            cache=cache)
+        lines = ['kaksi kolme',
+                 'neljä',
+                 '<s> kaksi kolme </s>',
+                 '',
+                 'neljä']
+        logprobs = scorer.score_lines(lines, self.vocabulary)
+        # The duplicates within the batch are not scored again.
+        self.assertEqual(len(cache), 2)
+        self.assertEqual(cache.misses, 2)
+        self.assertEqual(cache.hits, 2)
+        self.assertEqual(logprobs[0], logprobs[2])
+        self.assertEqual(logprobs[1], logprobs[4])
+
+        self.assertEqual(scorer.score_line('neljä', self.vocabulary),
+                         logprobs[1])
+        self.assertEqual(scorer.score_lines(lines, self.vocabulary), logprobs)
+        self.assertEqual(cache.misses, 2)
+        self.assertEqual(cache.hits, 7)
+        self.assertEqual(scorer.num_words, 31)
+
+        # The duplicates are hits even if they have been evicted.
+        cache = ScoreCache(max_size=1)
+        scorer = TextScorer(self.dummy_network, use_shortlist=False,
+                            cache=cache)
+        self.assertEqual(scorer.score_lines(lines, self.vocabulary), logprobs)
+        self.assertEqual(len(cache), 1)
+        self.assertEqual(cache.misses, 2)
+        self.assertEqual(cache.hits, 2)
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,61 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import unittest
+import random
+
+from theanolm.scoring.wordhistory import WordHistory
+
+class TestWordHistory(unittest.TestCase):
+    def setUp(self):
+        pass
+
+    def tearDown(self):
+        pass
+
+    def test_words(self):
+        history1 = WordHistory.from_words([1, 2, 3])
+        history2 = WordHistory('oov', history1)
+        self.assertEqual(len(history1), 3)
+        self.assertEqual(len(history2), 4)
+        self.assertSequenceEqual(history1.words(), (1, 2, 3))
+        self.assertSequenceEqual(history2.words(), (1, 2, 3, 'oov'))
+        self.assertIs(history2.parent, history1)
+        self.assertIsNone(WordHistory.from_words([]))
+
+    def test_ancestor(self):
+        words = list(range(100))
+        history = WordHistory.from_words(words)
+        for length in range(1, 101):
+            self.assertSequenceEqual(history.ancestor(length).words(),
+                                     words[:length])
+
+    def test_window_hash(self):
+        history1 = WordHistory.from_words([1, 12, 203, 3004, 23455])
+        history2 = WordHistory.from_words([2, 12, 203, 3004, 23455])
+        self.assertNotEqual(history1.window_hash(None),
+                            history2.window_hash(None))
+        self.assertNotEqual(history1.window_hash(5), history2.window_hash(5))
+        self.assertEqual(history1.window_hash(4), history2.window_hash(4))
+        self.assertEqual(history1.window_hash(1), history2.window_hash(1))
+        history3 = WordHistory.from_words([12, 203, 3004, 23455])
+        self.assertNotEqual(history1.window_hash(5), history3.window_hash(5))
+        self.assertEqual(history1.window_hash(4), history3.window_hash(5))
+
+    def test_random(self):
+        random.seed(1)
+        histories = [WordHistory(0)]
+        for _ in range(1000):
+            parent = random.choice(histories)
+            histories.append(WordHistory(random.randrange(4), parent))
+        for order in (None, 1, 2, 3, 5):
+            hashes = dict()
+            for history in histories:
+                words = history.words()
+                if order is not None:
+                    words = words[-order:]
+                key = history.window_hash(order)
+                self.assertEqual(hashes.setdefault(key, words), words)
+
+if __name__ == '__main__':
+    unittest.main()
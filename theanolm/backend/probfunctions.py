@@ -4,8 +4,6 @@
 defines logprob_type.
 """
 
-from decimal import Decimal, getcontext
-
 import numpy
 import theano
 
@@ -14,46 +12,34 @@ logprob_type = numpy.dtype(theano.config.floatX).type
 def interpolate_linear(logprob1, logprob2, weight1):
     """Performs linear interpolation of two probabilities.
 
-    If a probability is so small that it will be rounded to zero, uses the
-    decimal library. If a weight is zero, the corresponding log probability will
-    be ignored. Otherwise if the log probability was ``-inf``, multiplication
-    would result in a ``nan``.
+    The weighted sum is computed in the log domain using ``numpy.logaddexp()``,
+    so probabilities that are too small to be represented in linear domain will
+    not be rounded to zero. If a weight is zero, the corresponding log
+    probability will be ignored, since its logarithm is ``-inf``. The function
+    works element-wise on arrays of log probabilities.
 
-    :type logprob1: logprob_type
+    :type logprob1: logprob_type or numpy.ndarray
     :param logprob1: logarithm of first input probability
 
-    :type logprob2: logprob_type
+    :type logprob2: logprob_type or numpy.ndarray
     :param logprob2: logarithm of second input probability
 
     :type weight1: logprob_type
     :param weight1: interpolation weight for the first probability
 
-    :rtype: logprob_type
+    :rtype: logprob_type or numpy.ndarray
     :returns: logarithm of the weighted sum of the input probabilities
     """
 
-    prob1 = numpy.exp(numpy.float64(logprob1))
-    prob2 = numpy.exp(numpy.float64(logprob2))
-    if (prob1 > 0) and (prob2 > 0):
-        weight2 = 1.0 - weight1
-        prob = weight1 * prob1
-        prob += weight2 * prob2
-        return logprob_type(numpy.log(prob))
-    else:
-        # An exp() resulted in an underflow (or -inf logprob). Use the decimal
-        # library.
-        getcontext().prec = 16
-        d_weight1 = Decimal(float(weight1))
-        d_weight2 = Decimal(1.0) - d_weight1
-        d_logprob1 = Decimal(float(logprob1))
-        d_logprob2 = Decimal(float(logprob2))
-        d_zero = Decimal(0.0)
-        d_prob = d_zero
-        if d_weight1 != d_zero:
-            d_prob += d_weight1 * d_logprob1.exp()
-        if d_weight2 != d_zero:
-            d_prob += d_weight2 * d_logprob2.exp()
-        return logprob_type(d_prob.ln())
+    weight1 = numpy.float64(weight1)
+    with numpy.errstate(divide='ignore'):
+        log_weight1 = numpy.log(weight1)
+        log_weight2 = numpy.log(1.0 - weight1)
+    result = numpy.logaddexp(log_weight1 + numpy.float64(logprob1),
+                             log_weight2 + numpy.float64(logprob2))
+    if numpy.ndim(result) == 0:
+        return logprob_type(result)
+    return result.astype(logprob_type)
 
 def interpolate_loglinear(logprob1, logprob2, prior1, prior2):
     """Performs log-linear interpolation of two probabilities.
@@ -65,10 +51,10 @@ def interpolate_loglinear(logprob1, logprob2, prior1, prior2):
     Otherwise if the log probability was ``-inf``, multiplication would result
     in a ``nan``.
 
-    :type logprob1: logprob_type
+    :type logprob1: logprob_type or numpy.ndarray
     :param logprob1: first input log probability
 
-    :type logprob2: logprob_type
+    :type logprob2: logprob_type or numpy.ndarray
     :param logprob2: second input log probability
 
     :type prior1: logprob_type
@@ -77,7 +63,7 @@ def interpolate_loglinear(logprob1, logprob2, prior1, prior2):
     :type prior2: logprob_type
     :param prior2: weight for the second log probability
 
-    :rtype: logprob_type
+    :rtype: logprob_type or numpy.ndarray
     :returns: weighted sum of the input log probabilities
     """
 
@@ -86,5 +72,5 @@ def interpolate_loglinear(logprob1, logprob2, prior1, prior2):
         result += prior1 * logprob1
     if prior2 != 0:
         result += prior2 * logprob2
-    assert not numpy.isnan(result)
+    assert not numpy.any(numpy.isnan(result))
     return result
@@ -4,5 +4,7 @@
 import theanolm.commands.train
 import theanolm.commands.score
 import theanolm.commands.decode
+import theanolm.commands.prune
+import theanolm.commands.latticeconvert
 import theanolm.commands.sample
 import theanolm.commands.version
@@ -6,7 +6,13 @@
 import gc
 import sys
 import os
+import io
+import itertools
 import logging
+import multiprocessing
+import queue
+import traceback
+from functools import partial
 
 import numpy
 import theano
@@ -61,6 +67,20 @@ def add_arguments(parser):
         '--job', metavar='I', type=int, default=0,
         help='the index of the batch that this job should process, between 0 '
              'and J-1')
+    argument_group.add_argument(
+        '--workers', metavar='N', type=int, default=1,
+        help='decode lattices in N worker processes that are forked after '
+             'loading the model, so that the model is loaded and compiled only '
+             'once; lattices are distributed to the workers as they become '
+             'free, and the output is written in the input order (default 1, '
+             'only supported on CPU)')
+    argument_group.add_argument(
+        '--prefetch', metavar='N', type=int, default=0,
+        help='read and parse up to N lattices ahead in the background while '
+             'decoding, in a separate process if the lattices are compact '
+             'and otherwise in a thread (default 0, i.e. no prefetching; not '
+             'used with --workers, since the workers parse their own '
+             'lattices)')
 
     argument_group = parser.add_argument_group("decoding")
     argument_group.add_argument(
@@ -113,12 +133,42 @@ def add_arguments(parser):
         '--linear-interpolation', action="store_true",
         help="use linear interpolation of language model probabilities, "
              "instead of (pseudo) log-linear")
+    argument_group.add_argument(
+        '--cache-size', metavar='MB', type=float, default=None,
+        help="cache the recurrent states and NNLM log probabilities of word "
+             "histories within a lattice, so that identical histories are "
+             "computed only once, using at most MB megabytes of memory; the "
+             "histories are truncated to the recombination order (default is "
+             "no caching)")
+
+    argument_group.add_argument(
+        '--batch-nodes', action="store_true",
+        help="propagate the tokens of all the lattice nodes that have the same "
+             "time stamp (or that are at the same topological wavefront, if "
+             "the nodes have no time stamps) with a single call to the neural "
+             "network, instead of processing one node at a time")
+    argument_group.add_argument(
+        '--compact-lattices', action="store_true",
+        help="store the lattices in compact arrays during decoding, which uses "
+             "less memory for large lattices (the lattice scores are stored "
+             "in single precision)")
+    argument_group.add_argument(
+        '--lattice-cache', metavar='DIR', type=str, default=None,
+        help="read the lattices from binary archives in DIR, if they are up to "
+             "date, and write the archives of the other lattice files after "
+             "parsing them (see the lattice-convert command; implies "
+             "--compact-lattices)")
 
     argument_group = parser.add_argument_group("pruning")
     argument_group.add_argument(
         '--max-tokens-per-node', metavar='T', type=int, default=None,
         help="keep only at most T tokens at each node when decoding a lattice "
              "(default is no limit)")
+    argument_group.add_argument(
+        '--max-active-tokens', metavar='T', type=int, default=None,
+        help="keep only approximately T tokens in total in the nodes that have "
+             "been reached, but not processed yet, i.e. the nodes that overlap "
+             "the current time frame (default is no limit)")
     argument_group.add_argument(
         '--beam', metavar='B', type=float, default=None,
         help="prune tokens whose log probability is at least B smaller than "
@@ -142,6 +192,48 @@ def add_arguments(parser):
         '--abs-min-beam', metavar='B', type=float, default=150,
         help="if prune-extra-limit is used, do not tighten the beam further "
              "than this (default is 150)")
+    argument_group.add_argument(
+        '--lookahead', action="store_true",
+        help="in beam pruning, add to the log probability of each token the "
+             "best log probability from the node to the end of the lattice, "
+             "according to the scores in the lattice, so that tokens at "
+             "different stages of the lattice become comparable and a smaller "
+             "beam can be used")
+    argument_group.add_argument(
+        '--pre-prune-beam', metavar='B', type=float, default=None,
+        help="before decoding, remove the lattice links whose best path is at "
+             "least B worse than the best path through the lattice, according "
+             "to the scores in the lattice (default is no pre-pruning)")
+    argument_group.add_argument(
+        '--pre-prune-posterior', metavar='P', type=float, default=None,
+        help="before decoding, remove the lattice links whose posterior "
+             "probability is less than P, according to the scores in the "
+             "lattice (default is no pre-pruning)")
+
+    argument_group = parser.add_argument_group("parameter sweep")
+    argument_group.add_argument(
+        '--sweep-nnlm-weight', metavar='LAMBDA', type=float, nargs='+',
+        default=None,
+        help="decode each lattice once without pruning, and rank the final "
+             "tokens using each of these NNLM weights (default is to use only "
+             "--nnlm-weight)")
+    argument_group.add_argument(
+        '--sweep-lm-scale', metavar='LMSCALE', type=float, nargs='+',
+        default=None,
+        help="decode each lattice once without pruning, and rank the final "
+             "tokens using each of these LM scales (default is to use only "
+             "--lm-scale)")
+    argument_group.add_argument(
+        '--sweep-wi-penalty', metavar='WIP', type=float, nargs='+',
+        default=None,
+        help="decode each lattice once without pruning, and rank the final "
+             "tokens using each of these word insertion penalties (default is "
+             "to use only --wi-penalty)")
+    argument_group.add_argument(
+        '--sweep-dir', metavar='DIR', type=str, default=None,
+        help="directory where to write the output of a parameter sweep; one "
+             "file will be created for each combination of the parameter "
+             "values")
 
     argument_group = parser.add_argument_group("configuration")
     argument_group.add_argument(
@@ -194,6 +286,37 @@ def decode(args):
             print("Kaldi lattice vocabulary is not given.", file=sys.stderr)
             sys.exit(1)
 
+    sweep_settings = _sweep_settings(args)
+    if sweep_settings is not None:
+        if (args.output == 'slf') or (args.output == 'kaldi'):
+            print("Parameter sweep cannot be used with lattice output.",
+                  file=sys.stderr)
+            sys.exit(1)
+        if args.sweep_dir is None:
+            print("Output directory for parameter sweep (--sweep-dir) is not "
+                  "given.", file=sys.stderr)
+            sys.exit(1)
+
+    if (args.pre_prune_posterior is not None) and \
+       (args.lm_scale is not None) and (args.lm_scale <= 0.0):
+        print("Posterior pre-pruning requires a positive LM scale.",
+              file=sys.stderr)
+        sys.exit(1)
+
+    if (args.max_active_tokens is not None) and (args.max_active_tokens < 1):
+        print("Invalid maximum number of active tokens specified ({})."
+              .format(args.max_active_tokens), file=sys.stderr)
+        sys.exit(1)
+
+    if args.workers < 1:
+        print("Invalid number of workers specified ({})."
+              .format(args.workers), file=sys.stderr)
+        sys.exit(1)
+    if (args.workers > 1) and (theano.config.device != 'cpu'):
+        print("Multiple worker processes can be used only on CPU.",
+              file=sys.stderr)
+        sys.exit(1)
+
     default_device = get_default_device(args.default_device)
     network = Network.from_file(args.model_path,
                                 mode=Network.Mode(minibatch=False),
@@ -217,12 +340,33 @@ def decode(args):
         'unk_from_lattice': args.unk_from_lattice,
         'linear_interpolation': args.linear_interpolation,
         'max_tokens_per_node': args.max_tokens_per_node,
+        'max_active_tokens': args.max_active_tokens,
         'beam': args.beam,
         'recombination_order': args.recombination_order,
         'prune_relative': args.prune_relative,
         'abs_min_max_tokens': args.abs_min_max_tokens,
-        'abs_min_beam': args.abs_min_beam
+        'abs_min_beam': args.abs_min_beam,
+        'cache_size': args.cache_size,
+        'batch_nodes': args.batch_nodes,
+        'lookahead': args.lookahead,
+        'pre_prune_beam': args.pre_prune_beam,
+        'pre_prune_posterior': args.pre_prune_posterior
     }
+    if sweep_settings is not None:
+        # Pruning uses the total log probabilities computed with one setting,
+        # so the best tokens with the other settings could be pruned out.
+        for option_name in ('max_tokens_per_node', 'max_active_tokens', 'beam',
+                            'pre_prune_beam', 'pre_prune_posterior'):
+            if decoding_options[option_name] is not None:
+                logging.warning("--%s is ignored in a parameter sweep.",
+                                option_name.replace('_', '-'))
+                decoding_options[option_name] = None
+        decoding_options['sweep_settings'] = [
+            (nnlm_weight,
+             lm_scale,
+             None if sweep_wi_penalty is None
+             else sweep_wi_penalty * log_scale)
+            for nnlm_weight, lm_scale, sweep_wi_penalty in sweep_settings]
     logging.debug("DECODING OPTIONS")
     for option_name, option_value in decoding_options.items():
         logging.debug("%s: %s", option_name, str(option_value))
@@ -231,40 +375,347 @@ def decode(args):
     decoder = LatticeDecoder(network, decoding_options)
 
     batch = LatticeBatch(args.lattices, args.lattice_list, args.lattice_format,
-                         args.kaldi_vocabulary, args.num_jobs, args.job)
-    for lattice_number, lattice in enumerate(batch):
-        if lattice.utterance_id is None:
-            lattice.utterance_id = str(lattice_number)
-        logging.info("Utterance `%s´ -- %d of job %d",
-                     lattice.utterance_id,
-                     lattice_number + 1,
-                     args.job)
-        log_free_mem()
-
-        final_tokens, recomb_tokens = decoder.decode(lattice)
-        if (args.output == "slf") or (args.output == "kaldi"):
-            rescored_lattice = RescoredLattice(lattice,
-                                               final_tokens,
-                                               recomb_tokens,
-                                               network.vocabulary)
-            rescored_lattice.lm_scale = args.lm_scale
-            rescored_lattice.wi_penalty = args.wi_penalty
-            if args.output == "slf":
-                rescored_lattice.write_slf(args.output_file)
+                         args.kaldi_vocabulary, args.num_jobs, args.job,
+                         args.compact_lattices, args.lattice_cache,
+                         args.prefetch)
+    if sweep_settings is None:
+        output_files = [args.output_file]
+    else:
+        os.makedirs(args.sweep_dir, exist_ok=True)
+        output_files = []
+        for nnlm_weight, lm_scale, wi_penalty in sweep_settings:
+            file_name = 'nnlm{}-lmscale{}-wip{}.{}'.format(
+                _format_setting(nnlm_weight),
+                _format_setting(lm_scale),
+                _format_setting(wi_penalty),
+                args.output)
+            path = os.path.join(args.sweep_dir, file_name)
+            output_files.append(open(path, 'w', encoding='utf-8'))
+        logging.info("Parameter sweep over %d settings.", len(sweep_settings))
+
+    decode_lattice = partial(_decode_lattice,
+                             decoder=decoder,
+                             batch=batch,
+                             vocabulary=network.vocabulary,
+                             log_scale=log_scale,
+                             args=args,
+                             sweep_settings=sweep_settings)
+    if args.workers > 1:
+        _decode_parallel(decode_lattice, batch, args.workers, output_files)
+    else:
+        for lattice_number, lattice in enumerate(batch):
+            decode_lattice(lattice, lattice_number, output_files)
+            gc.collect()
+
+    if sweep_settings is not None:
+        for output_file in output_files:
+            output_file.close()
+
+def _sweep_settings(args):
+    """Creates the combinations of parameter values for a parameter sweep.
+
+    The parameters that are not swept will take the value of the corresponding
+    decoding option. ``None`` in place of the LM scale or the word insertion
+    penalty means that the value will be read from the lattice file.
+
+    :type args: argparse.Namespace
+    :param args: a collection of command line arguments
+
+    :rtype: list of tuples
+    :returns: the NNLM weight, the LM scale, and the word insertion penalty of
+              each setting (word insertion penalty is not converted to natural
+              logarithm), or ``None`` if no parameter sweep was requested
+    """
+
+    if (args.sweep_nnlm_weight is None) and \
+       (args.sweep_lm_scale is None) and \
+       (args.sweep_wi_penalty is None):
+        return None
+
+    nnlm_weights = args.sweep_nnlm_weight
+    if nnlm_weights is None:
+        nnlm_weights = [args.nnlm_weight]
+    lm_scales = args.sweep_lm_scale
+    if lm_scales is None:
+        lm_scales = [args.lm_scale]
+    wi_penalties = args.sweep_wi_penalty
+    if wi_penalties is None:
+        wi_penalties = [args.wi_penalty]
+    return [(nnlm_weight, lm_scale, wi_penalty)
+            for nnlm_weight in nnlm_weights
+            for lm_scale in lm_scales
+            for wi_penalty in wi_penalties]
+
+def _format_setting(value):
+    """Formats a parameter value for an output file name.
+
+    :type value: float
+    :param value: a parameter value, or ``None`` if the value is read from the
+                  lattice file
+
+    :rtype: str
+    :returns: a short string representation of the value
+    """
+
+    return 'lattice' if value is None else '{:g}'.format(value)
+
+def _decode_lattice(lattice, lattice_number, output_files, decoder, batch,
+                    vocabulary, log_scale, args, sweep_settings=None):
+    """Decodes one lattice and writes the result.
+
+    :type lattice: Lattice
+    :param lattice: the lattice to be decoded
+
+    :type lattice_number: int
+    :param lattice_number: index of the lattice within the job, used as the
+                           utterance ID if the lattice doesn't specify one
+
+    :type output_files: list of file objects
+    :param output_files: where to write the best paths or the rescored lattice;
+                         contains one file for each parameter sweep setting, or
+                         only one file if no parameter sweep is performed
+
+    :type decoder: LatticeDecoder
+    :param decoder: the decoder that will be used
+
+    :type batch: LatticeBatch
+    :param batch: the lattice batch, which provides the Kaldi word IDs
+
+    :type vocabulary: Vocabulary
+    :param vocabulary: mapping from word IDs to words
+
+    :type log_scale: float
+    :param log_scale: divide log probabilities by this number to convert the log
+                      base
+
+    :type args: argparse.Namespace
+    :param args: a collection of command line arguments
+
+    :type sweep_settings: list of tuples
+    :param sweep_settings: if not ``None``, writes the best paths using each
+        of these combinations of NNLM weight, LM scale, and word insertion
+        penalty
+    """
+
+    if lattice.utterance_id is None:
+        lattice.utterance_id = str(lattice_number)
+    logging.info("Utterance `%s´ -- %d of job %d",
+                 lattice.utterance_id,
+                 lattice_number + 1,
+                 args.job)
+    log_free_mem()
+
+    final_tokens, recomb_tokens = decoder.decode(lattice)
+    if sweep_settings is not None:
+        settings = []
+        for nnlm_weight, lm_scale, wi_penalty in sweep_settings:
+            if lm_scale is None:
+                lm_scale = 1.0 if lattice.lm_scale is None else lattice.lm_scale
+            if wi_penalty is not None:
+                wi_penalty *= log_scale
+            elif lattice.wi_penalty is not None:
+                wi_penalty = lattice.wi_penalty
             else:
-                assert args.output == "kaldi"
-                rescored_lattice.write_kaldi(args.output_file,
-                                             batch.kaldi_word_to_id)
-        else:
-            for token in final_tokens[:min(args.n_best, len(final_tokens))]:
+                wi_penalty = 0.0
+            settings.append((nnlm_weight, lm_scale, wi_penalty))
+        sweep_tokens = decoder.rescore_tokens(final_tokens, settings,
+                                              args.n_best)
+        for output_file, tokens in zip(output_files, sweep_tokens):
+            for token in tokens:
                 line = format_token(token,
                                     lattice.utterance_id,
-                                    network.vocabulary,
+                                    vocabulary,
                                     log_scale,
                                     args.output)
-                args.output_file.write(line + "\n")
+                output_file.write(line + "\n")
+        return
+
+    output_file = output_files[0]
+    if (args.output == "slf") or (args.output == "kaldi"):
+        rescored_lattice = RescoredLattice(lattice,
+                                           final_tokens,
+                                           recomb_tokens,
+                                           vocabulary)
+        rescored_lattice.lm_scale = args.lm_scale
+        rescored_lattice.wi_penalty = args.wi_penalty
+        if args.output == "slf":
+            rescored_lattice.write_slf(output_file)
+        else:
+            assert args.output == "kaldi"
+            rescored_lattice.write_kaldi(output_file,
+                                         batch.kaldi_word_to_id)
+    else:
+        for token in final_tokens[:min(args.n_best, len(final_tokens))]:
+            line = format_token(token,
+                                lattice.utterance_id,
+                                vocabulary,
+                                log_scale,
+                                args.output)
+            output_file.write(line + "\n")
+
+def _decode_parallel(decode_lattice, batch, num_workers, output_files):
+    """Decodes lattices in parallel worker processes.
+
+    The worker processes are forked from this process, so the network and the
+    compiled Theano functions are shared with the workers. This process reads
+    the lattice files and puts the unparsed lattices into a queue. Each worker
+    takes the next lattice from the queue when it has finished the previous
+    one. The results are written in the same order as the lattices were read.
+
+    :type decode_lattice: callable
+    :param decode_lattice: a function that takes a lattice, its index, and a
+                           list of output files, and decodes the lattice
+
+    :type batch: LatticeBatch
+    :param batch: the lattices to be decoded
+
+    :type num_workers: int
+    :param num_workers: number of worker processes
+
+    :type output_files: list of file objects
+    :param output_files: where to write the results
+    """
+
+    # Buffered output would be written again by the forked processes.
+    for output_file in output_files:
+        output_file.flush()
+    sys.stdout.flush()
+    sys.stderr.flush()
+
+    context = multiprocessing.get_context('fork')
+    task_queue = context.Queue(num_workers * 2)
+    result_queue = context.Queue()
+    workers = [context.Process(target=_decode_worker,
+                               args=(decode_lattice, batch, len(output_files),
+                                     task_queue, result_queue))
+               for _ in range(num_workers)]
+    for worker in workers:
+        worker.start()
+
+    results = dict()
+    next_number = 0
+    try:
+        num_lattices = 0
+        # After the lattices, one None is sent to each worker to stop it.
+        tasks = itertools.chain(enumerate(batch.sources()),
+                                [None] * num_workers)
+        for task in tasks:
+            while True:
+                try:
+                    task_queue.put(task, timeout=1)
+                    break
+                except queue.Full:
+                    _receive_results(result_queue, results, workers, False)
+                    next_number = _write_results(results, next_number,
+                                                 output_files)
+            if task is not None:
+                num_lattices += 1
+        while next_number < num_lattices:
+            _receive_results(result_queue, results, workers, True)
+            next_number = _write_results(results, next_number, output_files)
+    except BaseException:
+        for worker in workers:
+            worker.terminate()
+        raise
+    for worker in workers:
+        worker.join()
+
+def _decode_worker(decode_lattice, batch, num_outputs, task_queue,
+                   result_queue):
+    """Decodes lattices from a queue until ``None`` is received.
+
+    Each result is a tuple of the lattice index, the output text for each output
+    file, and the error message if decoding failed.
+
+    :type decode_lattice: callable
+    :param decode_lattice: a function that takes a lattice, its index, and a
+                           list of output files, and decodes the lattice
+
+    :type batch: LatticeBatch
+    :param batch: used to parse the lattices
+
+    :type num_outputs: int
+    :param num_outputs: number of output files
+
+    :type task_queue: multiprocessing.Queue
+    :param task_queue: a queue of lattice indices and unparsed lattices
+
+    :type result_queue: multiprocessing.Queue
+    :param result_queue: a queue where the results will be written
+    """
+
+    while True:
+        task = task_queue.get()
+        if task is None:
+            break
+        lattice_number, source = task
+        try:
+            outputs = [io.StringIO() for _ in range(num_outputs)]
+            decode_lattice(batch.read_lattice(source), lattice_number, outputs)
+            result_queue.put((lattice_number,
+                              [output.getvalue() for output in outputs],
+                              None))
+        except Exception:
+            result_queue.put((lattice_number, None, traceback.format_exc()))
         gc.collect()
 
+def _receive_results(result_queue, results, workers, block):
+    """Moves results from the result queue to a dictionary.
+
+    :type result_queue: multiprocessing.Queue
+    :param result_queue: a queue of results from the workers
+
+    :type results: dict
+    :param results: a mapping from lattice indices to lists of output texts
+
+    :type workers: list of multiprocessing.Processes
+    :param workers: the worker processes, checked for failures while waiting
+
+    :type block: bool
+    :param block: if ``True``, waits until at least one result is received
+    """
+
+    while True:
+        try:
+            lattice_number, output, error = result_queue.get(block, timeout=1)
+        except queue.Empty:
+            # If the workers have died, the task queue will never be emptied,
+            # so this has to be checked also when not blocking.
+            if any(worker.exitcode for worker in workers):
+                raise RuntimeError("A decoding worker process terminated "
+                                   "unexpectedly.")
+            if not block:
+                return
+            continue
+        if error is not None:
+            raise RuntimeError("Decoding lattice {} failed:\n{}"
+                               .format(lattice_number + 1, error))
+        results[lattice_number] = output
+        block = False
+
+def _write_results(results, next_number, output_files):
+    """Writes the results that are ready, in the order of the lattices.
+
+    :type results: dict
+    :param results: a mapping from lattice indices to lists of output texts;
+                    written results will be removed
+
+    :type next_number: int
+    :param next_number: index of the next lattice whose result will be written
+
+    :type output_files: list of file objects
+    :param output_files: where to write the results
+
+    :rtype: int
+    :returns: index of the next lattice whose result has not been written
+    """
+
+    while next_number in results:
+        for output_file, output in zip(output_files, results.pop(next_number)):
+            output_file.write(output)
+        next_number += 1
+    return next_number
+
 def format_token(token, utterance_id, vocabulary, log_scale, output_format):
     """Formats an output line from a token and an utterance ID.
 
@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""A module that implements the "theanolm lattice-convert" command.
+"""
+
+import sys
+import logging
+
+from theanolm.backend import TextFileType
+from theanolm.scoring import LatticeBatch
+
+def add_arguments(parser):
+    """Specifies the command line arguments supported by the "theanolm
+    lattice-convert" command.
+
+    :type parser: argparse.ArgumentParser
+    :param parser: a command line argument parser
+    """
+
+    argument_group = parser.add_argument_group("files")
+    argument_group.add_argument(
+        'cache_dir', metavar='CACHE-DIR', type=str,
+        help='directory where the binary lattice archives will be written')
+    argument_group.add_argument(
+        '--lattices', metavar='FILE', type=str, nargs='*', default=[],
+        help='word lattices to be converted (assumed to be compressed if the '
+             'name ends in ".gz")')
+    argument_group.add_argument(
+        '--lattice-list', metavar='FILE', type=TextFileType('r'),
+        help='text file containing a list of word lattices to be converted '
+             '(one path per line, the list and the lattice files are assumed '
+             'to be compressed if the name ends in ".gz")')
+    argument_group.add_argument(
+        '--lattice-format', metavar='FORMAT', type=str, default='slf',
+        choices=['slf', 'kaldi'],
+        help='format of the lattice files, either "slf" (HTK format, default) '
+             'or "kaldi" (a Kaldi lattice archive containing text '
+             'CompactLattices')
+    argument_group.add_argument(
+        '--kaldi-vocabulary', metavar='FILE', type=TextFileType('r'),
+        default=None,
+        help='mapping of words to word IDs in Kaldi lattices (usually '
+             'named words.txt)')
+    argument_group.add_argument(
+        '--num-jobs', metavar='J', type=int, default=1,
+        help='divide the set of lattice files into J distinct batches, and '
+             'process only batch I')
+    argument_group.add_argument(
+        '--job', metavar='I', type=int, default=0,
+        help='the index of the batch that this job should process, between 0 '
+             'and J-1')
+
+    argument_group = parser.add_argument_group("logging and debugging")
+    argument_group.add_argument(
+        '--log-file', metavar='FILE', type=str, default='-',
+        help='path where to write log file (default is standard error)')
+    argument_group.add_argument(
+        '--log-level', metavar='LEVEL', type=str, default='info',
+        help='minimum level of events to log, one of "debug", "info", "warn" '
+             '(default "info")')
+
+def lattice_convert(args):
+    """A function that performs the "theanolm lattice-convert" command.
+
+    Parses the lattice files and writes a binary archive of each file into the
+    cache directory, unless the directory already contains an up-to-date
+    archive. The "decode" and "prune" commands read the archives when the same
+    directory is given with ``--lattice-cache``.
+
+    :type args: argparse.Namespace
+    :param args: a collection of command line arguments
+    """
+
+    log_file = args.log_file
+    log_level = getattr(logging, args.log_level.upper(), None)
+    if not isinstance(log_level, int):
+        print("Invalid logging level requested:", args.log_level,
+              file=sys.stderr)
+        sys.exit(1)
+    log_format = '%(asctime)s %(funcName)s: %(message)s'
+    if args.log_file == '-':
+        logging.basicConfig(stream=sys.stderr, format=log_format, level=log_level)
+    else:
+        logging.basicConfig(filename=log_file, format=log_format, level=log_level)
+
+    if (args.lattice_format == 'kaldi') and (args.kaldi_vocabulary is None):
+        print("Kaldi lattice vocabulary is not given.", file=sys.stderr)
+        sys.exit(1)
+    if (not args.lattices) and (args.lattice_list is None):
+        print("No lattice files given. Lattices cannot be cached from the "
+              "standard input.", file=sys.stderr)
+        sys.exit(1)
+
+    batch = LatticeBatch(args.lattices, args.lattice_list, args.lattice_format,
+                         args.kaldi_vocabulary, args.num_jobs, args.job,
+                         cache_dir=args.cache_dir)
+    num_lattices = 0
+    for _ in batch.sources():
+        num_lattices += 1
+    logging.info("%d lattices are in the cache.", num_lattices)
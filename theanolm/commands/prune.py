@@ -0,0 +1,172 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""A module that implements the "theanolm prune" command.
+"""
+
+import sys
+import logging
+
+import numpy
+
+from theanolm.backend import TextFileType
+from theanolm.scoring import LatticeBatch
+
+def add_arguments(parser):
+    """Specifies the command line arguments supported by the "theanolm prune"
+    command.
+
+    :type parser: argparse.ArgumentParser
+    :param parser: a command line argument parser
+    """
+
+    argument_group = parser.add_argument_group("files")
+    argument_group.add_argument(
+        '--lattices', metavar='FILE', type=str, nargs='*', default=[],
+        help='word lattices to be pruned (default stdin, assumed to be '
+             'compressed if the name ends in ".gz")')
+    argument_group.add_argument(
+        '--lattice-list', metavar='FILE', type=TextFileType('r'),
+        help='text file containing a list of word lattices to be pruned (one '
+             'path per line, the list and the lattice files are assumed to be '
+             'compressed if the name ends in ".gz")')
+    argument_group.add_argument(
+        '--lattice-format', metavar='FORMAT', type=str, default='slf',
+        choices=['slf', 'kaldi'],
+        help='format of the lattice files, either "slf" (HTK format, default) '
+             'or "kaldi" (a Kaldi lattice archive containing text '
+             'CompactLattices')
+    argument_group.add_argument(
+        '--kaldi-vocabulary', metavar='FILE', type=TextFileType('r'),
+        default=None,
+        help='mapping of words to word IDs in Kaldi lattices (usually '
+             'named words.txt)')
+    argument_group.add_argument(
+        '--output-file', metavar='FILE', type=TextFileType('w'), default='-',
+        help='where to write the pruned lattices (default stdout, will be '
+             'compressed if the name ends in ".gz")')
+    argument_group.add_argument(
+        '--num-jobs', metavar='J', type=int, default=1,
+        help='divide the set of lattice files into J distinct batches, and '
+             'process only batch I')
+    argument_group.add_argument(
+        '--job', metavar='I', type=int, default=0,
+        help='the index of the batch that this job should process, between 0 '
+             'and J-1')
+    argument_group.add_argument(
+        '--compact-lattices', action="store_true",
+        help="store the lattices in compact arrays during pruning, which uses "
+             "less memory for large lattices (the lattice scores are stored "
+             "in single precision)")
+    argument_group.add_argument(
+        '--lattice-cache', metavar='DIR', type=str, default=None,
+        help="read the lattices from binary archives in DIR, if they are up to "
+             "date, and write the archives of the other lattice files after "
+             "parsing them (see the lattice-convert command; implies "
+             "--compact-lattices)")
+
+    argument_group = parser.add_argument_group("pruning")
+    argument_group.add_argument(
+        '--output', metavar='FORMAT', type=str, default=None,
+        choices=['slf', 'kaldi'],
+        help='format of the output, either "slf" (HTK format) or "kaldi" '
+             '(Kaldi format) (default is the same as the input format)')
+    argument_group.add_argument(
+        '--beam', metavar='B', type=float, default=None,
+        help="remove the links whose best path is at least B worse than the "
+             "best path through the lattice (default is no beam pruning)")
+    argument_group.add_argument(
+        '--min-posterior', metavar='P', type=float, default=None,
+        help="remove the links whose posterior probability is less than P "
+             "(default is no posterior pruning)")
+    argument_group.add_argument(
+        '--lm-scale', metavar='LMSCALE', type=float, default=None,
+        help="scale language model log probabilities by LMSCALE when computing "
+             "the total probability of a path (default is to use the LM scale "
+             "specified in the lattice file, or 1.0 if not specified)")
+    argument_group.add_argument(
+        '--wi-penalty', metavar='WIP', type=float, default=None,
+        help="penalize word insertion by adding WIP to the total log "
+             "probability as many times as there are words in the path "
+             "(without scaling WIP by LMSCALE)")
+    argument_group.add_argument(
+        '--log-base', metavar='B', type=int, default=None,
+        help="convert WIP from base B (default is natural logarithm; this does "
+             "not affect reading lattices, since they specify their internal "
+             "log base)")
+
+    argument_group = parser.add_argument_group("logging and debugging")
+    argument_group.add_argument(
+        '--log-file', metavar='FILE', type=str, default='-',
+        help='path where to write log file (default is standard error)')
+    argument_group.add_argument(
+        '--log-level', metavar='LEVEL', type=str, default='info',
+        help='minimum level of events to log, one of "debug", "info", "warn" '
+             '(default "info")')
+
+def prune(args):
+    """A function that performs the "theanolm prune" command.
+
+    :type args: argparse.Namespace
+    :param args: a collection of command line arguments
+    """
+
+    log_file = args.log_file
+    log_level = getattr(logging, args.log_level.upper(), None)
+    if not isinstance(log_level, int):
+        print("Invalid logging level requested:", args.log_level,
+              file=sys.stderr)
+        sys.exit(1)
+    log_format = '%(asctime)s %(funcName)s: %(message)s'
+    if args.log_file == '-':
+        logging.basicConfig(stream=sys.stderr, format=log_format, level=log_level)
+    else:
+        logging.basicConfig(filename=log_file, format=log_format, level=log_level)
+
+    output_format = args.output
+    if output_format is None:
+        output_format = args.lattice_format
+    if (args.lattice_format == 'kaldi') or (output_format == 'kaldi'):
+        if args.kaldi_vocabulary is None:
+            print("Kaldi lattice vocabulary is not given.", file=sys.stderr)
+            sys.exit(1)
+    if (args.beam is None) and (args.min_posterior is None):
+        print("No pruning criterion (--beam or --min-posterior) is given.",
+              file=sys.stderr)
+        sys.exit(1)
+    if (args.min_posterior is not None) and (args.lm_scale is not None) and \
+       (args.lm_scale <= 0.0):
+        print("Posterior pruning requires a positive LM scale.",
+              file=sys.stderr)
+        sys.exit(1)
+
+    log_scale = 1.0 if args.log_base is None else numpy.log(args.log_base)
+    batch = LatticeBatch(args.lattices, args.lattice_list, args.lattice_format,
+                         args.kaldi_vocabulary, args.num_jobs, args.job,
+                         args.compact_lattices, args.lattice_cache)
+    for lattice_number, lattice in enumerate(batch):
+        if lattice.utterance_id is None:
+            lattice.utterance_id = str(lattice_number)
+        logging.info("Pruning lattice %s.", lattice.utterance_id)
+
+        if args.lm_scale is not None:
+            lm_scale = args.lm_scale
+        elif lattice.lm_scale is not None:
+            lm_scale = lattice.lm_scale
+        else:
+            lm_scale = 1.0
+        if args.wi_penalty is not None:
+            wi_penalty = args.wi_penalty * log_scale
+        elif lattice.wi_penalty is not None:
+            wi_penalty = lattice.wi_penalty
+        else:
+            wi_penalty = 0.0
+
+        num_links = len(lattice.links)
+        num_removed = lattice.prune(args.beam, args.min_posterior, lm_scale,
+                                    wi_penalty)
+        logging.info("Removed %d of %d links.", num_removed, num_links)
+
+        if output_format == 'slf':
+            lattice.write_slf(args.output_file)
+        else:
+            lattice.write_kaldi(args.output_file, batch.kaldi_word_to_id)
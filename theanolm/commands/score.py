@@ -3,6 +3,7 @@
 """A module that implements the "theanolm score" command.
 """
 
+import os
 import sys
 import logging
 
@@ -10,9 +11,10 @@ import numpy
 import theano
 
 from theanolm import Network
-from theanolm.backend import TextFileType, get_default_device
-from theanolm.parsing import ScoringBatchIterator
-from theanolm.scoring import TextScorer
+from theanolm.backend import TextFileType, InputError, get_default_device
+from theanolm.parsing import ScoringBatchIterator, utterance_from_line, \
+                             bucket_sequences
+from theanolm.scoring import TextScorer, NBestScorer, ScoreCache
 
 def add_arguments(parser):
     """Specifies the command line arguments supported by the "theanolm score"
@@ -29,7 +31,8 @@ def add_arguments(parser):
     argument_group.add_argument(
         'input_file', metavar='TEXT-FILE', type=TextFileType('r'),
         help='text file containing text to be scored (UTF-8, one sentence per '
-             'line, assumed to be compressed if the name ends in ".gz")')
+             'line, or an n-best list with "nbest-scores" output, assumed to be '
+             'compressed if the name ends in ".gz")')
     argument_group.add_argument(
         '--output-file', metavar='FILE', type=TextFileType('w'), default='-',
         help='where to write the statistics (default stdout, will be '
@@ -38,9 +41,10 @@ def add_arguments(parser):
     argument_group = parser.add_argument_group("scoring")
     argument_group.add_argument(
         '--output', metavar='DETAIL', type=str, default='perplexity',
-        choices=['perplexity', 'utterance-scores', 'word-scores'],
+        choices=['perplexity', 'utterance-scores', 'word-scores',
+                 'nbest-scores'],
         help='what to output, one of "perplexity", "utterance-scores", '
-             '"word-scores" (default "perplexity")')
+             '"word-scores", "nbest-scores" (default "perplexity")')
     argument_group.add_argument(
         '--log-base', metavar='B', type=int, default=None,
         help='convert output log probabilities to base B (default is the '
@@ -60,6 +64,28 @@ def add_arguments(parser):
         help='distribute <unk> token probability among the out-of-shortlist '
              'words according to their unigram frequencies in the training '
              'data')
+    argument_group.add_argument(
+        '--batch-size', metavar='N', type=int, default=16,
+        help='score N sentences in parallel (default 16)')
+    argument_group.add_argument(
+        '--bucket-window', metavar='N', type=int, default=None,
+        help='read N sentences at a time and sort them by length, so that '
+             'each mini-batch contains sentences of similar length (the output '
+             'is still written in the input order)')
+    argument_group.add_argument(
+        '--max-batch-tokens', metavar='N', type=int, default=None,
+        help='with --bucket-window, limit the size of a mini-batch to N time '
+             'steps times sentences')
+    argument_group.add_argument(
+        '--score-cache-size', metavar='N', type=int, default=None,
+        help='with "utterance-scores" output, cache the scores of at most N '
+             'sentences, so that repeated sentences are scored only once '
+             '(default is no caching, or no limit with --score-cache)')
+    argument_group.add_argument(
+        '--score-cache', metavar='FILE', type=str, default=None,
+        help='with "utterance-scores" output, read cached sentence scores from '
+             'FILE, if it exists and was written using the same model and '
+             'scoring options, and write the cache to FILE at the end')
 
     argument_group = parser.add_argument_group("configuration")
     argument_group.add_argument(
@@ -110,28 +136,69 @@ def score(args):
     theano.config.profile_memory = args.profile
 
     default_device = get_default_device(args.default_device)
-    network = Network.from_file(args.model_path, exclude_unk=args.exclude_unk,
+    if args.output == 'nbest-scores':
+        # N-best lists are scored one time step at a time.
+        mode = Network.Mode(minibatch=False)
+    else:
+        mode = None
+    network = Network.from_file(args.model_path, mode=mode,
+                                exclude_unk=args.exclude_unk,
                                 default_device=default_device)
 
+    if (args.score_cache is None) and (args.score_cache_size is None):
+        cache = None
+    elif args.output != 'utterance-scores':
+        print("Score cache can only be used with utterance-scores output.",
+              file=sys.stderr)
+        sys.exit(1)
+    else:
+        # The scores depend on the model and the scoring options.
+        fingerprint = "{} {} shortlist={} exclude_unk={}".format(
+            os.path.abspath(args.model_path),
+            os.path.getmtime(args.model_path),
+            args.shortlist,
+            args.exclude_unk)
+        cache = ScoreCache(args.score_cache_size, fingerprint)
+        if args.score_cache is not None:
+            cache.load(args.score_cache)
+
     logging.info("Building text scorer.")
-    scorer = TextScorer(network, args.shortlist, args.exclude_unk, args.profile)
+    if args.output == 'nbest-scores':
+        scorer = NBestScorer(network, args.shortlist, args.exclude_unk,
+                             args.profile)
+    else:
+        scorer = TextScorer(network, args.shortlist, args.exclude_unk,
+                            args.profile, cache)
 
     logging.info("Scoring text.")
     if args.output == 'perplexity':
         _score_text(args.input_file, network.vocabulary, scorer,
-                    args.output_file, args.log_base, args.subwords, False)
+                    args.output_file, args.log_base, args.subwords, False,
+                    args.batch_size, args.bucket_window, args.max_batch_tokens)
     elif args.output == 'word-scores':
         _score_text(args.input_file, network.vocabulary, scorer,
-                    args.output_file, args.log_base, args.subwords, True)
+                    args.output_file, args.log_base, args.subwords, True,
+                    args.batch_size, args.bucket_window, args.max_batch_tokens)
     elif args.output == 'utterance-scores':
         _score_utterances(args.input_file, network.vocabulary, scorer,
-                          args.output_file, args.log_base)
+                          args.output_file, args.log_base, args.batch_size,
+                          args.bucket_window, args.max_batch_tokens)
+    elif args.output == 'nbest-scores':
+        _score_nbest(args.input_file, scorer, args.output_file, args.log_base)
     else:
         print("Invalid output format requested:", args.output)
         sys.exit(1)
 
+    if cache is not None:
+        logging.info("Score cache: %d hits, %d misses (%.1f %% hit rate), "
+                     "%d evictions.", cache.hits, cache.misses,
+                     cache.hit_rate() * 100, cache.evictions)
+        if args.score_cache is not None:
+            cache.save(args.score_cache)
+
 def _score_text(input_file, vocabulary, scorer, output_file,
-                log_base=None, subword_marking=None, word_level=False):
+                log_base=None, subword_marking=None, word_level=False,
+                batch_size=16, bucket_window=None, max_batch_tokens=None):
     """Reads text from ``input_file``, computes perplexity using
     ``scorer``, and writes to ``output_file``.
 
@@ -161,14 +228,27 @@ def _score_text(input_file, vocabulary, scorer, output_file,
 
     :type word_level: bool
     :param word_level: if set to True, also writes word-level statistics
+
+    :type batch_size: int
+    :param batch_size: number of sentences to score in one mini-batch
+
+    :type bucket_window: int
+    :param bucket_window: if not ``None``, sort this many sentences at a time
+                          by length before creating mini-batches
+
+    :type max_batch_tokens: int
+    :param max_batch_tokens: if not ``None``, limit the number of time steps
+                             times sentences in a bucketed mini-batch
     """
 
     scoring_iter = \
         ScoringBatchIterator(input_file,
                              vocabulary,
-                             batch_size=16,
+                             batch_size=batch_size,
                              max_sequence_length=None,
-                             map_oos_to_unk=False)
+                             map_oos_to_unk=False,
+                             bucket_window=bucket_window,
+                             max_batch_tokens=max_batch_tokens)
     log_scale = 1.0 if log_base is None else numpy.log(log_base)
 
     total_logprob = 0.0
@@ -178,36 +258,58 @@ def _score_text(input_file, vocabulary, scorer, output_file,
     num_probs = 0
     num_unks = 0
     num_zeroprobs = 0
+    # The mini-batches may be in a different order than the input, when they are
+    # bucketed by length. Sentence-level output is written in the input order.
+    pending = dict()
     for word_ids, words, mask in scoring_iter:
         class_ids, membership_probs = vocabulary.get_class_memberships(word_ids)
-        logprobs = scorer.score_batch(word_ids, class_ids, membership_probs,
-                                      mask)
-        for seq_index, seq_logprobs in enumerate(logprobs):
-            seq_word_ids = word_ids[:, seq_index]
-            seq_mask = mask[:, seq_index]
-            seq_word_ids = seq_word_ids[seq_mask == 1]
-            seq_words = words[seq_index]
-            merged_words, merged_logprobs = _merge_subwords(seq_words,
-                                                            seq_logprobs,
-                                                            subword_marking)
-
-            # total logprob of this sequence
-            seq_logprob = sum(lp for lp in merged_logprobs
-                              if (lp is not None) and (not numpy.isneginf(lp)))
+        logprobs = scorer.score_batch_masked(word_ids, class_ids,
+                                             membership_probs, mask)
+        seq_lengths = mask.sum(axis=0)
+        if subword_marking is None:
+            seq_stats = _sequence_statistics(logprobs, mask)
+            if not word_level:
+                # Only the totals are needed, so the words are not processed.
+                # The sentence log probabilities are added one at a time to
+                # keep the summation order of the word-level output.
+                for seq_logprob in seq_stats[0].tolist():
+                    total_logprob += seq_logprob
+                num_tokens += int(seq_lengths.sum())
+                num_words += int(seq_lengths.sum())
+                num_probs += int(seq_stats[1].sum())
+                num_unks += int(seq_stats[2].sum())
+                num_zeroprobs += int(seq_stats[3].sum())
+                num_sentences += mask.shape[1]
+                continue
+
+        output_mask = mask[1:] == 1
+        for seq_index, input_index in enumerate(scoring_iter.sequence_indices):
+            # Masked elements are converted to None.
+            seq_logprobs = logprobs[output_mask[:, seq_index], seq_index]
+            merged_words, merged_logprobs = _merge_subwords(
+                words[seq_index], seq_logprobs.tolist(), subword_marking)
+            if subword_marking is None:
+                stats = tuple(x[seq_index].item() for x in seq_stats)
+            else:
+                stats = _merged_statistics(merged_logprobs)
+            pending[input_index] = (int(seq_lengths[seq_index]), merged_words,
+                                    merged_logprobs, stats)
+
+        while num_sentences in pending:
+            seq_length, merged_words, merged_logprobs, stats = \
+                pending.pop(num_sentences)
+            seq_logprob, num_seq_probs, num_seq_unks, num_seq_zeroprobs = stats
             # total logprob of all sequences
             total_logprob += seq_logprob
             # number of tokens, which may be subwords, including <unk>'s
-            num_tokens += len(seq_word_ids)
+            num_tokens += seq_length
             # number of words, including <s>'s and <unk>'s
             num_words += len(merged_words)
             # number of word probabilities computed (may not include <unk>'s)
-            num_seq_probs = sum((lp is not None) and (not numpy.isneginf(lp))
-                                for lp in merged_logprobs)
             num_probs += num_seq_probs
             # number of unks and zeroprobs (just for reporting)
-            num_unks += sum(lp is None for lp in merged_logprobs)
-            num_zeroprobs += sum((lp is not None) and numpy.isneginf(lp)
-                                 for lp in merged_logprobs)
+            num_unks += num_seq_unks
+            num_zeroprobs += num_seq_zeroprobs
             # number of sequences
             num_sentences += 1
 
@@ -237,6 +339,55 @@ def _score_text(input_file, vocabulary, scorer, output_file,
                 cross_entropy, log_base))
         output_file.write("Perplexity: {0}\n".format(perplexity))
 
+def _sequence_statistics(logprobs, mask):
+    """Computes the statistics of each sequence in a mini-batch with array
+    operations.
+
+    :type logprobs: numpy.ma.MaskedArray
+    :param logprobs: log probabilities of the output words, as returned by
+                     ``TextScorer.score_batch_masked()``
+
+    :type mask: numpy.ndarray
+    :param mask: mask of the input mini-batch
+
+    :rtype: tuple of four numpy.ndarrays
+    :returns: total log probability, number of predicted probabilities, number
+              of excluded words, and number of zero probabilities in each
+              sequence
+    """
+
+    output_mask = mask[1:] == 1
+    excluded = numpy.ma.getmaskarray(logprobs) & output_mask
+    values = logprobs.filled(0.0)
+    zeroprobs = numpy.isneginf(values)
+    predicted = output_mask & (~excluded) & (~zeroprobs)
+    return (numpy.where(predicted, values, 0.0).sum(axis=0),
+            predicted.sum(axis=0),
+            excluded.sum(axis=0),
+            zeroprobs.sum(axis=0))
+
+def _merged_statistics(logprobs):
+    """Computes the statistics of a sequence from a list of word log
+    probabilities.
+
+    :type logprobs: list of floats
+    :param logprobs: log probability of each word starting from the second one,
+                     containing ``None`` in place of any ignored <unk>'s
+
+    :rtype: tuple of a float and three ints
+    :returns: total log probability, number of predicted probabilities, number
+              of excluded words, and number of zero probabilities
+    """
+
+    logprob = sum(lp for lp in logprobs
+                  if (lp is not None) and (not numpy.isneginf(lp)))
+    num_probs = sum((lp is not None) and (not numpy.isneginf(lp))
+                    for lp in logprobs)
+    num_unks = sum(lp is None for lp in logprobs)
+    num_zeroprobs = sum((lp is not None) and numpy.isneginf(lp)
+                        for lp in logprobs)
+    return logprob, num_probs, num_unks, num_zeroprobs
+
 def _merge_subwords(subwords, subword_logprobs, marking):
     """Creates a word list from a subword list.
 
@@ -381,14 +532,18 @@ def _write_word_scores(vocabulary, words, logprobs, output_file, log_scale):
                 predicted, history, logprob, info))
 
 def _score_utterances(input_file, vocabulary, scorer, output_file,
-                      log_base=None):
+                      log_base=None, batch_size=16, bucket_window=None,
+                      max_batch_tokens=None):
     """Reads utterances from ``input_file``, computes LM scores using
     ``scorer``, and writes one score per line to ``output_file``.
 
     Start-of-sentence and end-of-sentece tags (``<s>`` and ``</s>``) will be
     inserted at the beginning and the end of each utterance, if they're missing.
     Empty lines will be ignored, instead of interpreting them as the empty
-    sentence ``<s> </s>``.
+    sentence ``<s> </s>``. The utterances are scored in mini-batches of
+    ``batch_size`` lines, but the scores are written in the input order. If
+    ``bucket_window`` is given, that many lines are read at a time and the
+    mini-batches are formed from utterances of similar length.
 
     :type input_file: file object
     :param input_file: a file that contains the input sentences in SRILM n-best
@@ -408,24 +563,120 @@ def _score_utterances(input_file, vocabulary, scorer, output_file,
     :type log_base: int
     :param log_base: if set to other than None, convert log probabilities to
                      this base
+
+    :type batch_size: int
+    :param batch_size: number of lines to score in one mini-batch
+
+    :type bucket_window: int
+    :param bucket_window: if not ``None``, sort this many lines at a time by
+                          length before creating mini-batches
+
+    :type max_batch_tokens: int
+    :param max_batch_tokens: if not ``None``, limit the number of time steps
+                             times utterances in a bucketed mini-batch
     """
 
     log_scale = 1.0 if log_base is None else numpy.log(log_base)
 
-    for line_num, line in enumerate(input_file):
-        lm_score = scorer.score_line(line, vocabulary)
-        if lm_score is None:
+    def write_scores(lines):
+        if bucket_window is None:
+            lm_scores = scorer.score_lines(lines, vocabulary)
+        else:
+            lm_scores = [None] * len(lines)
+            lengths = [len(utterance_from_line(line)) for line in lines]
+            for indices in bucket_sequences(lengths, batch_size,
+                                            max_batch_tokens):
+                batch_lines = [lines[index] for index in indices]
+                batch_scores = scorer.score_lines(batch_lines, vocabulary)
+                for index, lm_score in zip(indices, batch_scores):
+                    lm_scores[index] = lm_score
+        for lm_score in lm_scores:
+            if lm_score is None:
+                continue
+            lm_score /= log_scale
+            output_file.write(str(lm_score) + '\n')
+
+    window_size = batch_size if bucket_window is None else bucket_window
+    lines = []
+    num_lines = 0
+    for line in input_file:
+        lines.append(line)
+        if len(lines) < window_size:
             continue
-        lm_score /= log_scale
-        output_file.write(str(lm_score) + '\n')
-        if (line_num + 1) % 1000 == 0:
-            logging.info("%d sentences scored.", line_num + 1)
+        write_scores(lines)
+        if (num_lines + len(lines)) // 1000 > num_lines // 1000:
+            logging.info("%d sentences scored.", num_lines + len(lines))
+        num_lines += len(lines)
+        lines = []
+    if lines:
+        write_scores(lines)
+
+    if scorer.num_words == 0:
+        logging.info("The input file contains no words.")
+    else:
+        logging.info("%d words processed, including start-of-sentence and "
+                     "end-of-sentence tags, and %d (%.1f %%) out-of-vocabulary "
+                     "words", scorer.num_words, scorer.num_unks,
+                     scorer.num_unks / scorer.num_words * 100)
+
+def _score_nbest(input_file, scorer, output_file, log_base=None):
+    """Reads an n-best list from ``input_file``, computes LM scores using
+    ``scorer``, and writes one score per line to ``output_file``.
+
+    Each line of the n-best list contains an utterance ID, acoustic score, LM
+    score, number of words, and the words of the hypothesis. The hypotheses of
+    an utterance have to be on consecutive lines. The hypotheses of each
+    utterance are scored together, so that the common prefixes are computed
+    only once.
+
+    :type input_file: file object
+    :param input_file: a file that contains the n-best list
+
+    :type scorer: NBestScorer
+    :param scorer: a scorer for rescoring the hypotheses
+
+    :type output_file: file object
+    :param output_file: a file where to write the LM scores
+
+    :type log_base: int
+    :param log_base: if set to other than None, convert log probabilities to
+                     this base
+    """
+
+    log_scale = 1.0 if log_base is None else numpy.log(log_base)
+
+    def write_scores(lines):
+        for lm_score in scorer.score_hypotheses(lines):
+            lm_score /= log_scale
+            output_file.write(str(lm_score) + '\n')
+
+    utterance_id = None
+    lines = []
+    num_utterances = 0
+    for line_num, line in enumerate(input_file):
+        fields = line.split(maxsplit=4)
+        if len(fields) < 4:
+            raise InputError("Invalid n-best list on line {}. Expected utterance "
+                             "ID, acoustic score, LM score, number of words, and "
+                             "the words.".format(line_num + 1))
+        if (fields[0] != utterance_id) and lines:
+            write_scores(lines)
+            lines = []
+            num_utterances += 1
+            if num_utterances % 100 == 0:
+                logging.info("%d utterances scored.", num_utterances)
+        utterance_id = fields[0]
+        lines.append(fields[4] if len(fields) > 4 else "")
+    if lines:
+        write_scores(lines)
 
     if scorer.num_words == 0:
         logging.info("The input file contains no words.")
     else:
         logging.info("%d words processed, including start-of-sentence and "
-              "end-of-sentence tags, and %d (%.1f %%) out-of-vocabulary "
-              "words".format(scorer.num_words,
-                             scorer.num_unks,
-                             scorer.num_unks / scorer.num_words))
+                     "end-of-sentence tags, and %d (%.1f %%) out-of-vocabulary "
+                     "words", scorer.num_words, scorer.num_unks,
+                     scorer.num_unks / scorer.num_words * 100)
+        logging.info("The network was run for %d time steps (%.1f %% of the "
+                     "words).", scorer.num_steps,
+                     scorer.num_steps / scorer.num_words * 100)
@@ -86,6 +86,15 @@ def add_arguments(parser):
         '--validation-frequency', metavar='N', type=int, default='5',
         help='cross-validate for reducing learning rate or early stopping N '
              'times per training epoch (default 5)')
+    argument_group.add_argument(
+        '--validation-bucket-window', metavar='N', type=int, default=None,
+        help='read N validation sentences at a time and sort them by length, '
+             'so that each validation mini-batch contains sentences of similar '
+             'length')
+    argument_group.add_argument(
+        '--validation-max-batch-tokens', metavar='N', type=int, default=None,
+        help='with --validation-bucket-window, limit the size of a validation '
+             'mini-batch to N time steps times sentences')
     argument_group.add_argument(
         '--patience', metavar='N', type=int, default=4,
         help='allow perplexity to increase N consecutive cross-validations, '
@@ -458,12 +467,14 @@ def train(args):
             validation_mmap = mmap.mmap(args.validation_file.fileno(),
                                         0,
                                         prot=mmap.PROT_READ)
-            validation_iter = \
-                LinearBatchIterator(validation_mmap,
-                                    vocabulary,
-                                    batch_size=args.batch_size,
-                                    max_sequence_length=args.sequence_length,
-                                    map_oos_to_unk=False)
+            validation_iter = LinearBatchIterator(
+                validation_mmap,
+                vocabulary,
+                batch_size=args.batch_size,
+                max_sequence_length=args.sequence_length,
+                map_oos_to_unk=False,
+                bucket_window=args.validation_bucket_window,
+                max_batch_tokens=args.validation_max_batch_tokens)
             trainer.set_validation(validation_iter, scorer)
         else:
             logging.info("Cross-validation will not be performed.")
@@ -6,3 +6,4 @@
 from theanolm.network.network import Network
 from theanolm.network.architecture import Architecture
 from theanolm.network.recurrentstate import RecurrentState
+from theanolm.network.steppredictor import StepPredictor
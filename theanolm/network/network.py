@@ -468,6 +468,21 @@ class Network(object):
             raise RuntimeError("The final layer is not an output layer.")
         return self.output_layer.target_probs
 
+    def output_layer_inputs(self):
+        """Returns the outputs of the layers that are connected to the output
+        layer.
+
+        These are the hidden activations that the output layer uses to predict
+        the next word. The output layer can be evaluated separately from the
+        rest of the network by replacing these variables with other inputs.
+
+        :rtype: list of Variables
+        :returns: a symbolic 3-dimensional matrix for each input of the output
+                  layer, indexed by time step, sequence, and vector element
+        """
+
+        return [layer.output for layer in self.output_layer._input_layers]
+
     def unnormalized_logprobs(self):
         """Returns the unnormalized log probabilities for the predicted words.
 
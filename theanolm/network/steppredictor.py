@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""A module that implements the StepPredictor class, for performing a forward
+pass one time step at a time.
+"""
+
+import numpy
+import theano
+
+from theanolm.network.recurrentstate import RecurrentState
+
+class StepPredictor(object):
+    """Single Time Step Predictor
+
+    Computes the forward pass of a network one time step at a time using two
+    separate Theano functions. The first one updates the recurrent state and
+    computes the hidden activations that are the input of the output layer. The
+    second one evaluates only the output layer, computing the probabilities of
+    given target classes from the hidden activations.
+
+    Because the recurrent layers are computed by the first function only, the
+    same hidden activations can be used to compute the probabilities of any
+    number of candidate next words without repeating the recurrent computation.
+    """
+
+    def __init__(self, network, profile=False):
+        """Creates the Theano functions for updating the state and scoring the
+        target words.
+
+        :type network: Network
+        :param network: the neural network object
+
+        :type profile: bool
+        :param profile: if set to True, creates a Theano profile object
+        """
+
+        self._network = network
+
+        hidden_outputs = network.output_layer_inputs()
+        self._num_hidden = len(hidden_outputs)
+
+        inputs = [network.input_word_ids, network.input_class_ids]
+        inputs.extend(network.recurrent_state_input)
+
+        outputs = list(hidden_outputs)
+        outputs.extend(network.recurrent_state_output)
+
+        # Ignore unused input, because is_training is only used by dropout
+        # layer.
+        self._state_function = theano.function(
+            inputs,
+            outputs,
+            givens=[(network.is_training, numpy.int8(0))],
+            name='step_state',
+            profile=profile,
+            on_unused_input='ignore')
+
+        # The output layer is evaluated from new input variables that replace
+        # the hidden activations in the graph.
+        hidden_inputs = []
+        for index, hidden_output in enumerate(hidden_outputs):
+            variable = hidden_output.type(
+                'steppredictor/hidden_input_' + str(index))
+            if hasattr(hidden_output.tag, 'test_value'):
+                variable.tag.test_value = hidden_output.tag.test_value
+            hidden_inputs.append(variable)
+
+        inputs = list(hidden_inputs)
+        inputs.append(network.target_class_ids)
+
+        givens = list(zip(hidden_outputs, hidden_inputs))
+        givens.append((network.is_training, numpy.int8(0)))
+        self._target_function = theano.function(
+            inputs,
+            theano.tensor.log(network.target_probs()),
+            givens=givens,
+            name='step_target_logprobs',
+            profile=profile,
+            on_unused_input='ignore')
+
+    def predict_state(self, input_word_ids, input_class_ids, recurrent_state):
+        """Computes the hidden activations and the new recurrent state after
+        one time step.
+
+        :type input_word_ids: numpy.ndarray of an integer type
+        :param input_word_ids: a 2-dimensional matrix that contains one time
+                               step of word IDs for each sequence
+
+        :type input_class_ids: numpy.ndarray of an integer type
+        :param input_class_ids: a 2-dimensional matrix that contains one time
+                                step of class IDs for each sequence
+
+        :type recurrent_state: RecurrentState
+        :param recurrent_state: the state of the recurrent layers before the
+                                time step, for each sequence
+
+        :rtype: tuple of (list of numpy.ndarrays, RecurrentState)
+        :returns: the inputs of the output layer and the state of the recurrent
+                  layers after the time step
+        """
+
+        step_result = self._state_function(input_word_ids,
+                                           input_class_ids,
+                                           *recurrent_state.get())
+        hidden = step_result[:self._num_hidden]
+        output_state = RecurrentState(self._network.recurrent_state_size,
+                                      input_word_ids.shape[1],
+                                      step_result[self._num_hidden:])
+        return hidden, output_state
+
+    def target_logprobs(self, hidden, target_class_ids, sequence_indices=None):
+        """Computes the log probabilities of given target classes.
+
+        The target classes are given in a 2-dimensional matrix with one time
+        step. If ``sequence_indices`` is given, the hidden activations of
+        sequence ``sequence_indices[i]`` are used to predict the class in column
+        ``i`` of ``target_class_ids``. This way the probabilities of several
+        target classes can be computed for each sequence in a single call.
+
+        :type hidden: list of numpy.ndarrays
+        :param hidden: the inputs of the output layer, as returned by
+                       ``predict_state()``
+
+        :type target_class_ids: numpy.ndarray of an integer type
+        :param target_class_ids: a 2-dimensional matrix that contains one time
+                                 step of target class IDs
+
+        :type sequence_indices: numpy.ndarray of an integer type
+        :param sequence_indices: if not ``None``, selects the sequence of
+                                 ``hidden`` for each target class
+
+        :rtype: numpy.ndarray
+        :returns: a 2-dimensional matrix that contains the log probability of
+                  each target class
+        """
+
+        if sequence_indices is not None:
+            hidden = [layer_hidden[:, sequence_indices]
+                      for layer_hidden in hidden]
+        return self._target_function(*hidden, target_class_ids)
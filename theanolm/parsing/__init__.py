@@ -6,4 +6,4 @@
 from theanolm.parsing.linearbatchiterator import LinearBatchIterator
 from theanolm.parsing.shufflingbatchiterator import ShufflingBatchIterator
 from theanolm.parsing.scoringbatchiterator import ScoringBatchIterator
-from theanolm.parsing.functions import utterance_from_line
+from theanolm.parsing.functions import utterance_from_line, bucket_sequences
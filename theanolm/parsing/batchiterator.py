@@ -5,10 +5,11 @@ that read mini-batches.
 """
 
 from abc import abstractmethod, ABCMeta
+from collections import deque
 
 import numpy
 
-from theanolm.parsing.functions import utterance_from_line
+from theanolm.parsing.functions import utterance_from_line, bucket_sequences
 
 class BatchIterator(object, metaclass=ABCMeta):
     """Base Class for Mini-Batch Iterators
@@ -18,13 +19,22 @@ class BatchIterator(object, metaclass=ABCMeta):
                  vocabulary,
                  batch_size=1,
                  max_sequence_length=None,
-                 map_oos_to_unk=False):
+                 map_oos_to_unk=False,
+                 bucket_window=None,
+                 max_batch_tokens=None):
         """Constructs an iterator for reading mini-batches.
 
         The iterator can produce word IDs just for the shortlist words by
         setting ``map_oos_to_unk=True``. This is used when reading training
         mini-batches.
 
+        Normally consecutive sequences form a mini-batch. If ``bucket_window``
+        is given, that many sequences are read at a time and sorted by length,
+        and the mini-batches are formed from sequences of similar length, so
+        that less time steps are wasted on padding. The positions of the
+        sequences of the last mini-batch in the input are stored in
+        ``sequence_indices``, so that the original order can be restored.
+
         :type vocabulary: Vocabulary
         :param vocabulary: vocabulary that provides mapping between words and
                            word IDs
@@ -40,14 +50,29 @@ class BatchIterator(object, metaclass=ABCMeta):
         :type map_oos_to_unk: bool
         :param map_oos_to_unk: if set to ``True``, out-of-shortlist words will
                                be mapped to ``<unk>``
+
+        :type bucket_window: int
+        :param bucket_window: if not ``None``, sort this many sequences at a
+                              time by length before creating mini-batches
+
+        :type max_batch_tokens: int
+        :param max_batch_tokens: if not ``None``, limit the number of sequences
+                                 in a bucketed mini-batch so that the number of
+                                 sequences times the length of the longest
+                                 sequence is at most this
         """
 
         self._vocabulary = vocabulary
         self._batch_size = batch_size
         self._max_sequence_length = max_sequence_length
         self._map_oos_to_unk = map_oos_to_unk
+        self._bucket_window = bucket_window
+        self._max_batch_tokens = max_batch_tokens
         self._buffer = []
         self._end_of_file = False
+        self._batches = deque()
+        self._num_sequences_read = 0
+        self.sequence_indices = []
 
     def __iter__(self):
         return self
@@ -69,11 +94,15 @@ class BatchIterator(object, metaclass=ABCMeta):
         :returns: word ID and mask matrix
         """
 
+        if self._bucket_window is not None:
+            return self._next_bucketed()
+
         # If EOF was reached on the previous call, but a mini-batch was
         # returned, rewind the file pointer now and raise StopIteration.
         if self._end_of_file:
             self._end_of_file = False
             self._reset()
+            self._num_sequences_read = 0
             raise StopIteration
 
         sequences = []
@@ -85,6 +114,7 @@ class BatchIterator(object, metaclass=ABCMeta):
                 continue
             sequences.append(sequence)
             if len(sequences) >= self._batch_size:
+                self._set_sequence_indices(len(sequences))
                 return self._prepare_batch(sequences)
 
         # When end of file is reached, if no lines were read, rewind to first
@@ -92,9 +122,11 @@ class BatchIterator(object, metaclass=ABCMeta):
         # raise StopIteration the next time this method is called.
         if not sequences:
             self._reset()
+            self._num_sequences_read = 0
             raise StopIteration
         else:
             self._end_of_file = True
+            self._set_sequence_indices(len(sequences))
             return self._prepare_batch(sequences)
 
     def __len__(self):
@@ -107,6 +139,8 @@ class BatchIterator(object, metaclass=ABCMeta):
 
         self._reset(False)
         num_sequences = 0
+        num_batches = 0
+        window_lengths = []
 
         while True:
             sequence = self._read_sequence()
@@ -115,10 +149,79 @@ class BatchIterator(object, metaclass=ABCMeta):
             if len(sequence) < 2:
                 continue
             num_sequences += 1
+            if self._bucket_window is not None:
+                window_lengths.append(len(sequence))
+                if len(window_lengths) >= self._bucket_window:
+                    num_batches += len(self._bucket(window_lengths))
+                    window_lengths = []
 
         self._reset(False)
+        if self._bucket_window is not None:
+            if window_lengths:
+                num_batches += len(self._bucket(window_lengths))
+            return num_batches
         return (num_sequences + self._batch_size - 1) // self._batch_size
 
+    def _next_bucketed(self):
+        """Returns the next mini-batch of sequences that have similar length.
+
+        When the previously read sequences have been used, reads the next
+        ``self._bucket_window`` sequences and divides them into mini-batches.
+
+        :rtype: tuple of ndarrays
+        :returns: the matrices created by ``_prepare_batch()``
+        """
+
+        if not self._batches:
+            sequences = []
+            while len(sequences) < self._bucket_window:
+                sequence = self._read_sequence()
+                if sequence is None:
+                    break
+                if len(sequence) < 2:
+                    continue
+                sequences.append(sequence)
+            if not sequences:
+                self._reset()
+                self._num_sequences_read = 0
+                raise StopIteration
+
+            first_index = self._num_sequences_read
+            self._num_sequences_read += len(sequences)
+            for indices in self._bucket([len(s) for s in sequences]):
+                self._batches.append([(first_index + index, sequences[index])
+                                      for index in indices])
+
+        batch = self._batches.popleft()
+        self.sequence_indices = [index for index, _ in batch]
+        return self._prepare_batch([sequence for _, sequence in batch])
+
+    def _bucket(self, lengths):
+        """Divides a window of sequences into mini-batches of similar length.
+
+        :type lengths: list of ints
+        :param lengths: length of each sequence
+
+        :rtype: list of lists
+        :returns: indices to ``lengths`` for each mini-batch
+        """
+
+        return bucket_sequences(lengths, self._batch_size,
+                                self._max_batch_tokens)
+
+    def _set_sequence_indices(self, num_sequences):
+        """Stores the positions of the next ``num_sequences`` sequences, when
+        the sequences are not reordered.
+
+        :type num_sequences: int
+        :param num_sequences: number of sequences in the mini-batch
+        """
+
+        first_index = self._num_sequences_read
+        self._num_sequences_read += num_sequences
+        self.sequence_indices = list(range(first_index,
+                                           self._num_sequences_read))
+
     @abstractmethod
     def _reset(self, shuffle=True):
         """Resets the read pointer back to the beginning of the data set.
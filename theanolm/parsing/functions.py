@@ -3,6 +3,8 @@
 """Functions related to reading text.
 """
 
+import numpy
+
 def utterance_from_line(line):
     """Converts a line of text, read from an input file, into a list of words.
 
@@ -60,3 +62,42 @@ def find_sentence_starts(data):
             result.append(pos)
 
     return result
+
+def bucket_sequences(lengths, max_sequences, max_tokens=None):
+    """Divides sequences into mini-batches of similar length.
+
+    The sequences are sorted by length, and consecutive sequences are grouped
+    into mini-batches of at most ``max_sequences`` sequences. If ``max_tokens``
+    is given, a mini-batch is also ended when the number of sequences times the
+    length of the longest sequence would exceed it, i.e. it limits the size of
+    the padded mini-batch. A sequence that alone exceeds ``max_tokens`` forms a
+    mini-batch of its own.
+
+    :type lengths: list of ints
+    :param lengths: length of each sequence
+
+    :type max_sequences: int
+    :param max_sequences: maximum number of sequences in a mini-batch
+
+    :type max_tokens: int
+    :param max_tokens: if not ``None``, maximum number of time steps times
+                       sequences in a mini-batch
+
+    :rtype: list of lists
+    :returns: indices to ``lengths`` for each mini-batch
+    """
+
+    result = []
+    batch = []
+    for index in numpy.argsort(lengths, kind='stable').tolist():
+        # The sequences are in ascending order, so this is the longest one.
+        length = lengths[index]
+        if batch and ((len(batch) >= max_sequences) or
+                      ((max_tokens is not None) and
+                       ((len(batch) + 1) * length > max_tokens))):
+            result.append(batch)
+            batch = []
+        batch.append(index)
+    if batch:
+        result.append(batch)
+    return result
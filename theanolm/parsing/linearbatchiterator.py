@@ -15,7 +15,9 @@ class LinearBatchIterator(BatchIterator):
                  vocabulary,
                  batch_size=1,
                  max_sequence_length=None,
-                 map_oos_to_unk=False):
+                 map_oos_to_unk=False,
+                 bucket_window=None,
+                 max_batch_tokens=None):
         """Constructs an iterator for reading mini-batches from given files or
         memory map. This iterator reads the sentences in linear order.
 
@@ -40,6 +42,17 @@ class LinearBatchIterator(BatchIterator):
         :type map_oos_to_unk: bool
         :param map_oos_to_unk: if set to ``True``, out-of-shortlist words will
                                be mapped to ``<unk>``
+
+        :type bucket_window: int
+        :param bucket_window: if not ``None``, sort this many sequences at a
+                              time by length and create mini-batches of
+                              sequences with similar length
+
+        :type max_batch_tokens: int
+        :param max_batch_tokens: if not ``None``, limit the number of sequences
+                                 in a bucketed mini-batch so that the number of
+                                 sequences times the length of the longest
+                                 sequence is at most this
         """
 
         if isinstance(input_files, (list, tuple)):
@@ -52,7 +65,7 @@ class LinearBatchIterator(BatchIterator):
         self._reset()
 
         super().__init__(vocabulary, batch_size, max_sequence_length,
-                         map_oos_to_unk)
+                         map_oos_to_unk, bucket_window, max_batch_tokens)
 
     def _reset(self, shuffle=True):
         """Resets the read pointer back to the beginning of the file.
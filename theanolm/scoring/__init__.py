@@ -4,6 +4,8 @@
 """
 
 from theanolm.scoring.textscorer import TextScorer
+from theanolm.scoring.nbestscorer import NBestScorer
+from theanolm.scoring.scorecache import ScoreCache
 from theanolm.scoring.latticedecoder import LatticeDecoder
 from theanolm.scoring.latticebatch import LatticeBatch
 from theanolm.scoring.rescoredlattice import RescoredLattice
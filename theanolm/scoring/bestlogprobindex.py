@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""A module that implements the BestLogprobIndex class used by the lattice
+decoder for beam pruning.
+"""
+
+from bisect import bisect_left
+
+class BestLogprobIndex(object):
+    """Index of the Best Log Probabilities at Lattice Nodes
+
+    Beam pruning compares the tokens of a node to the best token that has been
+    seen at the same or a later time. This class stores the best log
+    probability of each node in a Fenwick tree, indexed by the position of the
+    node in topological order. The best log probability from a given position
+    to the end of the lattice can be queried, and the log probability of a node
+    can be increased, both in O(log N) time.
+
+    The position where the search starts is computed for each node when the
+    index is constructed. If the nodes contain time stamps, it is the first node
+    in the sorted order whose time is not earlier than the time of the node.
+    Otherwise it is the node itself.
+    """
+
+    def __init__(self, sorted_nodes):
+        """Creates an index for given nodes, reading the initial best log
+        probabilities from the ``best_logprob`` attribute of the nodes.
+
+        :type sorted_nodes: list of Lattice.Nodes
+        :param sorted_nodes: all nodes in topological order
+        """
+
+        self._num_nodes = len(sorted_nodes)
+        self._positions = dict()
+        self._begin_positions = dict()
+
+        # The maximum time stamp before each position is a monotonic sequence,
+        # so the first node that is not earlier than a given time can be found
+        # using binary search.
+        max_times = []
+        max_time = float('-inf')
+        for position, node in enumerate(sorted_nodes):
+            self._positions[node.id] = position
+            if (node.time is not None) and (node.time > max_time):
+                max_time = node.time
+            max_times.append(max_time)
+        for position, node in enumerate(sorted_nodes):
+            if node.time is None:
+                self._begin_positions[node.id] = position
+            else:
+                self._begin_positions[node.id] = bisect_left(max_times,
+                                                             node.time)
+
+        # The tree is indexed in reverse order, so that a prefix query gives
+        # the maximum from a position to the end of the lattice.
+        self._tree = [float('-inf')] * (self._num_nodes + 1)
+        for node in sorted_nodes:
+            if node.best_logprob is not None:
+                self.update(node, node.best_logprob)
+
+    def update(self, node, logprob):
+        """Updates the best log probability of a node, if ``logprob`` is
+        greater than the current value.
+
+        :type node: Lattice.Node
+        :param node: a node whose log probability will be updated
+
+        :type logprob: float
+        :param logprob: log probability of a token in ``node``
+        """
+
+        index = self._num_nodes - self._positions[node.id]
+        tree = self._tree
+        while index <= self._num_nodes:
+            if tree[index] >= logprob:
+                # The values are updated from the bottom up, so the rest of the
+                # path contains at least the same value.
+                break
+            tree[index] = logprob
+            index += index & -index
+
+    def best_logprob(self, node):
+        """Returns the best log probability at the same or later time than
+        ``node``.
+
+        :type node: Lattice.Node
+        :param node: a node whose time is used to start the search
+
+        :rtype: float
+        :returns: the best log probability of the nodes at the same or later
+                  time, or -inf if no node has a log probability
+        """
+
+        index = self._num_nodes - self._begin_positions[node.id]
+        result = float('-inf')
+        tree = self._tree
+        while index > 0:
+            if tree[index] > result:
+                result = tree[index]
+            index -= index & -index
+        return result
@@ -0,0 +1,785 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""A module that implements the CSRLattice class, a compact representation of
+word lattices.
+"""
+
+import logging
+import math
+
+import numpy
+
+from theanolm.backend import InputError
+from theanolm.backend import logprob_type
+from theanolm.scoring.lattice import Lattice
+
+class CSRLattice(Lattice):
+    """Compact Word Lattice
+
+    Stores a word lattice in NumPy arrays instead of node and link objects. The
+    start and end node, word ID, and acoustic and language model scores of the
+    links are stored in arrays indexed by link ID. The scores are stored in
+    single precision and missing scores as NaN. Word IDs refer to the
+    ``words`` list of the lattice, and -1 means that the link has no word.
+
+    The outgoing and incoming links of the nodes are stored in compressed
+    sparse row (CSR) form: the IDs of the outgoing links of node ``i`` are
+    ``out_link_ids[out_offsets[i]:out_offsets[i + 1]]``, and similarly for
+    incoming links.
+
+    The ``nodes`` and ``links`` sequences create lightweight ``Node`` and
+    ``Link`` objects on demand, so the lattice can be used where other lattices
+    are used. The attributes that the decoder and the rescored lattice store in
+    the nodes are saved in lists owned by the lattice.
+    """
+
+    class Link(object):
+        """A view to a link stored in a CSRLattice.
+        """
+
+        __slots__ = ('_lattice', 'id')
+
+        def __init__(self, lattice, link_id):
+            """Constructs a view to a link.
+
+            :type lattice: CSRLattice
+            :param lattice: the lattice that contains the link
+
+            :type link_id: int
+            :param link_id: index of the link in the arrays
+            """
+
+            self._lattice = lattice
+            self.id = link_id
+
+        def __eq__(self, other):
+            return isinstance(other, CSRLattice.Link) and \
+                   (other._lattice is self._lattice) and (other.id == self.id)
+
+        def __hash__(self):
+            return hash(self.id)
+
+        @property
+        def start_node(self):
+            lattice = self._lattice
+            return lattice.Node(lattice, int(lattice.link_starts[self.id]))
+
+        @property
+        def end_node(self):
+            lattice = self._lattice
+            return lattice.Node(lattice, int(lattice.link_ends[self.id]))
+
+        @property
+        def word(self):
+            word_id = self._lattice.link_words[self.id]
+            return None if word_id < 0 else self._lattice.words[word_id]
+
+        @property
+        def ac_logprob(self):
+            return self._lattice._get_logprob(self._lattice.ac_logprobs,
+                                              self.id)
+
+        @property
+        def lm_logprob(self):
+            return self._lattice._get_logprob(self._lattice.lm_logprobs,
+                                              self.id)
+
+        @property
+        def transitions(self):
+            transitions = self._lattice.transitions
+            return "" if transitions is None else transitions[self.id]
+
+    class Node(object):
+        """A view to a node stored in a CSRLattice.
+        """
+
+        __slots__ = ('_lattice', 'id')
+
+        def __init__(self, lattice, node_id):
+            """Constructs a view to a node.
+
+            :type lattice: CSRLattice
+            :param lattice: the lattice that contains the node
+
+            :type node_id: int
+            :param node_id: index of the node in the arrays
+            """
+
+            self._lattice = lattice
+            self.id = node_id
+
+        def __eq__(self, other):
+            return isinstance(other, CSRLattice.Node) and \
+                   (other._lattice is self._lattice) and (other.id == self.id)
+
+        def __hash__(self):
+            return hash(self.id)
+
+        @property
+        def out_links(self):
+            lattice = self._lattice
+            begin = lattice.out_offsets[self.id]
+            end = lattice.out_offsets[self.id + 1]
+            return [lattice.Link(lattice, link_id)
+                    for link_id in lattice.out_link_ids[begin:end].tolist()]
+
+        @property
+        def in_links(self):
+            lattice = self._lattice
+            begin = lattice.in_offsets[self.id]
+            end = lattice.in_offsets[self.id + 1]
+            return [lattice.Link(lattice, link_id)
+                    for link_id in lattice.in_link_ids[begin:end].tolist()]
+
+        @property
+        def time(self):
+            time = self._lattice.node_times[self.id]
+            return None if numpy.isnan(time) else float(time)
+
+        @property
+        def final(self):
+            return bool(self._lattice.node_finals[self.id])
+
+        @property
+        def best_logprob(self):
+            best_logprobs = self._lattice._best_logprobs
+            return None if best_logprobs is None else best_logprobs[self.id]
+
+        @best_logprob.setter
+        def best_logprob(self, value):
+            lattice = self._lattice
+            if lattice._best_logprobs is None:
+                lattice._best_logprobs = [None] * lattice.num_nodes
+            lattice._best_logprobs[self.id] = value
+
+        @property
+        def word_to_link(self):
+            word_to_links = self._lattice._word_to_links
+            if word_to_links is None:
+                raise AttributeError("word_to_link")
+            return word_to_links[self.id]
+
+        @word_to_link.setter
+        def word_to_link(self, value):
+            lattice = self._lattice
+            if lattice._word_to_links is None:
+                lattice._word_to_links = [None] * lattice.num_nodes
+            lattice._word_to_links[self.id] = value
+
+    class _Views(object):
+        """A sequence of node or link views.
+        """
+
+        def __init__(self, lattice, view_class, length):
+            self._lattice = lattice
+            self._view_class = view_class
+            self._length = length
+
+        def __len__(self):
+            return self._length
+
+        def __getitem__(self, index):
+            if isinstance(index, slice):
+                return [self._view_class(self._lattice, i)
+                        for i in range(*index.indices(self._length))]
+            if index < 0:
+                index += self._length
+            if (index < 0) or (index >= self._length):
+                raise IndexError("Lattice index out of range.")
+            return self._view_class(self._lattice, index)
+
+        def __iter__(self):
+            for index in range(self._length):
+                yield self._view_class(self._lattice, index)
+
+    def __init__(self, lattice=None):
+        """Converts a lattice into the compact representation.
+
+        If ``lattice`` is ``None``, creates an empty lattice, whose arrays can
+        be assigned directly (used when reading lattice archives).
+
+        :type lattice: Lattice
+        :param lattice: a lattice read e.g. using ``SLFLattice`` or
+                        ``KaldiLattice``
+        """
+
+        # The base class constructor would create the node and link lists.
+        # pylint: disable=super-init-not-called
+
+        if lattice is None:
+            lattice = Lattice()
+            lattice.initial_node = Lattice.Node(0)
+            lattice.nodes.append(lattice.initial_node)
+
+        self.utterance_id = lattice.utterance_id
+        self.lm_scale = lattice.lm_scale
+        self.wi_penalty = lattice.wi_penalty
+
+        link_ids = {link: link_id for link_id, link in enumerate(lattice.links)}
+        num_links = len(lattice.links)
+        self.link_starts = numpy.empty(num_links, dtype='int32')
+        self.link_ends = numpy.empty(num_links, dtype='int32')
+        self.link_words = numpy.empty(num_links, dtype='int32')
+        self.ac_logprobs = numpy.empty(num_links, dtype='float32')
+        self.lm_logprobs = numpy.empty(num_links, dtype='float32')
+        self.words = []
+        word_ids = dict()
+        transitions = []
+        for link_id, link in enumerate(lattice.links):
+            self.link_starts[link_id] = link.start_node.id
+            self.link_ends[link_id] = link.end_node.id
+            if link.word is None:
+                self.link_words[link_id] = -1
+            else:
+                word_id = word_ids.get(link.word)
+                if word_id is None:
+                    word_id = len(self.words)
+                    word_ids[link.word] = word_id
+                    self.words.append(link.word)
+                self.link_words[link_id] = word_id
+            self.ac_logprobs[link_id] = numpy.nan \
+                                        if link.ac_logprob is None \
+                                        else link.ac_logprob
+            self.lm_logprobs[link_id] = numpy.nan \
+                                        if link.lm_logprob is None \
+                                        else link.lm_logprob
+            transitions.append(link.transitions)
+        # Transition IDs are only used in Kaldi lattices.
+        self.transitions = transitions if any(transitions) else None
+
+        nodes = lattice.nodes
+        num_nodes = len(nodes)
+        self.node_times = numpy.array(
+            [numpy.nan if node.time is None else node.time for node in nodes],
+            dtype='float64')
+        self.node_finals = numpy.array([node.final for node in nodes],
+                                       dtype='bool')
+        self.out_offsets, self.out_link_ids = self._csr(
+            [[link_ids[link] for link in node.out_links] for node in nodes])
+        self.in_offsets, self.in_link_ids = self._csr(
+            [[link_ids[link] for link in node.in_links] for node in nodes])
+        self.initial_node_id = lattice.initial_node.id
+        assert len(self.out_offsets) == num_nodes + 1
+
+        self._best_logprobs = None
+        self._word_to_links = None
+
+    @property
+    def num_nodes(self):
+        """Returns the number of nodes in the lattice.
+
+        :rtype: int
+        :returns: the number of nodes
+        """
+
+        return len(self.node_finals)
+
+    @property
+    def num_links(self):
+        """Returns the number of links in the lattice.
+
+        :rtype: int
+        :returns: the number of links
+        """
+
+        return len(self.link_starts)
+
+    @property
+    def nodes(self):
+        return self._Views(self, self.Node, self.num_nodes)
+
+    @property
+    def links(self):
+        return self._Views(self, self.Link, self.num_links)
+
+    @property
+    def initial_node(self):
+        return self.Node(self, self.initial_node_id)
+
+    @property
+    def nbytes(self):
+        """Returns the number of bytes allocated for the arrays.
+
+        :rtype: int
+        :returns: total size of the arrays in bytes
+        """
+
+        return sum(array.nbytes
+                   for array in (self.link_starts, self.link_ends,
+                                 self.link_words, self.ac_logprobs,
+                                 self.lm_logprobs, self.node_times,
+                                 self.node_finals, self.out_offsets,
+                                 self.out_link_ids, self.in_offsets,
+                                 self.in_link_ids))
+
+    def write_slf(self, output_file):
+        """Writes the lattice in SLF format.
+
+        :type output_file: file object
+        :param output_file: a file where to write the output
+        """
+
+        output_file.write("# Header (generated by TheanoLM)\n")
+        output_file.write("VERSION=1.1\n")
+        output_file.write('UTTERANCE="{}"\n'.format(self.utterance_id))
+        fields = []
+        if self.lm_scale is not None:
+            fields.append("lmscale={}".format(self.lm_scale))
+        if self.wi_penalty is not None:
+            fields.append("wdpenalty={}".format(self.wi_penalty))
+        if fields:
+            output_file.write("\t".join(fields) + "\n")
+        output_file.write("start={}\n".format(self.initial_node_id))
+        output_file.write("N={}\tL={}\n"
+                          .format(self.num_nodes, self.num_links))
+
+        output_file.write("# Nodes\n")
+        for node_id, time in enumerate(self.node_times.tolist()):
+            if numpy.isnan(time):
+                output_file.write("I={}\n".format(node_id))
+            else:
+                output_file.write("I={}\tt={}\n".format(node_id, time))
+
+        output_file.write("# Links\n")
+        # Adding zero converts negative zeros to positive.
+        ac_logprobs = self.ac_logprobs + numpy.float32(0.0)
+        lm_logprobs = self.lm_logprobs + numpy.float32(0.0)
+        for link_id, (start_id, end_id, word_id) in enumerate(zip(
+                self.link_starts.tolist(), self.link_ends.tolist(),
+                self.link_words.tolist())):
+            fields = ["J={}".format(link_id),
+                      "S={}".format(start_id),
+                      "E={}".format(end_id)]
+            if word_id < 0:
+                fields.append("W=!NULL")
+            else:
+                fields.append("W={}".format(self.words[word_id]))
+            if not numpy.isnan(ac_logprobs[link_id]):
+                fields.append("a=" + str(ac_logprobs[link_id]))
+            if not numpy.isnan(lm_logprobs[link_id]):
+                fields.append("l=" + str(lm_logprobs[link_id]))
+            output_file.write("\t".join(fields) + "\n")
+
+    def write_kaldi(self, output_file, word_to_id):
+        """Writes the lattice in Kaldi CompactLattice format.
+
+        :type output_file: file object
+        :param output_file: a file where to write the output
+
+        :type word_to_id: Vocabulary
+        :param word_to_id: mapping of words to Kaldi IDs
+        """
+
+        # Kaldi lattices always contain both scores.
+        ac_costs = -self.ac_logprobs + numpy.float32(0.0)
+        lm_costs = -self.lm_logprobs + numpy.float32(0.0)
+        finals = self.node_finals[self.link_ends]
+        output_file.write("{}\n".format(self.utterance_id))
+        for link_id in self.out_link_ids.tolist():
+            transitions = "" if self.transitions is None \
+                          else self.transitions[link_id]
+            if finals[link_id]:
+                output_file.write("{} {},{},{}\n".format(
+                    self.link_starts[link_id],
+                    str(lm_costs[link_id]),
+                    str(ac_costs[link_id]),
+                    transitions))
+            else:
+                word_id = self.link_words[link_id]
+                word = "<eps>" if word_id < 0 else self.words[word_id]
+                output_file.write("{} {} {} {},{},{}\n".format(
+                    self.link_starts[link_id],
+                    self.link_ends[link_id],
+                    word_to_id[word],
+                    str(lm_costs[link_id]),
+                    str(ac_costs[link_id]),
+                    transitions))
+        output_file.write("\n")
+
+    def sorted_nodes(self):
+        """Sorts nodes topologically, then by time.
+
+        Returns a list which contains the nodes in sorted order. The order is
+        the same as the order of ``Lattice.sorted_nodes()``.
+        """
+
+        return [self.Node(self, node_id)
+                for node_id in self.sorted_node_ids()]
+
+    def sorted_node_ids(self):
+        """Sorts the node IDs topologically, then by time.
+
+        Uses the Kahn's algorithm to sort the nodes topologically, but always
+        picks the node from the queue that has the lowest time stamp, if the
+        nodes contain time stamps.
+
+        :rtype: list of ints
+        :returns: IDs of the nodes in sorted order
+        """
+
+        times = self.node_times.tolist()
+        time_keys = [(True, 0.0) if numpy.isnan(time) else (False, time)
+                     for time in times]
+        out_offsets = self.out_offsets.tolist()
+        out_ends = self.link_ends[self.out_link_ids].tolist()
+
+        result = []
+        # A queue of nodes to be visited next:
+        node_queue = [self.initial_node_id]
+        # The number of incoming links not traversed yet:
+        in_degrees = numpy.diff(self.in_offsets).tolist()
+        while node_queue:
+            node_id = node_queue.pop()
+            result.append(node_id)
+            for next_id in out_ends[out_offsets[node_id]:
+                                    out_offsets[node_id + 1]]:
+                in_degrees[next_id] -= 1
+                if in_degrees[next_id] == 0:
+                    node_queue.append(next_id)
+                    node_queue.sort(key=time_keys.__getitem__, reverse=True)
+                elif in_degrees[next_id] < 0:
+                    raise InputError("Word lattice contains a cycle.")
+
+        if len(result) < self.num_nodes:
+            logging.warning("Word lattice contains unreachable nodes.")
+        else:
+            assert len(result) == self.num_nodes
+
+        return result
+
+    def prune(self, beam=None, min_posterior=None, lm_scale=1.0,
+              wi_penalty=0.0):
+        """Removes the links that are unlikely to be part of the best path,
+        using only the scores in the lattice.
+
+        Works like ``Lattice.prune()``, but the forward-backward pass iterates
+        over the arrays, and the links are removed by filtering the arrays.
+
+        :type beam: float
+        :param beam: prune links whose best path is at least this much worse
+                     than the best path through the lattice, or ``None`` for no
+                     beam pruning
+
+        :type min_posterior: float
+        :param min_posterior: prune links whose posterior probability is less
+                              than this, or ``None`` for no posterior pruning
+
+        :type lm_scale: float
+        :param lm_scale: scale LM log probabilities by this factor (must be
+                         positive for posterior pruning)
+
+        :type wi_penalty: float
+        :param wi_penalty: add this to the log probability of every word
+
+        :rtype: int
+        :returns: the number of links removed
+        """
+
+        sorted_ids = self.sorted_node_ids()
+        link_scores = self._link_scores(lm_scale, wi_penalty)
+        if min_posterior is None:
+            # The total log probabilities are not needed.
+            posterior_scale = 1.0
+        elif lm_scale > 0.0:
+            posterior_scale = 1.0 / lm_scale
+        else:
+            raise InputError("Posterior pruning requires a positive LM scale "
+                             "(got {}).".format(lm_scale))
+        out_offsets = self.out_offsets.tolist()
+        out_link_ids = self.out_link_ids.tolist()
+        link_starts = self.link_starts.tolist()
+        link_ends = self.link_ends.tolist()
+        scores = link_scores.tolist()
+
+        num_nodes = self.num_nodes
+        forward_best = [-numpy.inf] * num_nodes
+        forward_total = numpy.full(num_nodes, -numpy.inf)
+        best_in_links = [None] * num_nodes
+        forward_best[self.initial_node_id] = 0.0
+        forward_total[self.initial_node_id] = 0.0
+        for node_id in sorted_ids:
+            begin = out_offsets[node_id]
+            end = out_offsets[node_id + 1]
+            if begin == end:
+                continue
+            for link_id in out_link_ids[begin:end]:
+                end_id = link_ends[link_id]
+                best = forward_best[node_id] + scores[link_id]
+                if best > forward_best[end_id]:
+                    forward_best[end_id] = best
+                    best_in_links[end_id] = link_id
+            link_ids = self.out_link_ids[begin:end]
+            numpy.logaddexp.at(
+                forward_total, self.link_ends[link_ids],
+                forward_total[node_id] + link_scores[link_ids] * posterior_scale)
+        forward_best = numpy.array(forward_best)
+
+        backward_best = self._backward_best_logprobs(sorted_ids, link_scores)
+        backward_total = numpy.full(num_nodes, -numpy.inf)
+        for node_id in reversed(sorted_ids):
+            if self.node_finals[node_id]:
+                backward_total[node_id] = 0.0
+            link_ids = self.out_link_ids[out_offsets[node_id]:
+                                         out_offsets[node_id + 1]]
+            if len(link_ids) > 0:
+                backward_total[node_id] = numpy.logaddexp.reduce(
+                    numpy.concatenate((
+                        [backward_total[node_id]],
+                        backward_total[self.link_ends[link_ids]] +
+                        link_scores[link_ids] * posterior_scale)))
+
+        final_ids = [node_id for node_id in sorted_ids
+                     if self.node_finals[node_id]]
+        if not final_ids:
+            raise InputError("Could not reach a final node of word lattice.")
+        best_final_id = max(final_ids, key=lambda x: forward_best[x])
+        best_logprob = forward_best[best_final_id]
+        total_logprob = numpy.logaddexp.reduce(forward_total[final_ids])
+        if best_logprob == -numpy.inf:
+            raise InputError("Could not reach a final node of word lattice.")
+
+        logprobs = forward_best[self.link_starts] + link_scores + \
+                   backward_best[self.link_ends]
+        keep = logprobs != -numpy.inf
+        if beam is not None:
+            keep &= logprobs >= best_logprob - beam
+        if min_posterior is not None:
+            log_posteriors = forward_total[self.link_starts] + \
+                             link_scores * posterior_scale + \
+                             backward_total[self.link_ends] - total_logprob
+            keep &= log_posteriors >= numpy.log(min_posterior)
+
+        # Make sure that the best path is not broken.
+        link_id = best_in_links[best_final_id]
+        while link_id is not None:
+            keep[link_id] = True
+            link_id = best_in_links[link_starts[link_id]]
+
+        # Removing links may leave other links without a complete path. Keep
+        # only the links whose start node can be reached from the initial node
+        # and whose end node leads to a final node using the kept links.
+        kept = keep.tolist()
+        reachable = [False] * num_nodes
+        reachable[self.initial_node_id] = True
+        for node_id in sorted_ids:
+            if reachable[node_id]:
+                for link_id in out_link_ids[out_offsets[node_id]:
+                                            out_offsets[node_id + 1]]:
+                    if kept[link_id]:
+                        reachable[link_ends[link_id]] = True
+        leads_to_final = self.node_finals.tolist()
+        for node_id in reversed(sorted_ids):
+            for link_id in out_link_ids[out_offsets[node_id]:
+                                        out_offsets[node_id + 1]]:
+                if kept[link_id] and leads_to_final[link_ends[link_id]]:
+                    leads_to_final[node_id] = True
+        keep &= numpy.array(reachable)[self.link_starts]
+        keep &= numpy.array(leads_to_final, dtype='bool')[self.link_ends]
+
+        num_removed = self.num_links - int(numpy.count_nonzero(keep))
+        num_links = self.num_links
+        self._remove_links(keep)
+        logging.debug("Pruned lattice from %d to %d nodes and from %d to %d "
+                      "links.", num_nodes, self.num_nodes, num_links,
+                      self.num_links)
+        return num_removed
+
+    def lookahead_logprobs(self, lm_scale=1.0, wi_penalty=0.0):
+        """Computes the best log probability from each node to a final node,
+        using only the scores in the lattice.
+
+        :type lm_scale: float
+        :param lm_scale: scale LM log probabilities by this factor
+
+        :type wi_penalty: float
+        :param wi_penalty: add this to the log probability of every word
+
+        :rtype: numpy.ndarray
+        :returns: an array indexed by node ID that contains the best log
+                  probability of the remaining path, or -inf for the nodes
+                  that cannot reach a final node
+        """
+
+        return self._backward_best_logprobs(
+            self.sorted_node_ids(), self._link_scores(lm_scale, wi_penalty))
+
+    def link_lists(self):
+        """Returns the outgoing links of the nodes and the attributes of the
+        links in lists that are indexed by node and link ID.
+
+        The lists are created from the arrays without creating any link or
+        node views.
+
+        :rtype: tuple of five lists
+        :returns: the IDs of the outgoing links of each node, and the end node
+                  ID, word, acoustic log probability, and LM log probability of
+                  each link (``None`` for null links and missing scores)
+        """
+
+        out_offsets = self.out_offsets.tolist()
+        out_link_ids = self.out_link_ids.tolist()
+        out_links = [out_link_ids[out_offsets[node_id]:
+                                  out_offsets[node_id + 1]]
+                     for node_id in range(self.num_nodes)]
+        words = self.words
+        link_words = [None if word_id < 0 else words[word_id]
+                      for word_id in self.link_words.tolist()]
+
+        def logprob_list(logprobs):
+            return [None if math.isnan(logprob) else logprob_type(logprob)
+                    for logprob in logprobs.tolist()]
+
+        return (out_links, self.link_ends.tolist(), link_words,
+                logprob_list(self.ac_logprobs), logprob_list(self.lm_logprobs))
+
+    def _link_scores(self, lm_scale, wi_penalty):
+        """Computes the log probability of every link using the scores in the
+        lattice.
+
+        :type lm_scale: float
+        :param lm_scale: scale LM log probabilities by this factor
+
+        :type wi_penalty: float
+        :param wi_penalty: add this to the log probability of every word
+
+        :rtype: numpy.ndarray
+        :returns: log probability of each link, indexed by link ID
+        """
+
+        ac_logprobs = self.ac_logprobs.astype(logprob_type)
+        lm_logprobs = self.lm_logprobs.astype(logprob_type)
+        result = numpy.where(numpy.isnan(ac_logprobs), 0.0, ac_logprobs)
+        result += numpy.where(numpy.isnan(lm_logprobs), 0.0,
+                              lm_logprobs * lm_scale)
+        result += numpy.where(self.link_words >= 0, wi_penalty, 0.0)
+        return result
+
+    def _backward_best_logprobs(self, sorted_ids, link_scores):
+        """Computes the best log probability from each node to a final node.
+
+        :type sorted_ids: list of ints
+        :param sorted_ids: the node IDs in topological order
+
+        :type link_scores: numpy.ndarray
+        :param link_scores: log probability of each link, indexed by link ID
+
+        :rtype: numpy.ndarray
+        :returns: an array indexed by node ID that contains the best log
+                  probability of the remaining path
+        """
+
+        out_offsets = self.out_offsets.tolist()
+        out_link_ids = self.out_link_ids.tolist()
+        link_ends = self.link_ends.tolist()
+        scores = link_scores.tolist()
+        result = [-numpy.inf] * self.num_nodes
+        for node_id in reversed(sorted_ids):
+            best = 0.0 if self.node_finals[node_id] else -numpy.inf
+            for link_id in out_link_ids[out_offsets[node_id]:
+                                        out_offsets[node_id + 1]]:
+                best = max(best, result[link_ends[link_id]] + scores[link_id])
+            result[node_id] = best
+        return numpy.array(result)
+
+    def _remove_links(self, keep):
+        """Removes links and the nodes that are left without links.
+
+        The remaining nodes are renumbered, so that the node IDs still
+        correspond to their position in the arrays.
+
+        :type keep: numpy.ndarray
+        :param keep: a boolean mask that selects the links that will be kept
+        """
+
+        link_ids = numpy.full(self.num_links, -1, dtype='int32')
+        link_ids[keep] = numpy.arange(numpy.count_nonzero(keep))
+        link_starts = self.link_starts[keep]
+        link_ends = self.link_ends[keep]
+
+        kept_nodes = numpy.zeros(self.num_nodes, dtype='bool')
+        kept_nodes[link_starts] = True
+        kept_nodes[link_ends] = True
+        kept_nodes[self.initial_node_id] = True
+        node_ids = numpy.full(self.num_nodes, -1, dtype='int32')
+        node_ids[kept_nodes] = numpy.arange(numpy.count_nonzero(kept_nodes))
+
+        # The order of the links is preserved in the adjacency lists.
+        out_link_ids = self.out_link_ids[keep[self.out_link_ids]]
+        in_link_ids = self.in_link_ids[keep[self.in_link_ids]]
+        self.out_link_ids = link_ids[out_link_ids]
+        self.in_link_ids = link_ids[in_link_ids]
+        self.out_offsets = self._offsets(node_ids[link_starts],
+                                         numpy.count_nonzero(kept_nodes))
+        self.in_offsets = self._offsets(node_ids[link_ends],
+                                        numpy.count_nonzero(kept_nodes))
+
+        self.link_starts = node_ids[link_starts]
+        self.link_ends = node_ids[link_ends]
+        self.link_words = self.link_words[keep]
+        self.ac_logprobs = self.ac_logprobs[keep]
+        self.lm_logprobs = self.lm_logprobs[keep]
+        if self.transitions is not None:
+            self.transitions = [transitions for transitions, kept
+                                in zip(self.transitions, keep) if kept]
+        self.node_times = self.node_times[kept_nodes]
+        self.node_finals = self.node_finals[kept_nodes]
+        self.initial_node_id = int(node_ids[self.initial_node_id])
+        self._best_logprobs = None
+        self._word_to_links = None
+
+    @staticmethod
+    def _get_logprob(logprobs, link_id):
+        """Reads a log probability from a score array.
+
+        :type logprobs: numpy.ndarray
+        :param logprobs: acoustic or LM log probabilities
+
+        :type link_id: int
+        :param link_id: index of the link
+
+        :rtype: logprob_type
+        :returns: the log probability, or ``None`` if the lattice doesn't
+                  contain it
+        """
+
+        logprob = logprobs[link_id]
+        return None if numpy.isnan(logprob) else logprob_type(logprob)
+
+    @staticmethod
+    def _csr(adjacency):
+        """Converts adjacency lists into CSR form.
+
+        :type adjacency: list of lists of ints
+        :param adjacency: link IDs for each node
+
+        :rtype: tuple of two numpy.ndarrays
+        :returns: the offsets where the links of each node start, and the
+                  concatenated link IDs
+        """
+
+        offsets = numpy.zeros(len(adjacency) + 1, dtype='int32')
+        offsets[1:] = numpy.cumsum([len(link_ids) for link_ids in adjacency])
+        link_ids = numpy.fromiter((link_id
+                                   for node_link_ids in adjacency
+                                   for link_id in node_link_ids),
+                                  dtype='int32', count=offsets[-1])
+        return offsets, link_ids
+
+    @staticmethod
+    def _offsets(node_ids, num_nodes):
+        """Computes the CSR offsets from the node of each link.
+
+        :type node_ids: numpy.ndarray
+        :param node_ids: start or end node of each link
+
+        :type num_nodes: int
+        :param num_nodes: number of nodes in the lattice
+
+        :rtype: numpy.ndarray
+        :returns: the offsets where the links of each node start
+        """
+
+        offsets = numpy.zeros(num_nodes + 1, dtype='int32')
+        offsets[1:] = numpy.cumsum(numpy.bincount(node_ids,
+                                                  minlength=num_nodes))
+        return offsets
@@ -0,0 +1,197 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""A module that implements the HistoryCache class used by the lattice decoder.
+"""
+
+from collections import OrderedDict
+
+# Approximate number of bytes used by one cached log probability, including the
+# dictionary overhead.
+_LOGPROB_SIZE = 100
+
+class HistoryCache(object):
+    """Cache of Neural Network Outputs by Word History
+
+    Maps a word history to the state of the recurrent layers after the history,
+    the inputs of the output layer, and the log probabilities of the words that
+    have been predicted after the history. Tokens that reach the same history
+    through different paths in a lattice can reuse these instead of running the
+    network again.
+
+    The amount of memory used by the cached arrays is tracked. The recurrent
+    states are stored in the state pool of the decoder, so the cache only
+    keeps their indices. When it exceeds
+    the given limit, the least recently used histories are evicted.
+    """
+
+    class Entry(object):
+        """Cached Outputs of One Word History
+        """
+        __slots__ = ("hidden", "state", "logprobs", "size", "cached")
+
+        def __init__(self, hidden, state):
+            """Constructs a cache entry with no log probabilities.
+
+            :type hidden: list of numpy.ndarrays
+            :param hidden: the inputs of the output layer after the history
+
+            :type state: int
+            :param state: index of the state of the recurrent layers after the
+                          history in the state pool of the decoder
+            """
+
+            self.hidden = hidden
+            self.state = state
+            self.logprobs = dict()
+            self.size = sum(x.nbytes for x in hidden)
+            self.cached = True
+
+    def __init__(self, max_size=None):
+        """Constructs an empty cache.
+
+        :type max_size: int
+        :param max_size: maximum number of bytes used by the cache, or ``None``
+                         for no limit
+        """
+
+        self._max_size = max_size
+        self._entries = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.logprob_hits = 0
+        self.logprob_misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        """Returns the number of word histories in the cache.
+
+        :rtype: int
+        :returns: the number of cached histories
+        """
+
+        return len(self._entries)
+
+    def entries(self):
+        """Returns the cached entries.
+
+        :rtype: iterable of HistoryCache.Entries
+        :returns: the entries in the order from least to most recently used
+        """
+
+        return self._entries.values()
+
+    def clear(self):
+        """Removes all the entries and resets the statistics.
+        """
+
+        for entry in self._entries.values():
+            entry.cached = False
+        self._entries.clear()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.logprob_hits = 0
+        self.logprob_misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        """Returns the entry of a word history and marks it as recently used.
+
+        :type key: hashable
+        :param key: identifies the word history
+
+        :rtype: HistoryCache.Entry
+        :returns: the cached entry, or ``None`` if the history is not in the
+                  cache
+        """
+
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+            self._entries.move_to_end(key)
+        return entry
+
+    def add(self, key, hidden, state):
+        """Adds a word history to the cache.
+
+        :type key: hashable
+        :param key: identifies the word history
+
+        :type hidden: list of numpy.ndarrays
+        :param hidden: the inputs of the output layer after the history
+
+        :type state: int
+        :param state: index of the state of the recurrent layers after the
+                      history in the state pool of the decoder
+
+        :rtype: HistoryCache.Entry
+        :returns: the new entry
+        """
+
+        entry = self.Entry(hidden, state)
+        old_entry = self._entries.pop(key, None)
+        if old_entry is not None:
+            self.size -= old_entry.size
+            old_entry.cached = False
+        self._entries[key] = entry
+        self.size += entry.size
+        self._evict()
+        return entry
+
+    def get_logprob(self, entry, class_id):
+        """Returns the log probability of a class after the history of an
+        entry.
+
+        :type entry: HistoryCache.Entry
+        :param entry: an entry returned by ``get()`` or ``add()``
+
+        :type class_id: int
+        :param class_id: ID of the predicted class
+
+        :rtype: float
+        :returns: the cached log probability, or ``None`` if it has not been
+                  computed
+        """
+
+        result = entry.logprobs.get(class_id)
+        if result is None:
+            self.logprob_misses += 1
+        else:
+            self.logprob_hits += 1
+        return result
+
+    def add_logprob(self, entry, class_id, logprob):
+        """Saves the log probability of a class after the history of an entry.
+
+        :type entry: HistoryCache.Entry
+        :param entry: an entry returned by ``get()`` or ``add()``
+
+        :type class_id: int
+        :param class_id: ID of the predicted class
+
+        :type logprob: float
+        :param logprob: the log probability predicted by the network
+        """
+
+        if class_id not in entry.logprobs:
+            entry.size += _LOGPROB_SIZE
+            if entry.cached:
+                self.size += _LOGPROB_SIZE
+        entry.logprobs[class_id] = logprob
+        self._evict()
+
+    def _evict(self):
+        """Removes the least recently used entries until the cache fits in the
+        memory limit.
+        """
+
+        if self._max_size is None:
+            return
+        while self.size > self._max_size and self._entries:
+            _, entry = self._entries.popitem(last=False)
+            self.size -= entry.size
+            entry.cached = False
+            self.evictions += 1
@@ -5,6 +5,8 @@
 
 import logging
 
+import numpy
+
 from theanolm.backend import InputError
 
 class NodeNotFoundError(Exception):
@@ -205,6 +207,255 @@ class Lattice(object):
 
         return result
 
+    def prune(self, beam=None, min_posterior=None, lm_scale=1.0,
+              wi_penalty=0.0):
+        """Removes the links that are unlikely to be part of the best path,
+        using only the scores in the lattice.
+
+        Performs a forward-backward pass over the lattice, computing both the
+        best (Viterbi) and the total (sum over paths) log probability of the
+        partial paths that start from the initial node and that end in a final
+        node. The score of a link is the acoustic log probability plus the
+        scaled LM log probability, plus the word insertion penalty if the link
+        contains a word. The posterior probabilities are computed from the
+        scores divided by the LM scale, as is customary in speech recognition.
+
+        A link is removed if the best path through the link is more than
+        ``beam`` worse than the best path through the lattice, or if the
+        posterior probability of the link is less than ``min_posterior``. Links
+        that are not part of any complete path are always removed, while the
+        links of the best path are always kept. Finally the nodes without links
+        are removed, and the nodes are renumbered, so that the node IDs still
+        correspond to their position in the node list.
+
+        :type beam: float
+        :param beam: prune links whose best path is at least this much worse
+                     than the best path through the lattice, or ``None`` for no
+                     beam pruning
+
+        :type min_posterior: float
+        :param min_posterior: prune links whose posterior probability is less
+                              than this, or ``None`` for no posterior pruning
+
+        :type lm_scale: float
+        :param lm_scale: scale LM log probabilities by this factor (must be
+                         positive for posterior pruning)
+
+        :type wi_penalty: float
+        :param wi_penalty: add this to the log probability of every word
+
+        :rtype: int
+        :returns: the number of links removed
+        """
+
+        sorted_nodes = self.sorted_nodes()
+        link_scores = self._link_scores(lm_scale, wi_penalty)
+        if min_posterior is None:
+            # The total log probabilities are not needed.
+            posterior_scale = 1.0
+        elif lm_scale > 0.0:
+            posterior_scale = 1.0 / lm_scale
+        else:
+            raise InputError("Posterior pruning requires a positive LM scale "
+                             "(got {}).".format(lm_scale))
+
+        num_nodes = len(self.nodes)
+        forward_best = numpy.full(num_nodes, -numpy.inf)
+        forward_total = numpy.full(num_nodes, -numpy.inf)
+        best_in_links = [None] * num_nodes
+        forward_best[self.initial_node.id] = 0.0
+        forward_total[self.initial_node.id] = 0.0
+        for node in sorted_nodes:
+            for link in node.out_links:
+                score = link_scores[link]
+                end_id = link.end_node.id
+                best = forward_best[node.id] + score
+                if best > forward_best[end_id]:
+                    forward_best[end_id] = best
+                    best_in_links[end_id] = link
+                forward_total[end_id] = numpy.logaddexp(
+                    forward_total[end_id],
+                    forward_total[node.id] + score * posterior_scale)
+
+        backward_best = self._backward_best_logprobs(sorted_nodes,
+                                                     link_scores)
+        backward_total = numpy.full(num_nodes, -numpy.inf)
+        for node in reversed(sorted_nodes):
+            if node.final:
+                backward_total[node.id] = 0.0
+            for link in node.out_links:
+                score = link_scores[link]
+                end_id = link.end_node.id
+                backward_total[node.id] = numpy.logaddexp(
+                    backward_total[node.id],
+                    backward_total[end_id] + score * posterior_scale)
+
+        final_ids = [node.id for node in sorted_nodes if node.final]
+        if not final_ids:
+            raise InputError("Could not reach a final node of word lattice.")
+        best_final_id = max(final_ids, key=lambda x: forward_best[x])
+        best_logprob = forward_best[best_final_id]
+        total_logprob = numpy.logaddexp.reduce(forward_total[final_ids])
+        if best_logprob == -numpy.inf:
+            raise InputError("Could not reach a final node of word lattice.")
+
+        keep = set()
+        for link in self.links:
+            start_id = link.start_node.id
+            end_id = link.end_node.id
+            logprob = forward_best[start_id] + link_scores[link] + \
+                      backward_best[end_id]
+            if logprob == -numpy.inf:
+                continue
+            if (beam is not None) and (logprob < best_logprob - beam):
+                continue
+            if min_posterior is not None:
+                log_posterior = forward_total[start_id] + \
+                                link_scores[link] * posterior_scale + \
+                                backward_total[end_id] - total_logprob
+                if log_posterior < numpy.log(min_posterior):
+                    continue
+            keep.add(link)
+
+        # Make sure that the best path is not broken.
+        link = best_in_links[best_final_id]
+        while link is not None:
+            keep.add(link)
+            link = best_in_links[link.start_node.id]
+
+        # Removing links may leave other links without a complete path. Keep
+        # only the links whose start node can be reached from the initial node
+        # and whose end node leads to a final node using the kept links.
+        reachable = numpy.zeros(num_nodes, dtype=bool)
+        reachable[self.initial_node.id] = True
+        for node in sorted_nodes:
+            if reachable[node.id]:
+                for link in node.out_links:
+                    if link in keep:
+                        reachable[link.end_node.id] = True
+        leads_to_final = numpy.zeros(num_nodes, dtype=bool)
+        for node in reversed(sorted_nodes):
+            if node.final:
+                leads_to_final[node.id] = True
+            for link in node.out_links:
+                if (link in keep) and leads_to_final[link.end_node.id]:
+                    leads_to_final[node.id] = True
+        keep = set(link for link in keep
+                   if reachable[link.start_node.id] and
+                   leads_to_final[link.end_node.id])
+
+        num_removed = len(self.links) - len(keep)
+        self.links = [link for link in self.links if link in keep]
+        kept_nodes = []
+        for node in self.nodes:
+            node.in_links = [link for link in node.in_links if link in keep]
+            node.out_links = [link for link in node.out_links if link in keep]
+            if node.in_links or node.out_links or \
+               (node is self.initial_node):
+                node.id = len(kept_nodes)
+                kept_nodes.append(node)
+        logging.debug("Pruned lattice from %d to %d nodes and from %d to %d "
+                      "links.", len(self.nodes), len(kept_nodes),
+                      len(self.links) + num_removed, len(self.links))
+        self.nodes = kept_nodes
+        return num_removed
+
+    def lookahead_logprobs(self, lm_scale=1.0, wi_penalty=0.0):
+        """Computes the best log probability from each node to a final node,
+        using only the scores in the lattice.
+
+        Performs a backward Viterbi pass over the lattice. The score of a link
+        is the acoustic log probability plus the scaled LM log probability,
+        plus the word insertion penalty if the link contains a word.
+
+        :type lm_scale: float
+        :param lm_scale: scale LM log probabilities by this factor
+
+        :type wi_penalty: float
+        :param wi_penalty: add this to the log probability of every word
+
+        :rtype: numpy.ndarray
+        :returns: an array indexed by node ID that contains the best log
+                  probability of the remaining path, or -inf for the nodes
+                  that cannot reach a final node
+        """
+
+        return self._backward_best_logprobs(
+            self.sorted_nodes(), self._link_scores(lm_scale, wi_penalty))
+
+    def link_lists(self):
+        """Returns the outgoing links of the nodes and the attributes of the
+        links in lists that are indexed by node and link ID.
+
+        The link ID is the index of the link in ``links``. The decoder reads the
+        lattice through these lists, so that it doesn't have to follow the
+        object references in its inner loops.
+
+        :rtype: tuple of five lists
+        :returns: the IDs of the outgoing links of each node, and the end node
+                  ID, word, acoustic log probability, and LM log probability of
+                  each link (``None`` for null links and missing scores)
+        """
+
+        link_ids = {link: link_id for link_id, link in enumerate(self.links)}
+        out_links = [[link_ids[link] for link in node.out_links]
+                     for node in self.nodes]
+        link_ends = [link.end_node.id for link in self.links]
+        link_words = [link.word for link in self.links]
+        ac_logprobs = [link.ac_logprob for link in self.links]
+        lm_logprobs = [link.lm_logprob for link in self.links]
+        return out_links, link_ends, link_words, ac_logprobs, lm_logprobs
+
+    def _link_scores(self, lm_scale, wi_penalty):
+        """Computes the log probability of every link using the scores in the
+        lattice.
+
+        :type lm_scale: float
+        :param lm_scale: scale LM log probabilities by this factor
+
+        :type wi_penalty: float
+        :param wi_penalty: add this to the log probability of every word
+
+        :rtype: dict
+        :returns: a mapping from links to their log probabilities
+        """
+
+        result = dict()
+        for link in self.links:
+            score = 0.0
+            if link.ac_logprob is not None:
+                score += link.ac_logprob
+            if link.lm_logprob is not None:
+                score += link.lm_logprob * lm_scale
+            if link.word is not None:
+                score += wi_penalty
+            result[link] = score
+        return result
+
+    def _backward_best_logprobs(self, sorted_nodes, link_scores):
+        """Computes the best log probability from each node to a final node.
+
+        :type sorted_nodes: list of Nodes
+        :param sorted_nodes: the nodes in topological order
+
+        :type link_scores: dict
+        :param link_scores: a mapping from links to their log probabilities
+
+        :rtype: numpy.ndarray
+        :returns: an array indexed by node ID that contains the best log
+                  probability of the remaining path
+        """
+
+        result = numpy.full(len(self.nodes), -numpy.inf)
+        for node in reversed(sorted_nodes):
+            if node.final:
+                result[node.id] = 0.0
+            for link in node.out_links:
+                result[node.id] = max(
+                    result[node.id],
+                    result[link.end_node.id] + link_scores[link])
+        return result
+
     def _add_link(self, start_node, end_node):
         """Adds a link between two nodes.
 
@@ -3,15 +3,23 @@
 """A module that implements the "theanolm decode" command.
 """
 
+import io
 import logging
+import multiprocessing
+import queue
+import threading
 
-from theanolm.backend import TextFileType
+from theanolm.backend import TextFileType, InputError
 from theanolm.scoring.slflattice import SLFLattice
 from theanolm.scoring.kaldilattice import KaldiLattice, read_kaldi_vocabulary
+from theanolm.scoring.lattice import Lattice
+from theanolm.scoring.csrlattice import CSRLattice
+from theanolm.scoring.latticecache import LatticeCache
 
 class LatticeBatch(object):
     def __init__(self, lattices, lattice_list_file, lattice_format,
-                 kaldi_vocabulary=None, num_jobs=1, job_id=0):
+                 kaldi_vocabulary=None, num_jobs=1, job_id=0, compact=False,
+                 cache_dir=None, prefetch=0):
         """Reads the Kaldi word ID mapping, if given, and slices the lattices
         corresponding to the given job ID.
 
@@ -38,6 +46,23 @@ class LatticeBatch(object):
         :type job_id: int
         :param job_id: a number between ``0`` and ``num_jobs - 1``; select the
                        lattices corresponding to this job
+
+        :type compact: bool
+        :param compact: if set to ``True``, converts the lattices into
+                        ``CSRLattice`` objects after reading
+
+        :type cache_dir: str
+        :param cache_dir: if not ``None``, reads the lattices from binary
+                          archives in this directory, if they are up to date
+                          and were written using the same lattice format and
+                          Kaldi vocabulary, and writes the archives of the
+                          other lattice files while parsing them (the lattices
+                          will be ``CSRLattice`` objects)
+
+        :type prefetch: int
+        :param prefetch: if greater than zero, the iterator reads and parses
+                         the lattices in the background, at most this many
+                         lattices ahead
         """
 
         # Read Kaldi word ID mapping.
@@ -53,6 +78,15 @@ class LatticeBatch(object):
             raise ValueError("Invalid lattice format specified ({})."
                              .format(lattice_format))
         self._lattice_format = lattice_format
+        self._compact = compact
+        if cache_dir is None:
+            self._cache = None
+        else:
+            fingerprint = LatticeCache.fingerprint(
+                lattice_format,
+                self.kaldi_id_to_word if lattice_format == 'kaldi' else None)
+            self._cache = LatticeCache(cache_dir, fingerprint)
+        self._prefetch = prefetch
 
         # Combine paths from command line and lattice list.
         if lattice_list_file is not None:
@@ -74,31 +108,222 @@ class LatticeBatch(object):
 
     def __iter__(self):
         """A generator for iterating through the lattices of this job.
+
+        If prefetching is enabled, the lattices are read and parsed in the
+        background and passed through a bounded queue, so that parsing the next
+        lattices overlaps with processing the current one. Compact lattices are
+        parsed in a separate process, since they are cheap to transfer between
+        processes. Other lattices are parsed in a thread, which can only
+        overlap with the parts of the processing that release the global
+        interpreter lock, such as reading and decompressing the files and
+        numerical computation.
         """
 
-        file_type = TextFileType('r')
+        if self._prefetch < 1:
+            for source in self.sources():
+                yield self.read_lattice(source)
+            return
+
+        stop_event = threading.Event()
+        if self._compact or (self._cache is not None):
+            context = multiprocessing.get_context('fork')
+            lattice_queue = context.Queue(self._prefetch)
+            worker = context.Process(target=self._prefetch_worker,
+                                     args=(lattice_queue, stop_event),
+                                     daemon=True)
+        else:
+            lattice_queue = queue.Queue(self._prefetch)
+            worker = threading.Thread(target=self._prefetch_worker,
+                                      args=(lattice_queue, stop_event),
+                                      daemon=True)
+        worker.start()
+        try:
+            while True:
+                lattice, exception = lattice_queue.get()
+                if exception is not None:
+                    raise exception
+                if lattice is None:
+                    break
+                yield lattice
+        finally:
+            stop_event.set()
+            if isinstance(worker, threading.Thread):
+                worker.join()
+            else:
+                worker.terminate()
+                worker.join()
+
+    def sources(self):
+        """A generator for iterating through the lattices of this job without
+        parsing them.
+
+        The lattice files are read in this process, but the text can be parsed
+        later, possibly in another process, by calling ``read_lattice()``. If a
+        cache directory is used, the lattices are parsed in this process.
+
+        :rtype: generator
+        :returns: for SLF lattices, the content of one lattice file as a
+                  ``str``; for Kaldi lattices, a list of the lines of one
+                  lattice; or a ``CSRLattice`` if the lattice was read from the
+                  cache
+        """
 
         for path in self._lattices:
-            logging.info("Reading lattice file `%s´.", path)
-            lattice_file = file_type(path)
+            if (self._cache is None) or (path == '-'):
+                yield from self._file_sources(path)
+                continue
+
+            reader = self._cache.load(path)
+            if reader is not None:
+                logging.info("Reading %d lattices of `%s´ from cache.",
+                             len(reader), path)
+                try:
+                    yield from reader
+                finally:
+                    reader.close()
+                continue
+
+            # The lattices are written to the archive one at a time, so that
+            # the lattices of a large file don't have to fit in memory.
+            with self._cache.writer(path) as writer:
+                for source in self._file_sources(path):
+                    lattice = self._parse_lattice(source)
+                    if not isinstance(lattice, CSRLattice):
+                        lattice = CSRLattice(lattice)
+                    writer.write(lattice)
+                    yield lattice
+
+    def _prefetch_worker(self, lattice_queue, stop_event):
+        """Reads and parses the lattices and puts them in a queue.
+
+        Each item in the queue is a tuple of a lattice and an exception. After
+        the last lattice, ``(None, None)`` is put in the queue. If an error
+        occurs, the exception is put in the queue and the worker stops.
+
+        :type lattice_queue: queue.Queue or multiprocessing.Queue
+        :param lattice_queue: a bounded queue for the parsed lattices
+
+        :type stop_event: threading.Event
+        :param stop_event: when running in a thread, the consumer sets this
+                           event to stop the worker
+        """
+
+        def put(item):
+            while not stop_event.is_set():
+                try:
+                    lattice_queue.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        try:
+            for source in self.sources():
+                if not put((self.read_lattice(source), None)):
+                    return
+            put((None, None))
+        except Exception as e:
+            put((None, e))
+
+    def read_lattice(self, source):
+        """Parses a lattice generated by ``sources()``.
+
+        :type source: str, list of strs, or Lattice
+        :param source: text of an SLF lattice file, the lines of a Kaldi
+                       lattice, or a lattice that has already been parsed
+
+        :rtype: Lattice
+        :returns: the parsed lattice
+        """
+
+        if isinstance(source, Lattice):
+            return source
+        return self._parse_lattice(source)
+
+    def _file_sources(self, path):
+        """A generator for iterating through the lattices of one file without
+        parsing them.
+
+        :type path: str
+        :param path: path to a lattice file, or "-" for standard input
+
+        :rtype: generator
+        :returns: for SLF lattices, the content of the file as a ``str``; for
+                  Kaldi lattices, a list of the lines of each lattice
+        """
+
+        file_type = TextFileType('r')
+
+        logging.info("Reading lattice file `%s´.", path)
+        lattice_file = file_type(path)
+        try:
             if self._lattice_format == 'slf':
-                yield SLFLattice(lattice_file)
+                yield lattice_file.read()
             else:
                 assert self._lattice_format == 'kaldi'
-                lattice_lines = []
-                id_to_word = self.kaldi_id_to_word
-                while True:
-                    line = lattice_file.readline()
-                    if not line:
-                        # end of file
-                        if lattice_lines:
-                            yield KaldiLattice(lattice_lines, id_to_word)
-                        break
-                    line = line.strip()
-                    if not line:
-                        # empty line
-                        if lattice_lines:
-                            yield KaldiLattice(lattice_lines, id_to_word)
-                        lattice_lines = []
-                        continue
-                    lattice_lines.append(line)
+                yield from self._kaldi_sources(lattice_file, path)
+        finally:
+            if path != '-':
+                lattice_file.close()
+
+    def _kaldi_sources(self, lattice_file, path):
+        """A generator for iterating through the lattices of a Kaldi lattice
+        archive without parsing them.
+
+        The archive is streamed one line at a time, so that archives that
+        contain many utterances don't have to fit in memory.
+
+        :type lattice_file: file object
+        :param lattice_file: a Kaldi lattice archive in text format
+
+        :type path: str
+        :param path: path to the archive, for error messages
+
+        :rtype: generator
+        :returns: a list of the lines of each lattice
+        """
+
+        binary_error = InputError(
+            "Kaldi lattice archive `{}´ is not in text format. Binary archives "
+            "can be converted to text using \"lattice-copy ark:{} ark,t:-\"."
+            .format(path, path))
+
+        lattice_lines = []
+        try:
+            for line in lattice_file:
+                line = line.strip()
+                if not line:
+                    # empty line
+                    if lattice_lines:
+                        yield lattice_lines
+                    lattice_lines = []
+                    continue
+                # In binary archives the utterance ID is followed by "\0B".
+                if (not lattice_lines) and ('\0' in line):
+                    raise binary_error
+                lattice_lines.append(line)
+        except UnicodeDecodeError:
+            raise binary_error
+        # end of file
+        if lattice_lines:
+            yield lattice_lines
+
+    def _parse_lattice(self, source):
+        """Parses the text of a lattice.
+
+        :type source: str or list of strs
+        :param source: text of an SLF lattice file, or the lines of a Kaldi
+                       lattice
+
+        :rtype: Lattice
+        :returns: the parsed lattice
+        """
+
+        if self._lattice_format == 'slf':
+            lattice = SLFLattice(io.StringIO(source))
+        else:
+            assert self._lattice_format == 'kaldi'
+            lattice = KaldiLattice(source, self.kaldi_id_to_word)
+        if self._compact:
+            lattice = CSRLattice(lattice)
+        return lattice
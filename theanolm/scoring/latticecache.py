@@ -0,0 +1,364 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""A module that implements a binary lattice archive format and the
+LatticeCache class.
+"""
+
+import hashlib
+import logging
+import os
+import zipfile
+from contextlib import contextmanager
+
+import numpy
+
+from theanolm.backend import InputError
+from theanolm.scoring.csrlattice import CSRLattice
+
+ARCHIVE_VERSION = 2
+
+class LatticeArchiveWriter(object):
+    """Binary Lattice Archive Writer
+
+    The archive is an uncompressed ZIP file of NumPy arrays, which can be read
+    using ``numpy.load()`` like an ``.npz`` file. The arrays of each lattice are
+    written as soon as the lattice is given, so the lattices of a large file
+    don't have to be kept in memory. The words of all the lattices are mapped
+    to IDs in a vocabulary that is written after the lattices, when the archive
+    is closed.
+    """
+
+    def __init__(self, archive_file, fingerprint=""):
+        """Starts writing an archive.
+
+        :type archive_file: str or file object
+        :param archive_file: path or a file where the archive will be written
+
+        :type fingerprint: str
+        :param fingerprint: identifies the lattice format and the vocabulary
+                            that the lattices were read with
+        """
+
+        self._zip_file = zipfile.ZipFile(archive_file, mode='w',
+                                         compression=zipfile.ZIP_STORED,
+                                         allowZip64=True)
+        self._fingerprint = fingerprint
+        self._words = []
+        self._word_ids = dict()
+        self._num_lattices = 0
+
+    def write(self, lattice):
+        """Writes a lattice into the archive.
+
+        :type lattice: CSRLattice
+        :param lattice: the lattice to be written
+        """
+
+        mapping = []
+        for word in lattice.words:
+            word_id = self._word_ids.get(word)
+            if word_id is None:
+                word_id = len(self._words)
+                self._word_ids[word] = word_id
+                self._words.append(word)
+            mapping.append(word_id)
+        mapping = numpy.array(mapping + [-1], dtype='int32')
+        # Index -1 refers to the last element, which maps null words to -1.
+        link_words = mapping[lattice.link_words]
+
+        arrays = {
+            'utterance_id': numpy.array(
+                [] if lattice.utterance_id is None
+                else [lattice.utterance_id], dtype=str),
+            'lm_scale': numpy.array(
+                [numpy.nan if lattice.lm_scale is None else lattice.lm_scale],
+                dtype='float64'),
+            'wi_penalty': numpy.array(
+                [numpy.nan if lattice.wi_penalty is None
+                 else lattice.wi_penalty], dtype='float64'),
+            'initial_node_id': numpy.array([lattice.initial_node_id],
+                                           dtype='int32'),
+            'node_times': lattice.node_times.astype('float64', copy=False),
+            'node_finals': lattice.node_finals.astype('bool', copy=False),
+            'out_offsets': lattice.out_offsets.astype('int32', copy=False),
+            'in_offsets': lattice.in_offsets.astype('int32', copy=False),
+            'out_link_ids': lattice.out_link_ids.astype('int32', copy=False),
+            'in_link_ids': lattice.in_link_ids.astype('int32', copy=False),
+            'link_starts': lattice.link_starts.astype('int32', copy=False),
+            'link_ends': lattice.link_ends.astype('int32', copy=False),
+            'link_words': link_words,
+            'ac_logprobs': lattice.ac_logprobs.astype('float32', copy=False),
+            'lm_logprobs': lattice.lm_logprobs.astype('float32', copy=False)
+        }
+        if lattice.transitions is not None:
+            arrays['transitions'] = numpy.array(lattice.transitions, dtype=str)
+
+        prefix = 'lattice{}/'.format(self._num_lattices)
+        for name, array in arrays.items():
+            self._write_array(prefix + name, array)
+        self._num_lattices += 1
+
+    def close(self):
+        """Writes the vocabulary and the number of lattices, and closes the
+        archive.
+        """
+
+        self._write_array('version', numpy.array([ARCHIVE_VERSION]))
+        self._write_array('fingerprint',
+                          numpy.array([self._fingerprint], dtype=str))
+        self._write_array('num_lattices', numpy.array([self._num_lattices]))
+        self._write_array('words', numpy.array(self._words, dtype=str))
+        self._zip_file.close()
+
+    def _write_array(self, name, array):
+        """Writes an array into the archive in the NumPy ``.npy`` format.
+
+        :type name: str
+        :param name: name of the array in the archive
+
+        :type array: numpy.ndarray
+        :param array: the array to be written
+        """
+
+        with self._zip_file.open(name + '.npy', mode='w',
+                                 force_zip64=True) as array_file:
+            numpy.lib.format.write_array(array_file, array, allow_pickle=False)
+
+class LatticeArchiveReader(object):
+    """Binary Lattice Archive Reader
+
+    Reads the lattices of an archive written by ``LatticeArchiveWriter`` one at
+    a time, when iterating through the reader. The arrays of a lattice are
+    read only when the lattice is needed, and no parsing is needed. The
+    lattices share the vocabulary of the archive.
+    """
+
+    def __init__(self, archive_file):
+        """Opens an archive and reads the vocabulary.
+
+        :type archive_file: str or file object
+        :param archive_file: path or a file where the archive is read from
+        """
+
+        self._archive = numpy.load(archive_file)
+        try:
+            version = self._archive['version'][0]
+            if version != ARCHIVE_VERSION:
+                raise InputError("Unsupported lattice archive version {}."
+                                 .format(version))
+            self.fingerprint = str(self._archive['fingerprint'][0])
+            self._num_lattices = int(self._archive['num_lattices'][0])
+            self._words = self._archive['words'].tolist()
+        except Exception:
+            self._archive.close()
+            raise
+
+    def __len__(self):
+        """Returns the number of lattices in the archive.
+
+        :rtype: int
+        :returns: the number of lattices
+        """
+
+        return self._num_lattices
+
+    def __iter__(self):
+        """A generator for iterating through the lattices of the archive.
+
+        :rtype: generator
+        :returns: the lattices as ``CSRLattice`` objects
+        """
+
+        archive = self._archive
+        for index in range(self._num_lattices):
+            prefix = 'lattice{}/'.format(index)
+            lattice = CSRLattice(None)
+            utterance_id = archive[prefix + 'utterance_id']
+            if len(utterance_id) > 0:
+                lattice.utterance_id = str(utterance_id[0])
+            lm_scale = archive[prefix + 'lm_scale'][0]
+            lattice.lm_scale = None if numpy.isnan(lm_scale) else lm_scale
+            wi_penalty = archive[prefix + 'wi_penalty'][0]
+            lattice.wi_penalty = None if numpy.isnan(wi_penalty) \
+                                 else wi_penalty
+            lattice.initial_node_id = \
+                int(archive[prefix + 'initial_node_id'][0])
+            lattice.words = self._words
+            for name in ['node_times', 'node_finals', 'out_offsets',
+                         'in_offsets', 'out_link_ids', 'in_link_ids',
+                         'link_starts', 'link_ends', 'link_words',
+                         'ac_logprobs', 'lm_logprobs']:
+                setattr(lattice, name, archive[prefix + name])
+            if prefix + 'transitions' in archive:
+                lattice.transitions = \
+                    archive[prefix + 'transitions'].tolist()
+            yield lattice
+
+    def close(self):
+        """Closes the archive file.
+        """
+
+        self._archive.close()
+
+def write_lattice_archive(lattices, archive_file, fingerprint=""):
+    """Writes lattices into a binary archive.
+
+    :type lattices: iterable of CSRLattices
+    :param lattices: the lattices to be written
+
+    :type archive_file: str or file object
+    :param archive_file: path or a file where the archive will be written
+
+    :type fingerprint: str
+    :param fingerprint: identifies the lattice format and the vocabulary that
+                        the lattices were read with
+    """
+
+    writer = LatticeArchiveWriter(archive_file, fingerprint)
+    for lattice in lattices:
+        writer.write(lattice)
+    writer.close()
+
+def read_lattice_archive(archive_file):
+    """Reads all the lattices from a binary archive written by
+    ``write_lattice_archive()``.
+
+    :type archive_file: str or file object
+    :param archive_file: path or a file where the archive is read from
+
+    :rtype: list of CSRLattices
+    :returns: the lattices in the archive
+    """
+
+    reader = LatticeArchiveReader(archive_file)
+    try:
+        return list(reader)
+    finally:
+        reader.close()
+
+class LatticeCache(object):
+    """Cache of Parsed Lattices
+
+    A directory that contains a binary lattice archive for each lattice file.
+    The lattices depend on the lattice format and, with Kaldi lattices, on the
+    vocabulary that maps the word IDs to words. The archive of a lattice file
+    is named by a hash of the absolute path of the file and a fingerprint that
+    identifies the format and the vocabulary. The fingerprint is also stored
+    in the archive. An archive is used only if it is newer than the lattice
+    file and its fingerprint matches.
+    """
+
+    def __init__(self, cache_dir, fingerprint=""):
+        """Creates the cache directory if it doesn't exist.
+
+        :type cache_dir: str
+        :param cache_dir: path to the cache directory
+
+        :type fingerprint: str
+        :param fingerprint: identifies the lattice format and the vocabulary
+                            that the lattices are read with (see
+                            ``fingerprint()``)
+        """
+
+        self._cache_dir = cache_dir
+        self._fingerprint = fingerprint
+        os.makedirs(cache_dir, exist_ok=True)
+
+    @staticmethod
+    def fingerprint(lattice_format, kaldi_id_to_word=None):
+        """Creates a fingerprint of the options that the lattices are read
+        with.
+
+        :type lattice_format: str
+        :param lattice_format: format of the lattice files, ``slf`` or ``kaldi``
+
+        :type kaldi_id_to_word: list of strs
+        :param kaldi_id_to_word: mapping from Kaldi word IDs to words, used only
+                                 with Kaldi lattices
+
+        :rtype: str
+        :returns: the lattice format, followed by a hash of the vocabulary with
+                  Kaldi lattices
+        """
+
+        if lattice_format != 'kaldi':
+            return lattice_format
+        vocabulary = '\n'.join('' if word is None else word
+                               for word in kaldi_id_to_word)
+        digest = hashlib.sha1(vocabulary.encode('utf-8')).hexdigest()
+        return '{} {}'.format(lattice_format, digest)
+
+    def archive_path(self, lattice_path):
+        """Returns the path to the archive of a lattice file.
+
+        :type lattice_path: str
+        :param lattice_path: path to a lattice file
+
+        :rtype: str
+        :returns: path to the archive in the cache directory
+        """
+
+        key = '{}\n{}'.format(os.path.abspath(lattice_path), self._fingerprint)
+        digest = hashlib.sha1(key.encode('utf-8')).hexdigest()
+        return os.path.join(self._cache_dir, digest + '.npz')
+
+    def load(self, lattice_path):
+        """Opens the archive of a lattice file from the cache.
+
+        :type lattice_path: str
+        :param lattice_path: path to a lattice file
+
+        :rtype: LatticeArchiveReader
+        :returns: a reader that iterates through the lattices of the file, or
+                  ``None`` if the file is not in the cache, the archive is
+                  older than the file, or the archive was written with a
+                  different fingerprint
+        """
+
+        archive_path = self.archive_path(lattice_path)
+        if not os.path.exists(archive_path):
+            return None
+        if os.path.getmtime(archive_path) < os.path.getmtime(lattice_path):
+            logging.debug("Lattice archive `%s´ is out of date.", archive_path)
+            return None
+        reader = LatticeArchiveReader(archive_path)
+        if reader.fingerprint != self._fingerprint:
+            reader.close()
+            logging.warning("Lattice archive `%s´ was written using a "
+                            "different lattice format or vocabulary. Not "
+                            "using it.", archive_path)
+            return None
+        logging.debug("Reading lattice archive `%s´.", archive_path)
+        return reader
+
+    @contextmanager
+    def writer(self, lattice_path):
+        """Creates a writer for the archive of a lattice file.
+
+        The lattices are given to the writer one at a time, while the file is
+        being parsed. The archive is first written to a temporary file, which
+        is renamed when the context is exited normally, so that other processes
+        never see a partially written archive. If an exception is raised, or
+        the lattices are not written to the end, the temporary file is removed.
+
+        :type lattice_path: str
+        :param lattice_path: path to the lattice file
+
+        :rtype: LatticeArchiveWriter
+        :returns: a writer that writes the lattices of the file
+        """
+
+        archive_path = self.archive_path(lattice_path)
+        temp_path = '{}.{}.tmp'.format(archive_path, os.getpid())
+        try:
+            with open(temp_path, 'wb') as archive_file:
+                writer = LatticeArchiveWriter(archive_file, self._fingerprint)
+                try:
+                    yield writer
+                finally:
+                    writer.close()
+        except BaseException:
+            os.remove(temp_path)
+            raise
+        os.replace(temp_path, archive_path)
+        logging.debug("Wrote lattice archive `%s´.", archive_path)
@@ -3,17 +3,21 @@
 """A module that implements the LatticeDecoder class.
 """
 
+from collections import OrderedDict
 import logging
 import math
 
 import numpy
 import theano
-from theano import tensor
 
 from theanolm.backend import InputError
 from theanolm.backend import interpolate_linear, interpolate_loglinear
 from theanolm.backend import logprob_type
-from theanolm.network import RecurrentState
+from theanolm.network import RecurrentState, StepPredictor
+from theanolm.scoring.bestlogprobindex import BestLogprobIndex
+from theanolm.scoring.historycache import HistoryCache
+from theanolm.scoring.statepool import StatePool
+from theanolm.scoring.wordhistory import WordHistory
 
 class LatticeDecoder(object):
     """Word Lattice Decoding Using a Neural Network Language Model
@@ -30,7 +34,7 @@ class LatticeDecoder(object):
                      "total_logprob")
 
         def __init__(self,
-                     history=(),
+                     history=None,
                      state=None,
                      ac_logprob=logprob_type(0.0),
                      lat_lm_logprob=logprob_type(0.0),
@@ -44,12 +48,13 @@ class LatticeDecoder(object):
             New tokens will not have recombination hash and total log
             probability set.
 
-            :type history: list of ints
-            :param history: word IDs that the token has passed
+            :type history: WordHistory or list of ints
+            :param history: word IDs that the token has passed; a sequence will
+                            be converted to a ``WordHistory``
 
-            :type state: RecurrentState
-            :param state: the state of the recurrent layers for a single
-                          sequence
+            :type state: int
+            :param state: index of the recurrent layer state of the token in
+                          the state pool of the decoder
 
             :type ac_logprob: logprob_type
             :param ac_logprob: sum of the acoustic log probabilities of the
@@ -64,7 +69,10 @@ class LatticeDecoder(object):
                                   lattice links
             """
 
-            self.history = history
+            if (history is None) or isinstance(history, WordHistory):
+                self.history = history
+            else:
+                self.history = WordHistory.from_words(history)
             self.state = [] if state is None else state
             self.ac_logprob = ac_logprob
             self.lat_lm_logprob = lat_lm_logprob
@@ -77,9 +85,10 @@ class LatticeDecoder(object):
         def copy(cls, token):
             """Creates a copy of a token.
 
-            The recurrent layer states will not be copied - a pointer will be
-            copied instead. There's no need to copy the structure, since we
-            never modify the state of a token, but replace it if necessary.
+            The recurrent layer states will not be copied - only the index to
+            the state pool will be copied. There's no need to copy the state,
+            since we never modify the state of a token, but replace it if
+            necessary.
 
             Recombination hash and total log probability will not be copied.
 
@@ -105,11 +114,8 @@ class LatticeDecoder(object):
                 recombining tokens, or ``None`` for the entire history
             """
 
-            if recombination_order is None:
-                limited_history = self.history
-            else:
-                limited_history = self.history[-recombination_order:]
-            self.recombination_hash = hash(limited_history)
+            self.recombination_hash = \
+                self.history.window_hash(recombination_order)
 
         def recompute_total(self, nn_lm_weight, lm_scale, wi_penalty,
                             linear=False):
@@ -166,7 +172,7 @@ class LatticeDecoder(object):
 
             return [vocabulary.id_to_word[word] if isinstance(word, int)
                     else word
-                    for word in self.history]
+                    for word in self.history.words()]
 
         def __str__(self, vocabulary=None):
             """Creates a string representation of the token.
@@ -180,7 +186,7 @@ class LatticeDecoder(object):
             """
 
             if vocabulary is None:
-                history = ' '.join(str(x) for x in self.history)
+                history = ' '.join(str(x) for x in self.history.words())
             else:
                 history = ' '.join(self.history_words(vocabulary))
 
@@ -201,13 +207,16 @@ class LatticeDecoder(object):
                            self.total_logprob)
 
     def __init__(self, network, decoding_options, profile=False):
-        """Creates a Theano function that computes the output probabilities for
+        """Creates Theano functions that compute the output probabilities for
         a single time step.
 
-        Creates the function self._step_function that takes as input a set of
-        word sequences and the current recurrent states. It uses the previous
-        states and word IDs to compute the output distributions, and computes
-        the probabilities of the target words.
+        Creates ``self._step_predictor`` that provides two functions. The first
+        one takes as input a set of word sequences and the current recurrent
+        states, and computes the new states and the input of the output layer.
+        The second one computes the probabilities of the target words from the
+        output layer input. This way the recurrent state of a token is updated
+        only once, even if the token is propagated to several links. The
+        recurrent states of the tokens are stored in ``self._state_pool``.
 
         All invocations of ``decode()`` will use the given NNLM weight and LM
         scale when computing the total probability. If LM scale is not given,
@@ -251,6 +260,10 @@ class LatticeDecoder(object):
           if set to other than None, prune tokens whose total log probability is
           further than this from the best token at each point in time
 
+        max_active_tokens : int
+          if set to other than None, limit the total number of tokens in the
+          nodes that have received tokens but have not been processed yet
+
         recombination_order : int
           number of words to consider when deciding whether two tokens should be
           recombined, or ``None`` for the entire word history
@@ -268,6 +281,41 @@ class LatticeDecoder(object):
           when using prune_extra_limit, this is the minimum that the maximum
           number of tokens will be adjusted to
 
+        cache_size : float
+          if set to other than None, caches the recurrent states and NNLM log
+          probabilities of the word histories (truncated to the recombination
+          order) within a lattice, using at most this many megabytes of memory
+
+        lookahead : bool
+          if set to True, beam pruning compares the total log probability of
+          a token plus the best log probability from the node to the end of the
+          lattice (according to the scores in the lattice) to the best such
+          estimate
+
+        batch_nodes : bool
+          if set to True, propagates the tokens of all the nodes that are ready
+          at the same time frame (or at the same topological wavefront, if the
+          nodes have no time stamps) with a single call to the neural network
+
+        pre_prune_beam : float
+          if set to other than None, prune the lattice before decoding by
+          removing the links whose best path, according to the scores in the
+          lattice, is further than this from the best path
+
+        pre_prune_posterior : float
+          if set to other than None, prune the lattice before decoding by
+          removing the links whose posterior probability, according to the
+          scores in the lattice, is less than this
+
+        sweep_settings : list of tuples
+          if set to other than None, the final tokens will be ranked using each
+          of these combinations of NNLM weight, LM scale, and word insertion
+          penalty (``None`` in place of the LM scale or the word insertion
+          penalty means that the value will be read from the lattice file);
+          recombination keeps every token that is the best of its group with
+          any of the settings, but pruning uses only the above parameters, so
+          it should be disabled when sweeping
+
         :type network: Network
         :param network: the neural network object
 
@@ -290,12 +338,27 @@ class LatticeDecoder(object):
         self._beam = decoding_options['beam']
         if self._beam is not None:
             self._beam = logprob_type(self._beam)
+        self._max_active_tokens = decoding_options.get('max_active_tokens',
+                                                       None)
         self._recombination_order = decoding_options['recombination_order']
         self._prune_extra_limit = decoding_options.get('prune_extra_limit', None)
         self._abs_min_beam = decoding_options.get('abs_min_beam', 0)
         self._abs_min_max_tokens = decoding_options.get('abs_min_max_tokens', 0)
         if self._prune_extra_limit is None:
             self._abs_min_beam = self._abs_min_max_tokens = 0
+        cache_size = decoding_options.get('cache_size', None)
+        if cache_size is None:
+            self._history_cache = None
+        else:
+            self._history_cache = HistoryCache(int(cache_size * 1024 * 1024))
+        self._batch_nodes = decoding_options.get('batch_nodes', False)
+        self._use_lookahead = decoding_options.get('lookahead', False)
+        self._lookahead_logprobs = None
+        self._pre_prune_beam = decoding_options.get('pre_prune_beam', None)
+        self._pre_prune_posterior = decoding_options.get('pre_prune_posterior',
+                                                         None)
+        self._sweep_settings = decoding_options.get('sweep_settings', None)
+        self._lattice_sweep_settings = []
 
         if decoding_options['use_shortlist'] and \
            self._vocabulary.has_unigram_probs():
@@ -308,23 +371,10 @@ class LatticeDecoder(object):
         self._eos_id = self._vocabulary.word_to_id['</s>']
         self._unk_id = self._vocabulary.word_to_id['<unk>']
 
-        inputs = [network.input_word_ids,
-                  network.input_class_ids,
-                  network.target_class_ids]
-        inputs.extend(network.recurrent_state_input)
-
-        outputs = [tensor.log(network.target_probs())]
-        outputs.extend(network.recurrent_state_output)
-
-        # Ignore unused input, because is_training is only used by dropout
-        # layer.
-        self._step_function = theano.function(
-            inputs,
-            outputs,
-            givens=[(network.is_training, numpy.int8(0))],
-            name='step_predictor',
-            profile=profile,
-            on_unused_input='ignore')
+        self._step_predictor = StepPredictor(network, profile)
+        self._state_pool = StatePool(network.recurrent_state_size)
+        self._tokens = []
+        self._set_lattice(None)
 
     def decode(self, lattice):
         """Propagates tokens through given lattice and returns a list of tokens
@@ -336,80 +386,197 @@ class LatticeDecoder(object):
         The function returns two lists. The first list contains the final
         tokens, sorted in the descending order of total log probability. I.e.
         the first token in the list represents the best path through the
-        lattice. The second list contains the tokens that were dropped during
-        recombination. This is needed for constructing a new rescored lattice.
+        lattice. The second list contains the histories and NNLM log
+        probabilities of the tokens that were dropped during recombination, and
+        of the tokens that were kept. This is needed for constructing a new
+        rescored lattice.
+
+        The recurrent states of the tokens in a node are released after the
+        tokens have been propagated to the outgoing links.
+
+        If pre-pruning is enabled, the links that are unlikely according to the
+        scores in the lattice are removed from the lattice before decoding.
+        This modifies ``lattice``.
 
         :type lattice: Lattice
         :param lattice: a word lattice to be decoded
 
-        :rtype: a tuple of two lists of LatticeDecoder.Tokens
+        :rtype: a tuple of two lists
         :returns: a list of the final tokens sorted by probability (most likely
-                  token first), and a list of the tokens that were dropped
-                  during recombination
+                  token first), and a list of tuples that describe the tokens
+                  that were dropped during recombination
         """
 
-        if self._lm_scale is not None:
-            lm_scale = logprob_type(self._lm_scale)
-        elif lattice.lm_scale is not None:
-            lm_scale = logprob_type(lattice.lm_scale)
-        else:
-            lm_scale = logprob_type(1.0)
-
-        if self._wi_penalty is not None:
-            wi_penalty = logprob_type(self._wi_penalty)
-        elif lattice.wi_penalty is not None:
-            wi_penalty = logprob_type(lattice.wi_penalty)
+        lm_scale, wi_penalty = self._lattice_settings(lattice, self._lm_scale,
+                                                      self._wi_penalty)
+        if self._sweep_settings is None:
+            self._lattice_sweep_settings = []
         else:
-            wi_penalty = logprob_type(0.0)
-
-        tokens = [list() for _ in lattice.nodes]
+            self._lattice_sweep_settings = [
+                (logprob_type(nnlm_weight),) +
+                self._lattice_settings(lattice, sweep_lm_scale,
+                                       sweep_wi_penalty)
+                for nnlm_weight, sweep_lm_scale, sweep_wi_penalty
+                in self._sweep_settings]
+
+        if (self._pre_prune_beam is not None) or \
+           (self._pre_prune_posterior is not None):
+            lattice.prune(self._pre_prune_beam, self._pre_prune_posterior,
+                          lm_scale, wi_penalty)
+
+        if self._history_cache is not None:
+            self._history_cache.clear()
+
+        self._state_pool.clear()
+        self._set_lattice(lattice)
+
+        tokens = [list() for _ in self._nodes]
+        self._tokens = tokens
         recomb_tokens = []
         initial_state = RecurrentState(self._network.recurrent_state_size)
-        initial_token = self.Token(history=(self._sos_id,), state=initial_state)
+        initial_state = int(self._state_pool.add(initial_state)[0])
+        initial_token = self.Token(history=WordHistory(self._sos_id),
+                                   state=initial_state)
         initial_token.recompute_hash(self._recombination_order)
         initial_token.recompute_total(self._nnlm_weight, lm_scale, wi_penalty,
                                       self._linear_interpolation)
         tokens[lattice.initial_node.id].append(initial_token)
-        lattice.initial_node.best_logprob = initial_token.total_logprob
+        for node in self._nodes:
+            node.best_logprob = None
+
+        if self._use_lookahead:
+            self._lookahead_logprobs = lattice.lookahead_logprobs(lm_scale,
+                                                                  wi_penalty)
+        else:
+            self._lookahead_logprobs = None
 
         sorted_nodes = lattice.sorted_nodes()
+        self._best_logprob_index = BestLogprobIndex(sorted_nodes)
+        self._update_best_logprob(lattice.initial_node,
+                                  initial_token.total_logprob)
         self._nodes_processed = 0
+        self._num_active_pruned = 0
+        active_node_ids = set()
         final_tokens = []
-        for node in sorted_nodes:
-            stats = self._prune(node, sorted_nodes, tokens, recomb_tokens)
-
-            num_new_tokens = 0
-            node_tokens = tokens[node.id]
-            assert node_tokens
-            if node.final:
-                new_tokens = self._propagate(
-                    node_tokens, None, lm_scale, wi_penalty)
-                final_tokens.extend(new_tokens)
-                num_new_tokens += len(new_tokens)
-            for link in node.out_links:
-                new_tokens = self._propagate(
-                    node_tokens, link, lm_scale, wi_penalty)
-                tokens[link.end_node.id].extend(new_tokens)
-                # If there are lots of tokens in the end node, prune already to
+        for nodes in self._node_batches(sorted_nodes):
+            all_stats = [self._prune(node, sorted_nodes, tokens, recomb_tokens)
+                         for node in nodes]
+
+            # All the outgoing links, and the end of sentence if this is a final
+            # node, are processed with a single call to the neural network.
+            batch_tokens = []
+            links = []
+            link_slices = []
+            link_nodes = []
+            for node_index, node in enumerate(nodes):
+                node_tokens = tokens[node.id]
+                assert node_tokens
+                node_slice = slice(len(batch_tokens),
+                                   len(batch_tokens) + len(node_tokens))
+                batch_tokens.extend(node_tokens)
+                node_links = [None] if node.final else []
+                node_links.extend(self._out_links[node.id])
+                links.extend(node_links)
+                link_slices.extend([node_slice] * len(node_links))
+                link_nodes.extend([node_index] * len(node_links))
+            link_tokens = self._propagate(batch_tokens, links, lm_scale,
+                                          wi_penalty, link_slices)
+
+            num_new_tokens = [0] * len(nodes)
+            for link_id, node_index, new_tokens in \
+                zip(links, link_nodes, link_tokens):
+                if link_id is None:
+                    # Final tokens don't need the recurrent state anymore.
+                    for token in new_tokens:
+                        token.state = None
+                    final_tokens.extend(new_tokens)
+                else:
+                    end_id = self._link_ends[link_id]
+                    tokens[end_id].extend(new_tokens)
+                    active_node_ids.add(end_id)
+                num_new_tokens[node_index] += len(new_tokens)
+            for node, stats, num_new in zip(nodes, all_stats, num_new_tokens):
+                # The tokens of this node have been propagated to all the
+                # outgoing links, so their states can be released.
+                tokens[node.id] = []
+                active_node_ids.discard(node.id)
+                # If there are lots of tokens in the end nodes, prune already to
                 # conserve memory.
-                if self._max_tokens_per_node is not None and \
-                   len(tokens[link.end_node.id]) > self._max_tokens_per_node * 2:
-                    self._prune(link.end_node, sorted_nodes, tokens, recomb_tokens)
-                num_new_tokens += len(new_tokens)
-            stats['new'] = num_new_tokens
-
-            self._nodes_processed += 1
-            self._log_stats(stats, node.id, len(sorted_nodes))
+                if self._max_tokens_per_node is not None:
+                    for link_id in self._out_links[node.id]:
+                        end_id = self._link_ends[link_id]
+                        if len(tokens[end_id]) > \
+                           self._max_tokens_per_node * 2:
+                            self._prune(self._nodes[end_id], sorted_nodes,
+                                        tokens, recomb_tokens)
+                stats['new'] = num_new
+
+                self._nodes_processed += 1
+                self._log_stats(stats, node.id, len(sorted_nodes))
+
+            if self._max_active_tokens is not None:
+                self._prune_active_tokens(tokens, active_node_ids)
+
+        if self._max_active_tokens is not None:
+            logging.debug("Active token limit pruned %d tokens.",
+                          self._num_active_pruned)
+        if self._history_cache is not None:
+            self._log_cache_stats()
+        self._tokens = []
+        self._set_lattice(None)
+        logging.info("Peak token state memory: %.1f MB (%d states)",
+                     self._state_pool.peak_num_states *
+                     self._state_pool.state_nbytes / (1024 * 1024),
+                     self._state_pool.peak_num_states)
 
         if len(final_tokens) == 0:
             raise InputError("Could not reach a final node of word lattice.")
 
         final_tokens = self._sorted_recombined_tokens(final_tokens,
                                                       recomb_tokens)
+        self._lattice_sweep_settings = []
         return final_tokens, recomb_tokens
 
-    def _propagate(self, tokens, link, lm_scale, wi_penalty):
-        """Propagates tokens to given link or to end of sentence.
+    @staticmethod
+    def _lattice_settings(lattice, lm_scale, wi_penalty):
+        """Selects the LM scale and the word insertion penalty that are used
+        to decode a lattice.
+
+        :type lattice: Lattice
+        :param lattice: the lattice to be decoded
+
+        :type lm_scale: float
+        :param lm_scale: the LM scale given in the decoding options, or ``None``
+                         to use the value in the lattice file, or 1.0 if the
+                         lattice doesn't specify it
+
+        :type wi_penalty: float
+        :param wi_penalty: the word insertion penalty given in the decoding
+                           options, or ``None`` to use the value in the lattice
+                           file, or 0.0 if the lattice doesn't specify it
+
+        :rtype: tuple of two logprob_types
+        :returns: the LM scale and the word insertion penalty
+        """
+
+        if lm_scale is not None:
+            lm_scale = logprob_type(lm_scale)
+        elif lattice.lm_scale is not None:
+            lm_scale = logprob_type(lattice.lm_scale)
+        else:
+            lm_scale = logprob_type(1.0)
+
+        if wi_penalty is not None:
+            wi_penalty = logprob_type(wi_penalty)
+        elif lattice.wi_penalty is not None:
+            wi_penalty = logprob_type(lattice.wi_penalty)
+        else:
+            wi_penalty = logprob_type(0.0)
+
+        return lm_scale, wi_penalty
+
+    def _propagate(self, tokens, links, lm_scale, wi_penalty, link_slices=None):
+        """Propagates tokens to given links and/or to end of sentence.
 
         Lattices may contain null nodes with word ``None`` that model e.g.
         silence or sentence start or end, or for example when the topology is
@@ -417,16 +584,30 @@ class LatticeDecoder(object):
         language model scores. Then the function will update the acoustic and
         lattice LM score, but will not compute anything with the neural network.
 
-        Also updates ``best_logprob`` of the end node, so that beam pruning
-        threshold can be obtained efficiently.
+        A copy of each token is created for every link. The recurrent state of
+        each input token is updated once, and the words of all the links are
+        scored against the updated state with a single call to the output
+        layer, so the number of network invocations does not grow with the
+        out-degree of the node. The scores of the new tokens are updated using
+        array operations over all the input tokens.
+
+        The tokens of several nodes can be propagated at once by giving the
+        range of input tokens that is propagated to each link. Then the network
+        is invoked once for all the nodes.
+
+        Also updates ``best_logprob`` of the end nodes and the best log
+        probability index, so that beam pruning threshold can be obtained
+        efficiently.
 
         :type tokens: list of LatticeDecoder.Tokens
         :param tokens: input tokens
 
-        :type link: Lattice.Link
-        :param link: if other than ``None``, propagates the tokens to this link;
-                     if ``None``, just updates the LM logprobs as if the tokens
-                     were propagated to an end of sentence
+        :type links: list of ints
+        :param links: propagates the tokens to each of these links, given by
+                      their IDs in the lattice that was given to
+                      ``_set_lattice()``; ``None`` in place of a link means that
+                      the LM logprobs will be updated as if the tokens were
+                      propagated to an end of sentence
 
         :type lm_scale: logprob_type
         :param lm_scale: scale language model log probabilities by this factor
@@ -435,43 +616,317 @@ class LatticeDecoder(object):
         :param wi_penalty: penalize word insertion by adding this value to the
                            total log probability of the token
 
-        :rtype: list of LatticeDecoder.Tokens
-        :returns: the propagated tokens
+        :type link_slices: list of slices
+        :param link_slices: if not ``None``, propagates only this range of
+                            ``tokens`` to each link
+
+        :rtype: list of lists of LatticeDecoder.Tokens
+        :returns: the propagated tokens for each link, in the same order as
+                  ``links``
         """
 
-        new_tokens = [self.Token.copy(token) for token in tokens]
+        if link_slices is None:
+            link_slices = [slice(0, len(tokens))] * len(links)
+
+        ac_logprobs = numpy.array([token.ac_logprob for token in tokens],
+                                  dtype=logprob_type)
+        lat_lm_logprobs = numpy.array([token.lat_lm_logprob
+                                       for token in tokens],
+                                      dtype=logprob_type)
+        nn_lm_logprobs = numpy.array([token.nn_lm_logprob for token in tokens],
+                                     dtype=logprob_type)
+        history_lengths = numpy.array([token.history.length
+                                       for token in tokens])
+
+        targets = []
+        target_slices = []
+        link_targets = []
+        for link_id, link_slice in zip(links, link_slices):
+            if link_id is None:
+                target = (self._eos_id, None)
+            else:
+                target = self._link_targets[link_id]
+            if target is None:
+                link_targets.append(None)
+            else:
+                link_targets.append(len(targets))
+                targets.append(target)
+                target_slices.append(link_slice)
 
-        if link is None:
-            self._append_word(new_tokens, self._eos_id)
-        else:
-            for token in new_tokens:
-                if link.ac_logprob is not None:
-                    token.ac_logprob += link.ac_logprob
-                if link.lm_logprob is not None:
-                    token.lat_lm_logprob += link.lm_logprob
-
-            if link.word is not None:
-                try:
-                    word = self._vocabulary.word_to_id[link.word]
-                except KeyError:
-                    word = link.word
-                if self._unk_from_lattice:
-                    self._append_word(new_tokens, word, link.lm_logprob)
-                elif self._unk_penalty is not None:
-                    self._append_word(new_tokens, word, self._unk_penalty)
-                else:
-                    self._append_word(new_tokens, word)
+        if targets:
+            target_logprobs, new_states = self._append_words(tokens, targets,
+                                                             target_slices)
 
-        for token in new_tokens:
-            token.recompute_hash(self._recombination_order)
-            token.recompute_total(self._nnlm_weight, lm_scale, wi_penalty,
-                                  self._linear_interpolation)
-            if link is not None and link.end_node is not None:
-                if (link.end_node.best_logprob is None) or \
-                   (token.total_logprob > link.end_node.best_logprob):
-                    link.end_node.best_logprob = token.total_logprob
+        result = []
+        for link_id, link_slice, target_index in \
+            zip(links, link_slices, link_targets):
+            link_tokens = tokens[link_slice]
+            link_ac_logprobs = ac_logprobs[link_slice]
+            link_lat_lm_logprobs = lat_lm_logprobs[link_slice]
+            if link_id is not None:
+                ac_logprob = self._link_ac_logprobs[link_id]
+                if ac_logprob is not None:
+                    link_ac_logprobs = link_ac_logprobs + ac_logprob
+                lm_logprob = self._link_lm_logprobs[link_id]
+                if lm_logprob is not None:
+                    link_lat_lm_logprobs = link_lat_lm_logprobs + lm_logprob
+
+            if target_index is None:
+                word = None
+                states = [token.state for token in link_tokens]
+                link_nn_lm_logprobs = nn_lm_logprobs[link_slice]
+                link_history_lengths = history_lengths[link_slice]
+            else:
+                word = targets[target_index][0]
+                states = new_states[link_slice]
+                link_nn_lm_logprobs = nn_lm_logprobs[link_slice] + \
+                    target_logprobs[target_index][link_slice]
+                link_history_lengths = history_lengths[link_slice] + 1
+
+            graph_logprobs, total_logprobs = self._compute_totals(
+                link_ac_logprobs, link_lat_lm_logprobs, link_nn_lm_logprobs,
+                link_history_lengths, lm_scale, wi_penalty)
+
+            new_tokens = []
+            for index, token in enumerate(link_tokens):
+                history = token.history
+                if word is not None:
+                    history = WordHistory(word, history)
+                new_token = self.Token(history,
+                                       states[index],
+                                       link_ac_logprobs[index],
+                                       link_lat_lm_logprobs[index],
+                                       link_nn_lm_logprobs[index])
+                new_token.recompute_hash(self._recombination_order)
+                new_token.graph_logprob = graph_logprobs[index]
+                new_token.total_logprob = total_logprobs[index]
+                new_tokens.append(new_token)
+            result.append(new_tokens)
+
+            if (link_id is not None) and link_tokens:
+                end_node = self._nodes[self._link_ends[link_id]]
+                best_logprob = total_logprobs.max()
+                if (end_node.best_logprob is None) or \
+                   (best_logprob > end_node.best_logprob):
+                    self._update_best_logprob(end_node, best_logprob)
+
+        return result
+
+    def _node_batches(self, sorted_nodes):
+        """Divides the nodes into batches that are propagated together.
 
-        return new_tokens
+        Without node batching, each node is a batch of its own. Otherwise
+        consecutive nodes in topological order are collected into the same
+        batch as long as they have the same time stamp (or none of them has a
+        time stamp), and none of them is connected to another node in the same
+        batch. All the nodes of a batch are ready to be propagated when the
+        previous batches have been processed.
+
+        :type sorted_nodes: list of Lattice.Nodes
+        :param sorted_nodes: all nodes in topological order
+
+        :rtype: generator of lists of Lattice.Nodes
+        :returns: batches of nodes in the order they should be processed
+        """
+
+        if not self._batch_nodes:
+            for node in sorted_nodes:
+                yield [node]
+            return
+
+        batch = []
+        # The nodes that the batch is connected to.
+        batch_ends = set()
+        for node in sorted_nodes:
+            if batch and \
+               ((node.time != batch[0].time) or (node.id in batch_ends)):
+                yield batch
+                batch = []
+                batch_ends = set()
+            batch.append(node)
+            batch_ends.update(self._link_ends[link_id]
+                              for link_id in self._out_links[node.id])
+        if batch:
+            yield batch
+
+    def _set_lattice(self, lattice):
+        """Reads the nodes and links of a lattice into lists that the decoder
+        uses during decoding.
+
+        The links are identified by their IDs, and their end nodes, scores, and
+        the targets that are passed to ``_append_words()`` are read from lists
+        indexed by link ID. This way the decoder doesn't need to create or
+        follow link objects in its inner loops, which is especially costly with
+        ``CSRLattice``.
+
+        :type lattice: Lattice
+        :param lattice: the lattice to be decoded, or ``None`` to release the
+                        lists after decoding
+        """
+
+        if lattice is None:
+            self._nodes = []
+            self._out_links = []
+            self._link_ends = []
+            self._link_targets = []
+            self._link_ac_logprobs = []
+            self._link_lm_logprobs = []
+            return
+
+        self._nodes = list(lattice.nodes)
+        self._out_links, self._link_ends, link_words, self._link_ac_logprobs, \
+            self._link_lm_logprobs = lattice.link_lists()
+
+        # The word ID (or the word itself, if it's not in the vocabulary) and
+        # the log probability for OOV words, or None for null links.
+        word_to_id = self._vocabulary.word_to_id
+        self._link_targets = []
+        for word, lm_logprob in zip(link_words, self._link_lm_logprobs):
+            if word is None:
+                self._link_targets.append(None)
+                continue
+            word = word_to_id.get(word, word)
+            if self._unk_from_lattice:
+                self._link_targets.append((word, lm_logprob))
+            elif self._unk_penalty is not None:
+                self._link_targets.append((word, self._unk_penalty))
+            else:
+                self._link_targets.append((word, None))
+
+    def _update_best_logprob(self, node, logprob):
+        """Sets the best log probability of a node and updates the best log
+        probability index.
+
+        If look-ahead is used, the index is updated with an estimate of the
+        log probability of the complete path, i.e. ``logprob`` plus the best
+        log probability from the node to the end of the lattice.
+
+        :type node: Lattice.Node
+        :param node: a node that received a new best token
+
+        :type logprob: logprob_type
+        :param logprob: total log probability of the new best token
+        """
+
+        node.best_logprob = logprob
+        if self._lookahead_logprobs is not None:
+            logprob = logprob + self._lookahead_logprobs[node.id]
+        self._best_logprob_index.update(node, logprob)
+
+    def rescore_tokens(self, tokens, settings, max_tokens=None):
+        """Ranks tokens using different interpolation weights, LM scales, and
+        word insertion penalties.
+
+        The acoustic, lattice LM, and NNLM log probabilities of the tokens are
+        collected into arrays once, and the total log probabilities are
+        recomputed for every setting using array operations. No neural network
+        computation is needed, so this can be used to tune the parameters after
+        decoding a lattice only once. The tokens should be decoded with wide
+        enough pruning, so that the tokens that would be the best with the other
+        settings have not been pruned out. If ``decode()`` was given the sweep
+        settings, it may return several tokens with the same recombination
+        hash, and only the best one of them is kept for each setting.
+
+        :type tokens: list of LatticeDecoder.Tokens
+        :param tokens: the final tokens returned by ``decode()``
+
+        :type settings: list of tuples
+        :param settings: each tuple contains the NNLM weight, the LM scale, and
+                         the word insertion penalty
+
+        :type max_tokens: int
+        :param max_tokens: if set to other than ``None``, return only this many
+                           best tokens for each setting
+
+        :rtype: list of lists of LatticeDecoder.Tokens
+        :returns: for each setting, copies of the tokens with the new total log
+                  probabilities, sorted by the total log probability (most
+                  likely token first)
+        """
+
+        ac_logprobs = numpy.array([token.ac_logprob for token in tokens],
+                                  dtype=logprob_type)
+        lat_lm_logprobs = numpy.array([token.lat_lm_logprob
+                                       for token in tokens],
+                                      dtype=logprob_type)
+        nn_lm_logprobs = numpy.array([token.nn_lm_logprob for token in tokens],
+                                     dtype=logprob_type)
+        history_lengths = numpy.array([len(token.history) for token in tokens])
+        hashes = numpy.fromiter((token.recombination_hash for token in tokens),
+                                dtype='int64', count=len(tokens))
+
+        result = []
+        for nnlm_weight, lm_scale, wi_penalty in settings:
+            graph_logprobs, total_logprobs = self._compute_totals(
+                ac_logprobs, lat_lm_logprobs, nn_lm_logprobs, history_lengths,
+                logprob_type(lm_scale), logprob_type(wi_penalty),
+                logprob_type(nnlm_weight))
+            order, is_first = self._group_best(total_logprobs, hashes)
+            best = numpy.sort(order[is_first])
+            order = best[numpy.argsort(-total_logprobs[best], kind='stable')]
+            if max_tokens is not None:
+                order = order[:max_tokens]
+            new_tokens = []
+            for index in order:
+                new_token = self.Token.copy(tokens[index])
+                new_token.recombination_hash = tokens[index].recombination_hash
+                new_token.graph_logprob = graph_logprobs[index]
+                new_token.total_logprob = total_logprobs[index]
+                new_tokens.append(new_token)
+            result.append(new_tokens)
+        return result
+
+    def _compute_totals(self, ac_logprobs, lat_lm_logprobs, nn_lm_logprobs,
+                        history_lengths, lm_scale, wi_penalty,
+                        nnlm_weight=None):
+        """Computes the graph and total log probabilities of a set of tokens.
+
+        Performs the same computation as ``Token.recompute_total()``, but for
+        arrays that contain the scores of several tokens.
+
+        :type ac_logprobs: numpy.ndarray
+        :param ac_logprobs: acoustic log probability of each token
+
+        :type lat_lm_logprobs: numpy.ndarray
+        :param lat_lm_logprobs: lattice LM log probability of each token
+
+        :type nn_lm_logprobs: numpy.ndarray
+        :param nn_lm_logprobs: NNLM log probability of each token
+
+        :type history_lengths: numpy.ndarray
+        :param history_lengths: number of words in the history of each token
+
+        :type lm_scale: logprob_type
+        :param lm_scale: scale language model log probabilities by this factor
+
+        :type wi_penalty: logprob_type
+        :param wi_penalty: penalize word insertion by adding this value to the
+                           total log probability of the token
+
+        :type nnlm_weight: logprob_type
+        :param nnlm_weight: weight of the neural network probabilities, or
+                            ``None`` to use the weight given to the constructor
+
+        :rtype: tuple of two numpy.ndarrays
+        :returns: the graph log probabilities and the total log probabilities
+        """
+
+        if nnlm_weight is None:
+            nnlm_weight = self._nnlm_weight
+        if self._linear_interpolation:
+            lm_logprobs = interpolate_linear(
+                nn_lm_logprobs, lat_lm_logprobs,
+                nnlm_weight)
+        else:
+            lm_logprobs = interpolate_loglinear(
+                nn_lm_logprobs, lat_lm_logprobs,
+                nnlm_weight, (1.0 - nnlm_weight))
+
+        graph_logprobs = lm_logprobs * lm_scale
+        graph_logprobs += wi_penalty * (history_lengths - 1)
+        graph_logprobs = graph_logprobs.astype(logprob_type)
+        total_logprobs = ac_logprobs + graph_logprobs
+        return graph_logprobs, total_logprobs
 
     def _prune(self, node, sorted_nodes, tokens, recomb_tokens):
         """Prunes tokens from a node according to beam and the maximum number of
@@ -489,9 +944,9 @@ class LatticeDecoder(object):
 
         :type recomb_tokens: list of tuples
         :param recomb_tokens: for all tokens that were dropped during
-            recombination, contains the token, and the history and NNLM log
-            probability of the kept token; dropped tokens will be added to the
-            list
+            recombination, contains the history and NNLM log probability of
+            the dropped token and of the kept token; dropped tokens will be
+            added to the list
 
         :rtype: dict
         :returns: a dictionary of statistics collected during pruning
@@ -507,114 +962,281 @@ class LatticeDecoder(object):
             limit_divider = len(sorted_nodes) // self._prune_extra_limit + 1
             limit_divider = max(1, limit_divider)
 
-        new_tokens = self._sorted_recombined_tokens(node_tokens,
-                                                    recomb_tokens)
-        stats['after-recomb'] = len(new_tokens)
-
         # Compare to the best probability at the same or later time.
+        threshold = None
         if self._beam is not None:
-            if node.time is None:
-                node_ids = [iter_node.id for iter_node in sorted_nodes]
-                time_begin = node_ids.index(node.id)
-            else:
-                for time_begin, iter_node in enumerate(sorted_nodes):
-                    if (iter_node.time is not None) and \
-                       (iter_node.time >= node.time):
-                        break
-            assert time_begin < len(sorted_nodes)
-            best_logprob = max(iter_node.best_logprob
-                               for iter_node in sorted_nodes[time_begin:]
-                               if iter_node.best_logprob is not None)
+            best_logprob = self._best_logprob_index.best_logprob(node)
 
             beam = self._beam / limit_divider
             beam = max(beam, self._abs_min_beam)
             threshold = best_logprob - beam
+            if self._lookahead_logprobs is not None:
+                # Compare the estimated log probabilities of complete paths.
+                threshold -= self._lookahead_logprobs[node.id]
 
             stats['best'] = best_logprob
-            stats['node-best'] = new_tokens[0].total_logprob
-            stats['node-worst'] = new_tokens[-1].total_logprob
             stats['threshold'] = threshold
-            stats['average'] = sum(t.total_logprob for t in new_tokens) / len(new_tokens)
-            if len(new_tokens) >= 10:
-                stats['pos10'] = new_tokens[9].total_logprob
-            if len(new_tokens) >= 50:
-                stats['pos50'] = new_tokens[49].total_logprob
-            if len(new_tokens) >= 100:
-                stats['pos100'] = new_tokens[99].total_logprob
-
-            keep_tokens = len(new_tokens)
-            while (keep_tokens > 1) and \
-                  (new_tokens[keep_tokens - 1].total_logprob <= threshold):
-                keep_tokens -= 1
-            new_tokens = new_tokens[:keep_tokens]
-        stats['after-beam'] = len(new_tokens)
 
         # Enforce limit on number of tokens at each node.
+        max_tokens = None
         if self._max_tokens_per_node is not None:
             max_tokens = self._max_tokens_per_node // limit_divider
             max_tokens = max(max_tokens, self._abs_min_max_tokens)
-            new_tokens = new_tokens[:max_tokens]
-        stats['after-max'] = len(new_tokens)
 
-        tokens[node.id] = new_tokens
+        tokens[node.id] = self._sorted_recombined_tokens(
+            node_tokens, recomb_tokens, threshold, max_tokens, stats)
         return stats
 
-    def _sorted_recombined_tokens(self, tokens, recomb_tokens):
-        """Sorts tokens by descending probability and recombines tokens with
-        identical hash.
+    def _prune_active_tokens(self, tokens, active_node_ids):
+        """Limits the total number of tokens in the nodes that have received
+        tokens but have not been processed yet.
 
-        First sorts the tokens by probability, most likely token first. Then
-        keeps only the first if there are multiple tokens with the same hash.
-        Tokens with identical N previous words in the history (where N is the
-        recombination order) will be dropped and added to recomb_tokens.
+        These nodes are the frontier of the search, i.e. the nodes that overlap
+        the current time frame. If they contain more than ``max_active_tokens``
+        tokens in total, a common threshold is selected so that approximately
+        ``max_active_tokens`` best tokens will be kept. If look-ahead is used,
+        the look-ahead log probabilities of the nodes are added to the token log
+        probabilities, so that tokens in different nodes are comparable. The
+        best token of each node is always kept.
+
+        :type tokens: list of LatticeDecoder.Tokens
+        :param tokens: all tokens
+
+        :type active_node_ids: set of ints
+        :param active_node_ids: IDs of the nodes that contain tokens
+        """
+
+        node_ids = list(active_node_ids)
+        counts = numpy.array([len(tokens[node_id]) for node_id in node_ids])
+        num_tokens = counts.sum()
+        if num_tokens <= self._max_active_tokens:
+            return
+
+        logprobs = numpy.fromiter((token.total_logprob
+                                   for node_id in node_ids
+                                   for token in tokens[node_id]),
+                                  dtype=logprob_type, count=num_tokens)
+        if self._lookahead_logprobs is not None:
+            logprobs += numpy.repeat(self._lookahead_logprobs[node_ids], counts)
+        max_tokens = self._max_active_tokens
+        limit = -numpy.partition(-logprobs, max_tokens - 1)[max_tokens - 1]
+
+        offsets = numpy.cumsum(counts) - counts
+        for node_id, offset, count in zip(node_ids, offsets, counts):
+            node_logprobs = logprobs[offset:offset + count]
+            mask = node_logprobs >= limit
+            mask[node_logprobs.argmax()] = True
+            if not mask.all():
+                tokens[node_id] = [token
+                                   for token, keep in zip(tokens[node_id], mask)
+                                   if keep]
+                self._num_active_pruned += count - len(tokens[node_id])
+
+    def _sorted_recombined_tokens(self, tokens, recomb_tokens, threshold=None,
+                                  max_tokens=None, stats=None):
+        """Recombines tokens with identical hash, prunes tokens, and sorts the
+        remaining tokens by descending probability.
+
+        Keeps only the most probable token if there are multiple tokens with
+        the same hash, or with sweep settings, the most probable token with
+        each setting. Tokens with identical N previous words in the history
+        (where N is the recombination order) will be dropped and added to
+        recomb_tokens. Then removes the tokens whose log probability is not
+        greater than ``threshold``, except the best token, and keeps at most
+        ``max_tokens`` best tokens. Ties are resolved in favour of the token
+        that appears first in the input.
+
+        The log probabilities are collected into an array, so that the tokens
+        can be recombined and pruned using array operations. The best tokens are
+        selected without sorting all the tokens, and only the tokens that are
+        kept are sorted.
 
         :type tokens: list of LatticeDecoder.Tokens
         :param tokens: input tokens
 
         :type recomb_tokens: list of tuples
         :param recomb_tokens: for all tokens that were dropped during
-            recombination, contains the token, and the history and NNLM log
-            probability of the kept token; dropped tokens will be added to the
-            list
+            recombination, contains the history and NNLM log probability of
+            the dropped token and of the kept token; dropped tokens will be
+            added to the list
+
+        :type threshold: logprob_type
+        :param threshold: if not ``None``, prune the tokens whose total log
+                          probability is not greater than this
+
+        :type max_tokens: int
+        :param max_tokens: if not ``None``, keep at most this many tokens
+
+        :type stats: dict
+        :param stats: if not ``None``, pruning statistics will be written to
+                      this dictionary
 
         :rtype: list of LatticeDecoder.Tokens
         :returns: the tokens in sorted order and with only the best token of
                   those with identical recombination hash
         """
 
-        sorted_tokens = sorted(tokens,
-                               key=lambda token: token.total_logprob,
-                               reverse=True)
-
-        token_map = dict()
-        result = []
-        for token in sorted_tokens:
-            key = token.recombination_hash
-            if key not in token_map:
-                result.append(token)
-                token_map[key] = token
-            else:
-                kept_token = token_map[key]
-                recomb_tokens.append((token,
+        num_tokens = len(tokens)
+        logprobs = numpy.fromiter((token.total_logprob for token in tokens),
+                                  dtype=logprob_type, count=num_tokens)
+        hashes = numpy.fromiter((token.recombination_hash for token in tokens),
+                                dtype='int64', count=num_tokens)
+
+        order, is_first = self._group_best(logprobs, hashes)
+        kept = order[is_first]
+        if not is_first.all():
+            group_kept = kept[numpy.cumsum(is_first) - 1]
+            is_kept = is_first
+            if self._lattice_sweep_settings:
+                # Keep also the tokens that are the best of their group with
+                # some sweep setting, so that they can be ranked after
+                # decoding.
+                is_kept = is_first | self._sweep_group_best(tokens,
+                                                            hashes)[order]
+                kept = order[is_kept]
+            dropped = order[~is_kept]
+            dropped_kept = group_kept[~is_kept]
+            for index in numpy.lexsort((dropped, -logprobs[dropped])):
+                token = tokens[dropped[index]]
+                kept_token = tokens[dropped_kept[index]]
+                recomb_tokens.append((token.history,
+                                      token.nn_lm_logprob,
                                       kept_token.history,
                                       kept_token.nn_lm_logprob))
-        return result
+        kept = numpy.sort(kept)
+        kept_logprobs = logprobs[kept]
+        if stats is not None:
+            stats['after-recomb'] = len(kept)
+
+        if threshold is not None:
+            if stats is not None:
+                stats['node-best'] = kept_logprobs.max()
+                stats['node-worst'] = kept_logprobs.min()
+                stats['average'] = kept_logprobs.mean()
+                for position in (10, 50, 100):
+                    if len(kept) >= position:
+                        stats['pos{}'.format(position)] = -numpy.partition(
+                            -kept_logprobs, position - 1)[position - 1]
+            mask = kept_logprobs > threshold
+            mask[kept_logprobs.argmax()] = True
+            kept = kept[mask]
+            kept_logprobs = kept_logprobs[mask]
+        if stats is not None:
+            stats['after-beam'] = len(kept)
+
+        if (max_tokens is not None) and (len(kept) > max_tokens):
+            limit = -numpy.partition(-kept_logprobs,
+                                     max_tokens - 1)[max_tokens - 1]
+            mask = kept_logprobs > limit
+            num_ties = max_tokens - numpy.count_nonzero(mask)
+            mask[numpy.flatnonzero(kept_logprobs == limit)[:num_ties]] = True
+            kept = kept[mask]
+            kept_logprobs = kept_logprobs[mask]
+        if stats is not None:
+            stats['after-max'] = len(kept)
+
+        order = numpy.lexsort((kept, -kept_logprobs))
+        return [tokens[index] for index in kept[order]]
+
+    @staticmethod
+    def _group_best(logprobs, hashes):
+        """Groups tokens by recombination hash and finds the best token of
+        each group.
+
+        The sort is stable, so tokens with equal probability stay in input
+        order, and the first one of them is the best.
+
+        :type logprobs: numpy.ndarray
+        :param logprobs: total log probability of each token
+
+        :type hashes: numpy.ndarray
+        :param hashes: recombination hash of each token
+
+        :rtype: tuple of two numpy.ndarrays
+        :returns: indices of the tokens ordered by hash, the best token of each
+                  group first, and a boolean mask over that order that selects
+                  the best token of each group
+        """
 
-    def _append_word(self, tokens, target_word, oov_logprob=None):
-        """Appends a word to each of the given tokens, and updates their scores.
+        order = numpy.lexsort((-logprobs, hashes))
+        is_first = numpy.ones(len(order), dtype=bool)
+        sorted_hashes = hashes[order]
+        is_first[1:] = sorted_hashes[1:] != sorted_hashes[:-1]
+        return order, is_first
+
+    def _sweep_group_best(self, tokens, hashes):
+        """Finds the tokens that are the best of their recombination group
+        with any of the sweep settings.
 
         :type tokens: list of LatticeDecoder.Tokens
         :param tokens: input tokens
 
-        :type target_word: int or str
-        :param target_word: word ID or word to be appended to the existing
-                            history of each input token; if not an integer, the
-                            word will be considered ``<unk>`` and this variable
-                            will be taken literally as the word that will be
-                            used in the resulting transcript
+        :type hashes: numpy.ndarray
+        :param hashes: recombination hash of each token
 
-        :type oov_logprob: float
-        :param oov_logprob: log probability to be assigned to OOV words
+        :rtype: numpy.ndarray
+        :returns: a boolean mask that selects the tokens that should be kept
+        """
+
+        ac_logprobs = numpy.array([token.ac_logprob for token in tokens],
+                                  dtype=logprob_type)
+        lat_lm_logprobs = numpy.array([token.lat_lm_logprob
+                                       for token in tokens],
+                                      dtype=logprob_type)
+        nn_lm_logprobs = numpy.array([token.nn_lm_logprob for token in tokens],
+                                     dtype=logprob_type)
+        history_lengths = numpy.array([token.history.length
+                                       for token in tokens])
+
+        result = numpy.zeros(len(tokens), dtype=bool)
+        for nnlm_weight, lm_scale, wi_penalty in self._lattice_sweep_settings:
+            _, logprobs = self._compute_totals(
+                ac_logprobs, lat_lm_logprobs, nn_lm_logprobs, history_lengths,
+                lm_scale, wi_penalty, nnlm_weight)
+            order, is_first = self._group_best(logprobs, hashes)
+            result[order[is_first]] = True
+        return result
+
+    def _append_words(self, tokens, targets, target_slices=None):
+        """Computes the NNLM log probabilities of words that follow the
+        histories of the given tokens, and the recurrent states after the
+        histories.
+
+        First updates the recurrent state of the input tokens with a single call
+        to the state function. Then computes the log probabilities of all the
+        target words with a single call to the output layer. If a history cache
+        is used, the states and log probabilities of word histories that are
+        found from the cache are not computed again, and histories that appear
+        several times in the input are computed only once. Each target is a
+        tuple that contains the word to be appended, and the log probability to
+        be assigned to the word, if it is an OOV word. The new states are stored
+        in the state pool.
+
+        Each target may be restricted to a contiguous range of the input tokens.
+        This way the tokens of several nodes can be processed in one batch,
+        although the nodes are followed by different words. The state is
+        updated only for the tokens that are needed by some target.
+
+        :type tokens: list of LatticeDecoder.Tokens
+        :param tokens: input tokens
+
+        :type targets: list of tuples
+        :param targets: each tuple contains a word ID or a word, and a log
+                        probability for OOV words; if the word is not an
+                        integer, it will be considered ``<unk>`` and taken
+                        literally as the word that will be used in the resulting
+                        transcript
+
+        :type target_slices: list of slices
+        :param target_slices: if not ``None``, computes each target only for
+                              this range of the input tokens
+
+        :rtype: tuple of a numpy.ndarray and a list of ints
+        :returns: a matrix of log probabilities with one row per target and one
+                  column per input token (-inf outside the range of the
+                  target), and the state pool index of the new state of each
+                  input token (``None`` for tokens that are not needed by any
+                  target)
         """
 
         def limit_to_shortlist(self, word):
@@ -626,38 +1248,143 @@ class LatticeDecoder(object):
             else:
                 return self._unk_id
 
-        input_word_ids = [[limit_to_shortlist(self, token.history[-1])
-                           for token in tokens]]
+        num_tokens = len(tokens)
+        if target_slices is None:
+            target_slices = [slice(0, num_tokens)] * len(targets)
+        target_ranges = [range(*target_slice.indices(num_tokens))
+                         for target_slice in target_slices]
+        needed = numpy.zeros(num_tokens, dtype=bool)
+        for target_slice in target_slices:
+            needed[target_slice] = True
+        input_histories = [token.history for token in tokens]
+        if self._history_cache is None:
+            # Without a cache, every token is computed separately.
+            cache = HistoryCache()
+            keys = range(num_tokens)
+        else:
+            cache = self._history_cache
+            keys = [self._history_key(history) for history in input_histories]
+
+        # Update the recurrent state of the histories that are not found from
+        # the cache.
+        entries = [cache.get(key) if is_needed else None
+                   for key, is_needed in zip(keys, needed)]
+        missing = OrderedDict()
+        for index, (key, entry) in enumerate(zip(keys, entries)):
+            if needed[index] and (entry is None) and (key not in missing):
+                missing[key] = index
+        if missing:
+            missing_indices = list(missing.values())
+            input_word_ids = [[limit_to_shortlist(self, input_histories[i].word)
+                               for i in missing_indices]]
+            input_word_ids = numpy.asarray(input_word_ids).astype('int64')
+            input_class_ids, _ = \
+                self._vocabulary.get_class_memberships(input_word_ids)
+            recurrent_state = self._state_pool.get(
+                [tokens[i].state for i in missing_indices])
+            hidden, output_state = self._step_predictor.predict_state(
+                input_word_ids, input_class_ids, recurrent_state)
+            if not self._state_pool.has_room(len(missing_indices)):
+                self._release_states()
+            state_indices = self._state_pool.add(output_state)
+            # Slice the sequence that corresponds to each history.
+            for seq_index, key in enumerate(missing):
+                seq_slice = slice(seq_index, seq_index + 1)
+                missing[key] = cache.add(key,
+                                         [x[:, seq_slice] for x in hidden],
+                                         int(state_indices[seq_index]))
+            entries = [missing[key] if (entry is None) and is_needed else entry
+                       for key, entry, is_needed in zip(keys, entries, needed)]
+
+        # Compute the log probabilities that are not found from the cache.
+        target_class_ids = [
+            self._vocabulary.word_id_to_class_id[
+                limit_to_shortlist(self, word)]
+            for word, _ in targets]
+        logprobs = numpy.full(len(targets) * num_tokens, -numpy.inf,
+                              dtype=theano.config.floatX)
+        missing = OrderedDict()
+        for target_index, class_id in enumerate(target_class_ids):
+            offset = target_index * num_tokens
+            for index in target_ranges[target_index]:
+                entry = entries[index]
+                logprob = cache.get_logprob(entry, class_id)
+                if logprob is None:
+                    positions = missing.setdefault((keys[index], class_id),
+                                                   (entry, []))[1]
+                    positions.append(offset + index)
+                else:
+                    logprobs[offset + index] = logprob
+        if missing:
+            missing_entries = [entry for entry, _ in missing.values()]
+            hidden = [numpy.concatenate([entry.hidden[layer_index]
+                                         for entry in missing_entries],
+                                        axis=1)
+                      for layer_index in range(len(missing_entries[0].hidden))]
+            missing_class_ids = [[class_id for _, class_id in missing]]
+            missing_class_ids = numpy.asarray(missing_class_ids).astype('int64')
+            missing_logprobs = self._step_predictor.target_logprobs(
+                hidden, missing_class_ids)
+            for (_, class_id), (entry, positions), logprob \
+                in zip(missing, missing.values(), missing_logprobs[0]):
+                cache.add_logprob(entry, class_id, logprob)
+                logprobs[positions] = logprob
+
+        # Add logprobs from the class membership of the predicted words.
+        input_word_ids = [[limit_to_shortlist(self, history.word)
+                           for history in input_histories]]
         input_word_ids = numpy.asarray(input_word_ids).astype('int64')
-        input_class_ids, membership_probs = \
+        _, membership_probs = \
             self._vocabulary.get_class_memberships(input_word_ids)
-        recurrent_state = [token.state for token in tokens]
-        recurrent_state = RecurrentState.combine_sequences(recurrent_state)
-        target_word_id = limit_to_shortlist(self, target_word)
-        target_class_ids = numpy.ones(shape=(1, len(tokens))).astype('int64')
-        target_class_ids *= self._vocabulary.word_id_to_class_id[target_word_id]
-        step_result = self._step_function(input_word_ids,
-                                          input_class_ids,
-                                          target_class_ids,
-                                          *recurrent_state.get())
-        logprobs = step_result[0]
-        # Add logprobs from the class membership of the predicted words.
-        logprobs += numpy.log(membership_probs)
-        output_state = step_result[1:]
-
-        for index, token in enumerate(tokens):
-            token.history = token.history + (target_word,)
-            token.state = RecurrentState(self._network.recurrent_state_size)
-            # Slice the sequence that corresponds to this token.
-            token.state.set([layer_state[:, index:index + 1]
-                             for layer_state in output_state])
-            # logprobs matrix contains only one time step.
-            token.nn_lm_logprob += self._handle_unk_logprob(target_word,
-                                                            logprobs[0, index],
-                                                            oov_logprob)
-
-    def _handle_unk_logprob(self, word, network_logprob, oov_logprob):
-        """Returns the log probability after applying <unk> processing.
+        logprobs += numpy.tile(numpy.log(membership_probs[0]), len(targets))
+        logprobs = logprobs.reshape(len(targets), num_tokens)
+
+        for target_index, (target_word, oov_logprob) in enumerate(targets):
+            logprobs[target_index] = self._handle_unk_logprobs(
+                target_word, logprobs[target_index], oov_logprob)
+
+        return logprobs, [None if entry is None else entry.state
+                          for entry in entries]
+
+    def _release_states(self):
+        """Releases the recurrent states that are not used by any token in the
+        lattice nodes or by the history cache.
+
+        The state pool is compacted, and the state indices of the tokens and
+        the cache entries are updated.
+        """
+
+        live_tokens = [token
+                       for node_tokens in self._tokens
+                       for token in node_tokens]
+        if self._history_cache is None:
+            live_entries = []
+        else:
+            live_entries = list(self._history_cache.entries())
+        indices = [token.state for token in live_tokens]
+        indices.extend(entry.state for entry in live_entries)
+        mapping = self._state_pool.compact(indices)
+        for token in live_tokens:
+            token.state = mapping[token.state]
+        for entry in live_entries:
+            entry.state = mapping[entry.state]
+
+    def _history_key(self, history):
+        """Returns the key that is used to look up a word history from the
+        history cache.
+
+        :type history: WordHistory
+        :param history: word IDs (or OOV words) of a token
+
+        :rtype: int
+        :returns: hash of the history truncated to the recombination order
+        """
+
+        return history.window_hash(self._recombination_order)
+
+    def _handle_unk_logprobs(self, word, network_logprobs, oov_logprob):
+        """Returns the log probabilities of a word after applying <unk>
+        processing.
 
         If ``self._oos_logprobs`` is set and the word is in vocabulary, the
         corresponding value will be added to the network log probability. In
@@ -675,11 +1402,15 @@ class LatticeDecoder(object):
         :param word: target word ID or word; if not an integer, the word will be
                      considered ``<unk>``
 
-        :type network_logprob: float
-        :param network_logprob: log probability predicted by the network
+        :type network_logprobs: numpy.ndarray
+        :param network_logprobs: log probabilities predicted by the network
+                                 after different histories
 
         :type oov_logprob: float
         :param oov_logprob: log probability to be assigned to OOV words
+
+        :rtype: numpy.ndarray
+        :returns: the log probabilities after <unk> processing
         """
 
         in_vocabulary = isinstance(word, int)
@@ -687,17 +1418,15 @@ class LatticeDecoder(object):
 
         if self._oos_logprobs is not None:
             if in_vocabulary:
-                return network_logprob + self._oos_logprobs[word]
+                return network_logprobs + self._oos_logprobs[word]
             elif oov_logprob is not None:
-                logging.debug("Replacing <unk> logprob %f with %f.",
-                              network_logprob, oov_logprob)
-                return oov_logprob
+                logging.debug("Replacing <unk> logprob with %f.", oov_logprob)
+                return numpy.full_like(network_logprobs, oov_logprob)
         elif (not in_shortlist) and (oov_logprob is not None):
-            logging.debug("Replacing <unk> logprob %f with %f.",
-                          network_logprob, oov_logprob)
-            return oov_logprob
+            logging.debug("Replacing <unk> logprob with %f.", oov_logprob)
+            return numpy.full_like(network_logprobs, oov_logprob)
 
-        return network_logprob
+        return network_logprobs
 
     def _log_stats(self, stats, node_id, num_nodes):
         """Writes pruning statistics to debug log.
@@ -730,3 +1459,18 @@ class LatticeDecoder(object):
             logging.debug('logprob best=%.1f%s',
                           stats['best'],
                           optional)
+
+    def _log_cache_stats(self):
+        """Writes history cache statistics to debug log.
+        """
+
+        cache = self._history_cache
+        logging.debug("History cache: %d histories, %.1f MB, state hits=%d "
+                      "misses=%d, logprob hits=%d misses=%d, evictions=%d",
+                      len(cache),
+                      cache.size / (1024 * 1024),
+                      cache.hits,
+                      cache.misses,
+                      cache.logprob_hits,
+                      cache.logprob_misses,
+                      cache.evictions)
@@ -0,0 +1,227 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""A module that implements the NBestScorer class.
+"""
+
+import numpy
+
+from theanolm.backend import NumberError
+from theanolm.network import RecurrentState, StepPredictor
+from theanolm.parsing import utterance_from_line
+from theanolm.scoring.statepool import StatePool
+
+class NBestScorer(object):
+    """N-best List Scoring Using a Prefix Tree
+
+    Computes the log probabilities of the hypotheses of an n-best list. The
+    hypotheses of an utterance usually share long prefixes. They are inserted
+    into a prefix tree of word IDs, and the network is run one time step at a
+    time, once for each node of the tree. The recurrent state after a node is
+    passed to its children, so a prefix that is shared by several hypotheses is
+    computed only once.
+
+    The tree is processed level by level. The recurrent states of all the nodes
+    at the same depth are updated with one call to the network, and the log
+    probabilities of all their children are computed with one call to the
+    output layer.
+    """
+
+    def __init__(self, network, use_shortlist=True, exclude_unk=False,
+                 profile=False):
+        """Creates the Theano functions for performing the forward pass one
+        time step at a time.
+
+        :type network: Network
+        :param network: the neural network object, created in single time step
+                        mode
+
+        :type use_shortlist: bool
+        :param use_shortlist: if ``True``, the ``<unk>`` probability is
+                              distributed among the out-of-shortlist words
+
+        :type exclude_unk: bool
+        :param exclude_unk: if set to ``True``, ``<unk>`` tokens are excluded
+                            from probability computation
+
+        :type profile: bool
+        :param profile: if set to True, creates a Theano profile object
+        """
+
+        self._vocabulary = network.vocabulary
+        self._unk_id = self._vocabulary.word_to_id['<unk>']
+        self._shortlist_size = self._vocabulary.num_shortlist_words()
+        self._exclude_unk = exclude_unk
+        if use_shortlist and self._vocabulary.has_unigram_probs():
+            oos_logprobs = numpy.log(self._vocabulary.get_oos_probs())
+            self._oos_logprobs = oos_logprobs
+        else:
+            self._oos_logprobs = None
+
+        self._step_predictor = StepPredictor(network, profile)
+        self._state_pool = StatePool(network.recurrent_state_size)
+        self._initial_state = RecurrentState(network.recurrent_state_size)
+
+        # These are updated by score_hypotheses().
+        self.num_words = 0
+        self.num_unks = 0
+        self.num_steps = 0
+
+    def score_hypotheses(self, lines):
+        """Scores the hypotheses of one utterance.
+
+        Start-of-sentence and end-of-sentece tags (``<s>`` and ``</s>``) will be
+        inserted at the beginning and the end of each hypothesis, if they're
+        missing. An empty hypothesis is interpreted as the empty sentence
+        ``<s> </s>``.
+
+        ``<unk>`` tokens will be excluded from the probability computation, if
+        the constructor was given ``exclude_unk=True``. When using a shortlist,
+        OOV words are always excluded, and if ``exclude_unk=True`` was given,
+        OOS words are also excluded. Words with zero class membership
+        probability are always excluded.
+
+        :type lines: list of strs
+        :param lines: the words of each hypothesis
+
+        :rtype: list of floats
+        :returns: log probability of each hypothesis
+        """
+
+        if not lines:
+            return []
+
+        # The prefix tree is stored in parallel lists that are indexed by node
+        # ID. Node 0 is the start of sentence.
+        node_words = [None]
+        node_parents = [None]
+        node_depths = [0]
+        node_children = [dict()]
+        end_nodes = []
+        for line in lines:
+            words = utterance_from_line(line)
+            if not words:
+                words = ['<s>', '</s>']
+            word_ids = self._vocabulary.words_to_ids(words)
+            self.num_words += word_ids.size
+            self.num_unks += numpy.count_nonzero(word_ids == self._unk_id)
+            node_words[0] = int(word_ids[0])
+            node_id = 0
+            for word_id in word_ids[1:]:
+                word_id = int(word_id)
+                children = node_children[node_id]
+                child_id = children.get(word_id)
+                if child_id is None:
+                    child_id = len(node_words)
+                    children[word_id] = child_id
+                    node_words.append(word_id)
+                    node_parents.append(node_id)
+                    node_depths.append(node_depths[node_id] + 1)
+                    node_children.append(dict())
+                node_id = child_id
+            end_nodes.append(node_id)
+
+        # Group the nodes that have children by depth.
+        levels = [[] for _ in range(max(node_depths) + 1)]
+        for node_id, children in enumerate(node_children):
+            if children:
+                levels[node_depths[node_id]].append(node_id)
+
+        self._state_pool.clear()
+        initial_index = int(self._state_pool.add(self._initial_state)[0])
+        node_states = [None] * len(node_words)
+        node_logprobs = numpy.zeros(len(node_words))
+        for level in levels:
+            if not level:
+                break
+            self._score_level(level, node_words, node_parents, node_children,
+                              node_states, node_logprobs, initial_index)
+            self.num_steps += len(level)
+
+        result = node_logprobs[end_nodes]
+        if numpy.isnan(result).any():
+            raise NumberError("Log probability of a sequence is NaN.")
+        if numpy.isneginf(result).any():
+            raise NumberError("Probability of a sequence is zero.")
+        if (result > 0.0).any():
+            raise NumberError("Probability of a sequence is greater than one.")
+        return result.tolist()
+
+    def _score_level(self, level, node_words, node_parents, node_children,
+                     node_states, node_logprobs, initial_index):
+        """Runs the network one time step from the nodes at one level of the
+        prefix tree, and computes the log probabilities of their children.
+
+        The recurrent state of each node is updated from the state of its
+        parent, and stored in ``node_states``. The total log probability of the
+        path to each child is stored in ``node_logprobs``.
+
+        :type level: list of ints
+        :param level: IDs of the nodes that have children, all at the same depth
+
+        :type node_words: list of ints
+        :param node_words: word ID of each node
+
+        :type node_parents: list of ints
+        :param node_parents: parent node ID of each node
+
+        :type node_children: list of dicts
+        :param node_children: mapping from word IDs to child node IDs, for each
+                              node
+
+        :type node_states: list of ints
+        :param node_states: state pool index of each node
+
+        :type node_logprobs: numpy.ndarray
+        :param node_logprobs: log probability of the path to each node
+
+        :type initial_index: int
+        :param initial_index: state pool index of the initial state
+        """
+
+        input_word_ids = numpy.array([[node_words[node_id]
+                                       for node_id in level]], dtype='int64')
+        input_word_ids[input_word_ids >= self._shortlist_size] = self._unk_id
+        input_class_ids, _ = \
+            self._vocabulary.get_class_memberships(input_word_ids)
+        state_indices = [initial_index if node_parents[node_id] is None
+                         else node_states[node_parents[node_id]]
+                         for node_id in level]
+        recurrent_state = self._state_pool.get(state_indices)
+        hidden, output_state = self._step_predictor.predict_state(
+            input_word_ids, input_class_ids, recurrent_state)
+        for node_id, state_index in zip(level,
+                                        self._state_pool.add(output_state)):
+            node_states[node_id] = int(state_index)
+
+        sequence_indices = []
+        target_word_ids = []
+        child_ids = []
+        for seq_index, node_id in enumerate(level):
+            for word_id, child_id in node_children[node_id].items():
+                sequence_indices.append(seq_index)
+                target_word_ids.append(word_id)
+                child_ids.append(child_id)
+        target_word_ids = numpy.array(target_word_ids, dtype='int64')
+        target_class_ids, membership_probs = \
+            self._vocabulary.get_class_memberships(target_word_ids[None, :])
+        logprobs = self._step_predictor.target_logprobs(
+            hidden, target_class_ids, numpy.array(sequence_indices))[0]
+        with numpy.errstate(divide='ignore'):
+            logprobs = logprobs + numpy.log(membership_probs[0])
+
+        # Words with zero class membership probability are excluded.
+        mask = membership_probs[0] != 0.0
+        if self._oos_logprobs is not None:
+            # The probability of out-of-shortlist words (which is the <unk>
+            # probability) is multiplied by the fraction of the actual word
+            # within the set of OOS words. OOV words are always excluded.
+            logprobs += self._oos_logprobs[target_word_ids]
+            mask &= target_word_ids != self._unk_id
+        elif self._exclude_unk:
+            mask &= target_word_ids != self._unk_id
+            mask &= target_word_ids < self._shortlist_size
+        logprobs = numpy.where(mask, logprobs, 0.0)
+
+        child_ids = numpy.array(child_ids)
+        parent_ids = numpy.array(level)[sequence_indices]
+        node_logprobs[child_ids] = node_logprobs[parent_ids] + logprobs
@@ -11,49 +11,6 @@ from theanolm.scoring.lattice import Lattice
 class NodeNotFoundError(Exception):
     pass
 
-def _follow_word_from_node(node, word):
-    """Follows the link with given word label from given node.
-
-    If there is a link from ``node`` with the label ``word``, returns the end
-    node and the log probabilities and transition IDs of the link. If there are
-    null links in between, returns the sum of the log probabilities and the
-    concatenation of the transition IDs.
-
-    :type node: Lattice.Node
-    :param node: node where to start searching
-
-    :type word: str
-    :param word: word to search for
-
-    :rtype: tuple of (Lattice.Node, float, float, str)
-    :returns: the end node of the link with the word label (or ``None`` if the
-              word is not found), and the total acoustic log probability, LM log
-              probability, and transition IDs of the path to the word
-    """
-
-    if word not in node.word_to_link:
-        return (None, None, None, None)
-
-    link = node.word_to_link[word]
-    if link.word is not None:
-        return (link.end_node,
-                link.ac_logprob if link.ac_logprob is not None else 0.0,
-                link.lm_logprob if link.lm_logprob is not None else 0.0,
-                link.transitions if link.transitions is not None else "")
-
-    end_node, ac_logprob, lm_logprob, transitions = \
-        _follow_word_from_node(link.end_node, word)
-    if end_node is None:
-        return (None, None, None, None)
-    else:
-        if link.ac_logprob is not None:
-            ac_logprob += link.ac_logprob
-        if link.lm_logprob is not None:
-            lm_logprob += link.lm_logprob
-        if link.transitions is not None:
-            transitions += link.transitions
-        return (end_node, ac_logprob, lm_logprob, transitions)
-
 class RescoredLattice(Lattice):
     """Rescored Lattice
 
@@ -76,8 +33,9 @@ class RescoredLattice(Lattice):
 
         :type recomb_tokens: list of tuples
         :param recomb_tokens: tokens that were dropped during recombination;
-            each tuple contains the token, and the word IDs and NNLM log
-            probability of the token that was kept when dropping the token
+            each tuple contains the word history and NNLM log probability of
+            the dropped token, and those of the token that was kept when
+            dropping the token
 
         :type vocabulary: Vocabulary
         :param vocabulary: vocabulary for mapping the word IDs in the tokens to
@@ -87,11 +45,52 @@ class RescoredLattice(Lattice):
         :returns: the created lattice
         """
 
-        def follow_word_ids(word_ids, create=True):
-            """Follows a path from the initial node with given word IDs.
+        # The lattice is a prefix tree of the token histories. The node in this
+        # lattice and the node in the original lattice that correspond to a
+        # history are memoized, so that a history can be followed by taking one
+        # step from the node of its parent history. The histories of the
+        # tokens share their prefixes, so each history is followed only once.
+        history_nodes = dict()
 
-            :type word_ids: list of ints
-            :param word_ids: IDs of the words to be found on the path
+        def follow_word(node, orig_node, word, create):
+            """Follows one word from a node of this lattice and the
+            corresponding node of the original lattice.
+
+            :rtype: tuple of two Lattice.Nodes
+            :returns: the nodes in this lattice and in the original lattice
+                      after the word
+            """
+
+            orig_end_node, ac_logprob, lm_logprob, transitions = \
+                orig_closures[orig_node.id].get(word, (None, None, None, None))
+            # The original lattice may contain null links that we have to skip.
+            if orig_end_node is None:
+                return node, orig_node
+
+            # Our new lattice doesn't contain null links, so word_to_link maps
+            # never skip nodes.
+            if word in node.word_to_link:
+                link = node.word_to_link[word]
+            else:
+                if not create:
+                    raise NodeNotFoundError
+                end_node = self.Node(len(self.nodes))
+                end_node.word_to_link = dict()
+                self.nodes.append(end_node)
+                link = self.Link(node, end_node, word,
+                                 ac_logprob, lm_logprob, transitions)
+                node.out_links.append(link)
+                node.word_to_link[word] = link
+                self.links.append(link)
+            return link.end_node, orig_end_node
+
+        def follow_word_ids(history, create=True):
+            """Follows a path from the initial node with the word IDs of given
+            history.
+
+            :type history: WordHistory
+            :param history: IDs of the words to be found on the path, or
+                            ``None`` for an empty path
 
             :type create: bool
             :param create: if ``True``, creates new nodes if necessary
@@ -100,9 +99,24 @@ class RescoredLattice(Lattice):
             :returns: the last node of the path
             """
 
-            words = [vocabulary.id_to_word[id] if isinstance(id, int) else id
-                     for id in word_ids[1:]]
-            return self._follow_words(words, original_lattice, create)
+            # Find the longest prefix of the history that has been followed
+            # already. The first word is the start of sentence.
+            path = []
+            while history not in history_nodes:
+                if history.parent is None:
+                    history_nodes[history] = history_nodes[None]
+                    break
+                path.append(history)
+                history = history.parent
+
+            node, orig_node = history_nodes[history]
+            for history in reversed(path):
+                word_id = history.word
+                word = vocabulary.id_to_word[word_id] \
+                       if isinstance(word_id, int) else word_id
+                node, orig_node = follow_word(node, orig_node, word, create)
+                history_nodes[history] = (node, orig_node)
+            return node
 
         super().__init__()
 
@@ -115,7 +129,8 @@ class RescoredLattice(Lattice):
         final_node.final = True
         final_node.word_to_link = dict()
 
-        self._add_word_maps(original_lattice.nodes)
+        orig_closures = self._add_word_maps(original_lattice.nodes)
+        history_nodes[None] = (self.initial_node, original_lattice.initial_node)
 
         # Create all the paths that correspond to the final tokens.
         for token in final_tokens:
@@ -136,9 +151,10 @@ class RescoredLattice(Lattice):
 
         # Add recombined tokens.
         oov_words = set()
-        for token, new_history, nn_lm_logprob in reversed(recomb_tokens):
-            assert new_history[-1] == token.history[-1]
-            word_id = token.history[-1]
+        for history, nn_lm_logprob, new_history, new_nn_lm_logprob \
+            in reversed(recomb_tokens):
+            assert new_history.word == history.word
+            word_id = history.word
             if isinstance(word_id, int):
                 word = vocabulary.id_to_word[word_id]
             else:
@@ -148,7 +164,7 @@ class RescoredLattice(Lattice):
             # Find the incoming link that corresponds to the token that was kept
             # during recombination.
             try:
-                recomb_from_node = follow_word_ids(new_history[:-1], False)
+                recomb_from_node = follow_word_ids(new_history.parent, False)
             except NodeNotFoundError:
                 continue
             # Our new lattice doesn't contain null links, so word_to_link maps
@@ -161,8 +177,8 @@ class RescoredLattice(Lattice):
             # that was kept during recombination. The difference in LM log
             # probability can be computed from the token (path) NNLM log
             # probabilities.
-            from_node = follow_word_ids(token.history[:-1])
-            lm_logprob_diff = token.nn_lm_logprob - nn_lm_logprob
+            from_node = follow_word_ids(history.parent)
+            lm_logprob_diff = nn_lm_logprob - new_nn_lm_logprob
             new_link = self.Link(from_node, recomb_link.end_node, word,
                                  recomb_link.ac_logprob,
                                  recomb_link.lm_logprob + lm_logprob_diff,
@@ -171,6 +187,12 @@ class RescoredLattice(Lattice):
             # Tokens never contain null words, so we can be sure that
             # word_to_link maps in our new lattice never skip nodes.
             assert word is not None
+            if word in from_node.word_to_link:
+                # Replacing a link changes the paths of the histories that
+                # were followed through it.
+                initial_nodes = history_nodes[None]
+                history_nodes.clear()
+                history_nodes[None] = initial_nodes
             from_node.word_to_link[word] = new_link
             self.links.append(new_link)
 
@@ -185,90 +207,82 @@ class RescoredLattice(Lattice):
         """Adds mapping from words to outgoing links on each node.
 
         For each node, finds the words that follow the node. If an outgoing link
-        is a null link, follows the link recursively. Then adds the attribute
-        ``word_to_link`` to the node that provides a mapping from words to the
-        links that have to be followed to reach that word. This is done to avoid
-        doing the search every time when constructing the rescored lattice.
+        is a null link, the words that follow its end node are included. Then
+        adds the attribute ``word_to_link`` to the node that provides a mapping
+        from words to the links that have to be followed to reach that word.
+        This is done to avoid doing the search every time when constructing the
+        rescored lattice.
+
+        The words that follow a node through null links are computed only once
+        per node, after computing them for the end nodes of the null links.
+        Together with the path to each word, they form the epsilon closure of
+        the node, which is returned.
 
         :type nodes: list of Lattice.Nodes
         :param nodes: add a ``word_to_link`` map to these nodes
-        """
 
-        def next_words(link):
-            if link.word is None:
-                return [word
-                        for next_link in link.end_node.out_links
-                        for word in next_words(next_link)]
-            else:
-                return [link.word]
+        :rtype: dict
+        :returns: a mapping from node IDs to dictionaries that map the words
+                  following the node to a tuple of the end node of the word,
+                  and the total acoustic log probability, LM log probability,
+                  and transition IDs of the path to the end of the word
+        """
 
+        closures = dict()
         determinized = True
-        for node in nodes:
-            node.word_to_link = {word: link
-                                 for link in node.out_links
-                                 for word in next_words(link)}
-            if len(node.word_to_link) != len(node.out_links):
-                determinized = False
+        for root in nodes:
+            stack = [root]
+            expanded = set()
+            while stack:
+                node = stack[-1]
+                if node.id in closures:
+                    stack.pop()
+                    continue
+                pending = [link.end_node for link in node.out_links
+                           if (link.word is None) and
+                           (link.end_node.id not in closures)]
+                if pending:
+                    if node.id in expanded:
+                        raise InputError("The lattice contains a cycle of null "
+                                         "links.")
+                    expanded.add(node.id)
+                    stack.extend(pending)
+                    continue
+                stack.pop()
+
+                closure = dict()
+                word_to_link = dict()
+                for link in node.out_links:
+                    if link.word is not None:
+                        closure[link.word] = (
+                            link.end_node,
+                            link.ac_logprob if link.ac_logprob is not None
+                            else 0.0,
+                            link.lm_logprob if link.lm_logprob is not None
+                            else 0.0,
+                            link.transitions if link.transitions is not None
+                            else "")
+                        word_to_link[link.word] = link
+                        continue
+                    for word, path in closures[link.end_node.id].items():
+                        end_node, ac_logprob, lm_logprob, transitions = path
+                        if link.ac_logprob is not None:
+                            ac_logprob += link.ac_logprob
+                        if link.lm_logprob is not None:
+                            lm_logprob += link.lm_logprob
+                        if link.transitions is not None:
+                            transitions += link.transitions
+                        closure[word] = (end_node, ac_logprob, lm_logprob,
+                                         transitions)
+                        word_to_link[word] = link
+                closures[node.id] = closure
+                node.word_to_link = word_to_link
+                if len(word_to_link) != len(node.out_links):
+                    determinized = False
         if not determinized:
             logging.warning(
                 "The original word lattice is not determinized, meaning that "
                 "there are multiple links from the same node with the same "
                 "word label, or the lattice contains null links (epsilon "
                 "arcs). Lattice rescoring may not work properly.")
-
-    def _follow_words(self, words, original_lattice, create=True):
-        """Ensures that a path exists, creating new nodes if necessary, and
-        returns the last node of the path.
-
-        The new lattice will be created by repeatedly calling this function. It
-        starts from the beginning of the lattice and follows the nodes that
-        correspond to the given words. When a word is not found from the
-        outgoing links of the node, the tail will be created. Thus the created
-        lattice is always a tree.
-
-        :type words: list of strs
-        :param words: words of the path
-
-        :type original_lattice: Lattice
-        :param original_lattice: the original lattice where the probabilities of
-            the links will be read from
-
-        :type create: bool
-        :param create: if set to ``False``, won't create any nodes but raises a
-            ``NodeNotFoundError`` if the path doesn't exist
-
-        :rtype: Lattice.Node
-        :returns: the last node of the path
-        """
-
-        node = self.initial_node
-        orig_node = original_lattice.initial_node
-
-        for word in words:
-            # The original lattice may contain null links that we have to skip.
-            orig_end_node, ac_logprob, lm_logprob, transitions = \
-                _follow_word_from_node(orig_node, word)
-            if orig_end_node is None:
-                continue
-
-            # Our new lattice doesn't contain null links, so word_to_link maps
-            # never skip nodes.
-            if word in node.word_to_link:
-                link = node.word_to_link[word]
-            else:
-                if not create:
-                    raise NodeNotFoundError
-                end_node_id = len(self.nodes)
-                end_node = self.Node(end_node_id)
-                end_node.word_to_link = dict()
-                self.nodes.append(end_node)
-                link = self.Link(node, end_node, word,
-                                 ac_logprob, lm_logprob, transitions)
-                node.out_links.append(link)
-                node.word_to_link[word] = link
-                self.links.append(link)
-
-            node = link.end_node
-            orig_node = orig_end_node
-
-        return node
+        return closures
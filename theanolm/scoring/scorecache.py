@@ -0,0 +1,193 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""A module that implements the ScoreCache class used by the text scorer.
+"""
+
+import logging
+import os
+from collections import OrderedDict
+
+import numpy
+
+from theanolm.backend import InputError
+
+CACHE_VERSION = 1
+
+class ScoreCache(object):
+    """Cache of Sentence Log Probabilities
+
+    Maps a sequence of word IDs to the log probability of the sentence. N-best
+    lists and system combination inputs contain many identical sentences, which
+    only need to be scored once. The word IDs are stored as a byte string, which
+    is hashed by the dictionary, so different sequences never collide.
+
+    The number of cached sentences can be limited. When it exceeds the limit,
+    the least recently used sentences are evicted. The cache can be saved to a
+    NumPy ``.npz`` file and loaded in another run. The scores depend on the
+    model and the scoring options, so the file stores a fingerprint that
+    identifies them, and a file with a different fingerprint is not used.
+    """
+
+    def __init__(self, max_size=None, fingerprint=""):
+        """Constructs an empty cache.
+
+        :type max_size: int
+        :param max_size: maximum number of sentences in the cache, or ``None``
+                         for no limit
+
+        :type fingerprint: str
+        :param fingerprint: identifies the model and the scoring options that
+                            the log probabilities were computed with
+        """
+
+        self._max_size = max_size
+        self._fingerprint = fingerprint
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        """Returns the number of sentences in the cache.
+
+        :rtype: int
+        :returns: the number of cached sentences
+        """
+
+        return len(self._entries)
+
+    def hit_rate(self):
+        """Returns the fraction of lookups that were found in the cache.
+
+        :rtype: float
+        :returns: hits divided by the number of lookups, or 0.0 if nothing has
+                  been looked up
+        """
+
+        num_lookups = self.hits + self.misses
+        if num_lookups == 0:
+            return 0.0
+        return self.hits / num_lookups
+
+    @staticmethod
+    def key(word_ids):
+        """Returns the cache key of a word ID sequence.
+
+        :type word_ids: numpy.ndarray of an integer type
+        :param word_ids: a vector of word IDs
+
+        :rtype: bytes
+        :returns: the word IDs as a byte string
+        """
+
+        return numpy.asarray(word_ids, dtype='int64').tobytes()
+
+    def get(self, key):
+        """Returns the log probability of a sentence and marks it as recently
+        used.
+
+        :type key: bytes
+        :param key: a key returned by ``key()``
+
+        :rtype: float
+        :returns: the cached log probability, or ``None`` if the sentence is not
+                  in the cache
+        """
+
+        logprob = self._entries.get(key)
+        if logprob is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+            self._entries.move_to_end(key)
+        return logprob
+
+    def add(self, key, logprob):
+        """Adds the log probability of a sentence to the cache.
+
+        :type key: bytes
+        :param key: a key returned by ``key()``
+
+        :type logprob: float
+        :param logprob: the log probability of the sentence
+        """
+
+        self._entries[key] = logprob
+        self._entries.move_to_end(key)
+        self._evict()
+
+    def load(self, path):
+        """Reads the sentences from a file written by ``save()``.
+
+        The sentences are added to the cache in the order they were used. The
+        file is ignored if it doesn't exist, or if it was written with a
+        different fingerprint.
+
+        :type path: str
+        :param path: path to the cache file
+        """
+
+        if not os.path.exists(path):
+            return
+        with numpy.load(path) as archive:
+            arrays = {name: archive[name] for name in archive.files}
+        if arrays['version'][0] != CACHE_VERSION:
+            raise InputError("Unsupported score cache version {}."
+                             .format(arrays['version'][0]))
+        if str(arrays['fingerprint'][0]) != self._fingerprint:
+            logging.warning("Score cache `%s´ was written using a different "
+                            "model or scoring options. Not using it.", path)
+            return
+
+        word_ids = arrays['word_ids']
+        offsets = arrays['offsets'].tolist()
+        for index, logprob in enumerate(arrays['logprobs']):
+            key = self.key(word_ids[offsets[index]:offsets[index + 1]])
+            self._entries[key] = logprob
+        self._evict()
+        logging.debug("Read %d sentences from score cache `%s´.",
+                      len(self._entries), path)
+
+    def save(self, path):
+        """Writes the sentences into a file.
+
+        The file is first written to a temporary file and then renamed, so that
+        other processes never see a partially written file.
+
+        :type path: str
+        :param path: path to the cache file
+        """
+
+        sequences = [numpy.frombuffer(key, dtype='int64')
+                     for key in self._entries]
+        offsets = numpy.zeros(len(sequences) + 1, dtype='int64')
+        offsets[1:] = numpy.cumsum([len(x) for x in sequences])
+        if sequences:
+            word_ids = numpy.concatenate(sequences)
+        else:
+            word_ids = numpy.zeros(0, dtype='int64')
+        arrays = {
+            'version': numpy.array([CACHE_VERSION]),
+            'fingerprint': numpy.array([self._fingerprint], dtype=str),
+            'word_ids': word_ids,
+            'offsets': offsets,
+            'logprobs': numpy.array(list(self._entries.values()))
+        }
+
+        temp_path = '{}.{}.tmp'.format(path, os.getpid())
+        with open(temp_path, 'wb') as cache_file:
+            numpy.savez(cache_file, **arrays)
+        os.replace(temp_path, path)
+        logging.debug("Wrote %d sentences to score cache `%s´.",
+                      len(self._entries), path)
+
+    def _evict(self):
+        """Removes the least recently used sentences until the cache fits in the
+        size limit.
+        """
+
+        if self._max_size is None:
+            return
+        while len(self._entries) > self._max_size:
+            self._entries.popitem(last=False)
+            self.evictions += 1
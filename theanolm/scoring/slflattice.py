@@ -4,6 +4,7 @@
 files.
 """
 
+import re
 from shlex import shlex
 
 import numpy
@@ -12,14 +13,37 @@ from theanolm.backend import InputError
 from theanolm.backend import logprob_type
 from theanolm.scoring.lattice import Lattice
 
+# Characters that have a special meaning to shlex. Lines that don't contain any
+# of these can be split simply at whitespace.
+_SHLEX_SPECIAL_RE = re.compile(r'["\\#]')
+_SLF_FIELD_RE = re.compile(r'[^ \t\r\n]+')
+
 def _split_slf_line(line):
-    """Parses a list of field    s from an SLF lattice line.
+    """Parses a list of fields from an SLF lattice line.
 
     Each field contains a name, followed by =, followed by a possible quoted
     value. Only double quotes can be used for quotation, and for the literal
     " the double quote must be escaped (\"). I'm not surprise if other
     implementations or the standard doesn't agree.
 
+    Most lines contain no quotes, escapes, or comments, and are split at
+    whitespace using a regular expression. shlex is used only for the rest.
+
+    :type line: str
+    :param line: a line from an SLF file
+
+    :rtype: list of strs
+    :returns: list of fields found from the line, with possible quotation
+              marks removed
+    """
+
+    if _SHLEX_SPECIAL_RE.search(line) is None:
+        return _SLF_FIELD_RE.findall(line)
+    return _shlex_split_slf_line(line)
+
+def _shlex_split_slf_line(line):
+    """Parses a list of fields from an SLF lattice line using shlex.
+
     :type line: str
     :param line: a line from an SLF file
 
@@ -102,6 +126,7 @@ class SLFLattice(Lattice):
 
         self.nodes = [self.Node(node_id) for node_id in range(self._num_nodes)]
 
+        link_fields = []
         for line in lattice_file:
             fields = _split_slf_line(line)
             if not fields:
@@ -110,7 +135,8 @@ class SLFLattice(Lattice):
             if name == 'I':
                 self._read_slf_node(int(value), fields[1:])
             elif name == 'J':
-                self._read_slf_link(int(value), fields[1:])
+                link_fields.append((int(value), fields[1:]))
+        self._read_slf_links(link_fields)
 
         if len(self.links) != self._num_links:
             raise InputError("Number of links in SLF lattice doesn't match the "
@@ -213,45 +239,93 @@ class SLFLattice(Lattice):
         :param fields: the rest of the link fields after ID
         """
 
-        start_node = None
-        end_node = None
-        word = None
-        ac_logprob = None
-        lm_logprob = None
+        self._read_slf_links([(link_id, fields)])
 
-        for field in fields:
-            name, value = _split_slf_field(field)
-            if (name == 'START') or (name == 'S'):
-                start_node = self.nodes[int(value)]
-            elif (name == 'END') or (name == 'E'):
-                end_node = self.nodes[int(value)]
-            elif (name == 'WORD') or (name == 'W'):
-                word = value
-            elif (name == 'acoustic') or (name == 'a'):
-                if self._log_scale is None:
-                    ac_logprob = logprob_type(numpy.log(numpy.float64(value)))
-                else:
-                    ac_logprob = logprob_type(value) * self._log_scale
-            elif (name == 'language') or (name == 'l'):
-                if self._log_scale is None:
-                    lm_logprob = logprob_type(numpy.log(numpy.float64(value)))
-                else:
-                    lm_logprob = logprob_type(value) * self._log_scale
-
-        if start_node is None:
-            raise InputError("Start node is not specified for link {}."
-                             .format(link_id))
-        if end_node is None:
-            raise InputError("End node is not specified for link {}."
-                             .format(link_id))
-        link = self._add_link(start_node, end_node)
-        link.word = word
-        link.ac_logprob = ac_logprob
-        link.lm_logprob = lm_logprob
-
-        if link.word is not None and \
-           (link.word.startswith('!') or link.word.startswith('#')):
-            link.word = None
+    def _read_slf_links(self, link_fields):
+        """Reads the fields of a list of SLF lattice links and creates the
+        links.
+
+        The fields are parsed first, and the acoustic and language model
+        probabilities of all the links are converted to log probabilities at
+        once.
+
+        :type link_fields: list of tuples
+        :param link_fields: the ID of each link and a list of the rest of the
+                            link fields after ID
+        """
+
+        num_links = len(link_fields)
+        start_ids = [None] * num_links
+        end_ids = [None] * num_links
+        words = [None] * num_links
+        ac_values = [None] * num_links
+        lm_values = [None] * num_links
+
+        for index, (link_id, fields) in enumerate(link_fields):
+            for field in fields:
+                name, separator, value = field.partition('=')
+                if not separator:
+                    raise InputError("Expected '=' in SLF lattice field: '{}'"
+                                     .format(field))
+                if (name == 'START') or (name == 'S'):
+                    start_ids[index] = int(value)
+                elif (name == 'END') or (name == 'E'):
+                    end_ids[index] = int(value)
+                elif (name == 'WORD') or (name == 'W'):
+                    words[index] = value
+                elif (name == 'acoustic') or (name == 'a'):
+                    ac_values[index] = value
+                elif (name == 'language') or (name == 'l'):
+                    lm_values[index] = value
+            if start_ids[index] is None:
+                raise InputError("Start node is not specified for link {}."
+                                 .format(link_id))
+            if end_ids[index] is None:
+                raise InputError("End node is not specified for link {}."
+                                 .format(link_id))
+
+        ac_logprobs = self._convert_slf_probs(ac_values)
+        lm_logprobs = self._convert_slf_probs(lm_values)
+        nodes = self.nodes
+        for start_id, end_id, word, ac_logprob, lm_logprob in \
+            zip(start_ids, end_ids, words, ac_logprobs, lm_logprobs):
+            link = self._add_link(nodes[start_id], nodes[end_id])
+            if word is not None and \
+               (word.startswith('!') or word.startswith('#')):
+                word = None
+            link.word = word
+            link.ac_logprob = ac_logprob
+            link.lm_logprob = lm_logprob
+
+    def _convert_slf_probs(self, values):
+        """Converts probabilities read from an SLF lattice to natural log
+        probabilities.
+
+        :type values: list of strs
+        :param values: probabilities in the log base of the lattice (or linear
+                       probabilities if the base is 0), or ``None`` for
+                       missing values
+
+        :rtype: list
+        :returns: a ``logprob_type`` log probability for each value, or ``None``
+                  for missing values
+        """
+
+        result = [None] * len(values)
+        indices = [index for index, value in enumerate(values)
+                   if value is not None]
+        if not indices:
+            return result
+
+        probs = numpy.array([values[index] for index in indices],
+                            dtype=numpy.float64)
+        if self._log_scale is None:
+            logprobs = numpy.log(probs).astype(logprob_type)
+        else:
+            logprobs = probs.astype(logprob_type) * self._log_scale
+        for index, logprob in zip(indices, logprobs):
+            result[index] = logprob
+        return result
 
     def _move_words_to_links(self):
         """Move word identities from nodes to the links leading to the node.
@@ -264,11 +338,11 @@ class SLFLattice(Lattice):
         """
 
         visited = {self.initial_node.id}
-
-        def visit_link(link):
-            """A function that is called recursively to move a word from the
-            link end node to the link.
-            """
+        # Iterate using a stack instead of recursion, so that long lattices
+        # won't exceed the maximum recursion depth.
+        stack = list(reversed(self.initial_node.out_links))
+        while stack:
+            link = stack.pop()
             end_node = link.end_node
             if hasattr(end_node, 'word'):
                 if link.word is None:
@@ -278,11 +352,7 @@ class SLFLattice(Lattice):
                                      "and links.")
             if end_node.id not in visited:
                 visited.add(end_node.id)
-                for next_link in end_node.out_links:
-                    visit_link(next_link)
-
-        for link in self.initial_node.out_links:
-            visit_link(link)
+                stack.extend(reversed(end_node.out_links))
 
         for node in self.nodes:
             if hasattr(node, 'word'):
@@ -0,0 +1,186 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""A module that implements the StatePool class used by the lattice decoder.
+"""
+
+import numpy
+import theano
+
+from theanolm.network import RecurrentState
+
+class StatePool(object):
+    """Pool of Recurrent States
+
+    Stores the recurrent layer states of the decoding tokens in contiguous
+    arrays, one row per state. A token refers to its state by the row index.
+    This way the states of any set of tokens can be gathered into a mini-batch
+    with a single indexing operation per state variable, and the new states
+    computed by the network are stored with a single copy, instead of slicing
+    and concatenating a separate array for each token.
+
+    The arrays grow by doubling their capacity when they become full. States
+    that are not needed anymore can be released by compacting the pool, which
+    moves the remaining states to the beginning of the arrays.
+    """
+
+    def __init__(self, sizes, initial_capacity=1024):
+        """Allocates the arrays.
+
+        :type sizes: list of ints
+        :param sizes: size of each recurrent layer state
+
+        :type initial_capacity: int
+        :param initial_capacity: number of states that can be stored before the
+                                 arrays have to be enlarged
+        """
+
+        self.sizes = sizes
+        self._arrays = [numpy.zeros((initial_capacity, size),
+                                    dtype=theano.config.floatX)
+                        for size in sizes]
+        self.num_states = 0
+        self.peak_num_states = 0
+
+    def __len__(self):
+        """Returns the number of states stored in the pool.
+
+        :rtype: int
+        :returns: the number of states
+        """
+
+        return self.num_states
+
+    @property
+    def capacity(self):
+        """Returns the number of states that fit in the arrays without
+        enlarging them.
+
+        :rtype: int
+        :returns: the number of rows in the arrays
+        """
+
+        return self._arrays[0].shape[0] if self._arrays else 0
+
+    @property
+    def nbytes(self):
+        """Returns the number of bytes allocated for the arrays.
+
+        :rtype: int
+        :returns: total size of the arrays in bytes
+        """
+
+        return sum(array.nbytes for array in self._arrays)
+
+    @property
+    def state_nbytes(self):
+        """Returns the number of bytes used by one state.
+
+        :rtype: int
+        :returns: size of the state vectors of one sequence in bytes
+        """
+
+        return sum(array.itemsize * array.shape[1] for array in self._arrays)
+
+    def clear(self):
+        """Removes all the states from the pool, but keeps the memory allocated.
+
+        Also resets the peak number of states.
+        """
+
+        self.num_states = 0
+        self.peak_num_states = 0
+
+    def has_room(self, num_states):
+        """Checks if given number of states can be added without enlarging the
+        arrays.
+
+        :type num_states: int
+        :param num_states: number of states to be added
+
+        :rtype: bool
+        :returns: ``True`` if the states fit in the current capacity
+        """
+
+        return self.num_states + num_states <= self.capacity
+
+    def add(self, state):
+        """Stores the sequences of a recurrent state in the pool.
+
+        :type state: RecurrentState
+        :param state: a recurrent state that contains one or more sequences
+
+        :rtype: numpy.ndarray
+        :returns: pool indices of the sequences in the same order as they
+                  appear in ``state``
+        """
+
+        num_sequences = state.num_sequences
+        self._reserve(self.num_states + num_sequences)
+        start = self.num_states
+        stop = start + num_sequences
+        for array, state_variable in zip(self._arrays, state.get()):
+            array[start:stop] = state_variable[0]
+        self.num_states = stop
+        self.peak_num_states = max(self.peak_num_states, stop)
+        return numpy.arange(start, stop)
+
+    def get(self, indices):
+        """Gathers the states with given indices into one recurrent state.
+
+        :type indices: list of ints
+        :param indices: pool indices of the states
+
+        :rtype: RecurrentState
+        :returns: a recurrent state that contains the states as separate
+                  sequences, in the same order as in ``indices``
+        """
+
+        indices = numpy.asarray(indices, dtype='int64')
+        state_variables = [array[indices][numpy.newaxis]
+                           for array in self._arrays]
+        return RecurrentState(self.sizes, len(indices), state_variables)
+
+    def compact(self, indices):
+        """Releases all the states except those with given indices.
+
+        The remaining states are moved to the beginning of the arrays, which
+        changes their indices. If more than half of the capacity is still in use
+        after compaction, the arrays are enlarged, so that the pool will not be
+        compacted again too soon.
+
+        :type indices: list of ints
+        :param indices: pool indices of the states that will be kept; may
+                        contain duplicates
+
+        :rtype: list of ints
+        :returns: a list that maps the old indices to the new ones, with -1 for
+                  the states that were released
+        """
+
+        live = numpy.unique(numpy.asarray(indices, dtype='int64'))
+        num_live = len(live)
+        for array in self._arrays:
+            array[:num_live] = array[live]
+        mapping = numpy.full(self.num_states, -1, dtype='int64')
+        mapping[live] = numpy.arange(num_live)
+        self.num_states = num_live
+        self._reserve(num_live * 2)
+        return mapping.tolist()
+
+    def _reserve(self, num_states):
+        """Makes sure that the arrays can hold at least given number of states.
+
+        :type num_states: int
+        :param num_states: required capacity
+        """
+
+        capacity = self.capacity
+        if num_states <= capacity:
+            return
+        while capacity < num_states:
+            capacity = max(capacity * 2, 1)
+        for index, array in enumerate(self._arrays):
+            new_array = numpy.zeros((capacity, array.shape[1]),
+                                    dtype=array.dtype)
+            new_array[:self.num_states] = array[:self.num_states]
+            self._arrays[index] = new_array
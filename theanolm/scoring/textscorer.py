@@ -18,7 +18,7 @@ class TextScorer(object):
     """
 
     def __init__(self, network, use_shortlist=True, exclude_unk=False,
-                 profile=False):
+                 profile=False, cache=None):
         """Creates two Theano function, ``self._target_logprobs_function()``,
         which computes the log probabilities predicted by the neural network for
         the words in a mini-batch, and ``self._total_logprob_function()``, which
@@ -39,8 +39,8 @@ class TextScorer(object):
         log probabilities for the output words (excluding the first time step)
         and the mask. ``<unk>`` tokens are also masked out if ``exclude_unk`` is
         set to ``True``. ``self._total_logprob_function()`` will return the
-        total log probability of the predicted (unmasked) words and the number
-        of those words.
+        total log probability of the predicted (unmasked) words, the number of
+        those words, and a vector of the log probabilities of each sequence.
 
         :type network: Network
         :param network: the neural network object
@@ -55,10 +55,16 @@ class TextScorer(object):
 
         :type profile: bool
         :param profile: if set to True, creates a Theano profile object
+
+        :type cache: ScoreCache
+        :param cache: if not ``None``, ``score_line()`` and ``score_lines()``
+                      look up the sentences from this cache and add the
+                      sentences that they score to it
         """
 
         self._vocabulary = network.vocabulary
         self._unk_id = self._vocabulary.word_to_id['<unk>']
+        self._cache = cache
 
         # The functions take as input a mini-batch of word IDs and class IDs,
         # and slice input and target IDs for the network.
@@ -128,7 +134,7 @@ class TextScorer(object):
         masked_logprobs = tensor.switch(mask, logprobs, 0.0)
         self._total_logprob_function = theano.function(
             [batch_word_ids, batch_class_ids, membership_probs, network.mask],
-            [masked_logprobs.sum(), mask.sum()],
+            [masked_logprobs.sum(), mask.sum(), masked_logprobs.sum(axis=0)],
             givens=[(network.input_word_ids, input_word_ids),
                     (network.input_class_ids, input_class_ids),
                     (network.target_class_ids, target_class_ids),
@@ -137,7 +143,7 @@ class TextScorer(object):
             on_unused_input='ignore',
             profile=profile)
 
-        # These are updated by score_line().
+        # These are updated by score_line() and score_lines().
         self.num_words = 0
         self.num_unks = 0
 
@@ -176,7 +182,46 @@ class TextScorer(object):
                   indicating excluded <unk> tokens
         """
 
-        result = []
+        logprobs = self.score_batch_masked(word_ids, class_ids,
+                                           membership_probs, mask)
+        # Masked elements are converted to None.
+        output_mask = mask[1:] == 1
+        return [logprobs[output_mask[:, seq_index], seq_index].tolist()
+                for seq_index in range(logprobs.shape[1])]
+
+    def score_batch_masked(self, word_ids, class_ids, membership_probs, mask):
+        """Computes the log probabilities predicted by the neural network for
+        the words in a mini-batch, and returns them in a masked array.
+
+        The result has the same shape as the output words of the mini-batch,
+        i.e. one time step less than the input matrices. Elements past the
+        sequence ends are masked, and so are the excluded tokens that
+        ``score_batch()`` replaces with ``None``. The two can be told apart
+        using ``mask[1:]``. Words with zero class membership probability will
+        have ``-inf`` log probability.
+
+        :type word_ids: numpy.ndarray of an integer type
+        :param word_ids: a 2-dimensional matrix, indexed by time step and
+                         sequence, that contains the word IDs
+
+        :type class_ids: numpy.ndarray of an integer type
+        :param class_ids: a 2-dimensional matrix, indexed by time step and
+                          sequence, that contains the class IDs
+
+        :type membership_probs: numpy.ndarray of a floating point type
+        :param membership_probs: a 2-dimensional matrix, indexed by time step
+                                 and sequences, that contains the class
+                                 membership probabilities of the words
+
+        :type mask: numpy.ndarray of a floating point type
+        :param mask: a 2-dimensional matrix, indexed by time step and sequence,
+                     that masks out elements past the sequence ends
+
+        :rtype: numpy.ma.MaskedArray
+        :returns: logprob of each output word, indexed by time step and
+                  sequence
+        """
+
         membership_probs = membership_probs.astype(theano.config.floatX)
 
         # target_logprobs_function() uses the word and class IDs of the entire
@@ -185,16 +230,8 @@ class TextScorer(object):
                                                             class_ids,
                                                             membership_probs[1:],
                                                             mask[1:])
-        for seq_index in range(logprobs.shape[1]):
-            seq_mask = mask[1:, seq_index]
-            seq_logprobs = logprobs[seq_mask == 1, seq_index]
-            # The new mask also masks excluded tokens, replace those with None.
-            seq_mask = new_mask[seq_mask == 1, seq_index]
-            seq_logprobs = [lp if m == 1 else None
-                            for lp, m in zip(seq_logprobs, seq_mask)]
-            result.append(seq_logprobs)
-
-        return result
+        # The new mask also masks excluded tokens.
+        return numpy.ma.masked_array(logprobs, mask=(new_mask != 1))
 
     def compute_perplexity(self, batch_iter):
         """Computes the perplexity of text read using the given iterator.
@@ -229,7 +266,7 @@ class TextScorer(object):
 
             # total_logprob_function() uses the word and class IDs of the entire
             # mini-batch, but membership probs and mask are only for the output.
-            batch_logprob, batch_num_words = \
+            batch_logprob, batch_num_words, _ = \
                 self._total_logprob_function(word_ids,
                                              class_ids,
                                              membership_probs[1:],
@@ -286,7 +323,7 @@ class TextScorer(object):
 
         # total_logprob_function() uses the word and class IDs of the entire
         # mini-batch, but membership probs and mask are only for the output.
-        logprob, _ = self._total_logprob_function(word_ids,
+        logprob, _, _ = self._total_logprob_function(word_ids,
                                                   class_ids,
                                                   membership_probs[1:],
                                                   mask[1:])
@@ -316,6 +353,9 @@ class TextScorer(object):
         OOS words are also excluded. Words with zero class membership
         probability are always excluded.
 
+        If the constructor was given a cache, the log probability is read from
+        the cache when the same sentence has been scored before.
+
         :type line: str
         :param line: a sequence of words
 
@@ -335,13 +375,119 @@ class TextScorer(object):
         unk_id = vocabulary.word_to_id['<unk>']
         self.num_words += word_ids.size
         self.num_unks += numpy.count_nonzero(word_ids == unk_id)
+        if self._cache is not None:
+            key = self._cache.key(word_ids)
+            logprob = self._cache.get(key)
+            if logprob is not None:
+                return logprob
 
         class_ids = [vocabulary.word_id_to_class_id[word_id]
                      for word_id in word_ids]
         probs = [vocabulary.get_word_prob(word_id)
                  for word_id in word_ids]
 
-        return self.score_sequence(word_ids, class_ids, probs)
+        logprob = self.score_sequence(word_ids, class_ids, probs)
+        if self._cache is not None:
+            self._cache.add(key, logprob)
+        return logprob
+
+    def score_lines(self, lines, vocabulary):
+        """Scores a batch of text lines.
+
+        The lines are scored in one mini-batch, which is considerably faster
+        than calling ``score_line()`` for each line. Start-of-sentence and
+        end-of-sentece tags (``<s>`` and ``</s>``) will be inserted at the
+        beginning and the end of each line, if they're missing. Empty lines are
+        not scored.
+
+        ``<unk>`` tokens will be excluded from the probability computation, if
+        the constructor was given ``exclude_unk=True``. When using a shortlist,
+        OOV words are always excluded, and if ``exclude_unk=True`` was given,
+        OOS words are also excluded. Words with zero class membership
+        probability are always excluded.
+
+        If the constructor was given a cache, only the sentences that are not
+        found in the cache are passed to the network. A sentence that occurs
+        several times in the batch is scored once.
+
+        :type lines: list of strs
+        :param lines: the lines of text to score
+
+        :type vocabulary: Vocabulary
+        :param vocabulary: vocabulary for converting the words to word IDs
+
+        :rtype: list of floats
+        :returns: log probability of the word sequence on each line, or
+                  ``None`` for empty lines
+        """
+
+        result = [None] * len(lines)
+        sequences = []
+        seq_indices = []
+        # Lines that repeat a sentence that is scored in this batch.
+        duplicates = []
+        keys = dict()
+        unk_id = vocabulary.word_to_id['<unk>']
+        for line_index, line in enumerate(lines):
+            words = utterance_from_line(line)
+            if not words:
+                continue
+            seq_word_ids = vocabulary.words_to_ids(words)
+            self.num_words += seq_word_ids.size
+            self.num_unks += numpy.count_nonzero(seq_word_ids == unk_id)
+            if self._cache is not None:
+                key = self._cache.key(seq_word_ids)
+                if key in keys:
+                    duplicates.append((line_index, key))
+                    continue
+                logprob = self._cache.get(key)
+                if logprob is not None:
+                    result[line_index] = logprob
+                    continue
+                keys[key] = len(sequences)
+            sequences.append(seq_word_ids)
+            seq_indices.append(line_index)
+        if not sequences:
+            return result
+
+        num_time_steps = max(len(seq_word_ids) for seq_word_ids in sequences)
+        word_ids = numpy.zeros((num_time_steps, len(sequences)), numpy.int64)
+        mask = numpy.zeros((num_time_steps, len(sequences)), numpy.int8)
+        for seq_index, seq_word_ids in enumerate(sequences):
+            word_ids[:len(seq_word_ids), seq_index] = seq_word_ids
+            mask[:len(seq_word_ids), seq_index] = 1
+        class_ids, membership_probs = \
+            vocabulary.get_class_memberships(word_ids)
+        membership_probs = membership_probs.astype(theano.config.floatX)
+
+        # total_logprob_function() uses the word and class IDs of the entire
+        # mini-batch, but membership probs and mask are only for the output.
+        _, _, logprobs = self._total_logprob_function(word_ids,
+                                                      class_ids,
+                                                      membership_probs[1:],
+                                                      mask[1:])
+        if numpy.isnan(logprobs).any():
+            self._debug_log_batch(word_ids, class_ids, membership_probs, mask)
+            raise NumberError("Log probability of a sequence is NaN.")
+        if numpy.isneginf(logprobs).any():
+            self._debug_log_batch(word_ids, class_ids, membership_probs, mask)
+            raise NumberError("Probability of a sequence is zero.")
+        if (logprobs > 0.0).any():
+            self._debug_log_batch(word_ids, class_ids, membership_probs, mask)
+            raise NumberError("Probability of a sequence is greater than one.")
+
+        for line_index, logprob in zip(seq_indices, logprobs):
+            result[line_index] = logprob
+        if self._cache is not None:
+            for key, seq_index in keys.items():
+                self._cache.add(key, logprobs[seq_index])
+            # The duplicates were not passed to the network, so they are
+            # counted as cache hits, even if a small cache has already evicted
+            # them.
+            for line_index, key in duplicates:
+                result[line_index] = logprobs[keys[key]]
+            self._cache.hits += len(duplicates)
+        return result
 
     def _debug_log_batch(self, word_ids, class_ids, membership_probs, mask):
         """Writes the target word IDs, their log probabilities, and the mask to
@@ -0,0 +1,137 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""A module that implements the WordHistory class used by the lattice decoder.
+"""
+
+# The hash of a word sequence is computed as a polynomial of the word codes
+# modulo a Mersenne prime.
+_MODULUS = (1 << 61) - 1
+_BASE = 1000003
+
+class WordHistory(object):
+    """Word History as a Linked List
+
+    Represents the words that a decoding token has passed as a node that points
+    to the history without the last word. Tokens that are propagated from the
+    same token share the nodes of the common part of their histories, so
+    appending a word takes constant time and memory, regardless of the length
+    of the history.
+
+    Each node stores a hash of the entire word sequence, computed incrementally
+    from the hash of the parent. The hash of the last N words is obtained from
+    the hashes of the full sequence and of the history N words earlier. The
+    latter is found using jump pointers, in time that is logarithmic in the
+    length of the history.
+    """
+
+    __slots__ = ("word", "parent", "length", "prefix_hash", "_jump")
+
+    def __init__(self, word, parent=None):
+        """Creates a history by appending a word to an existing history.
+
+        :type word: int or str
+        :param word: word ID, or the word itself for OOV words
+
+        :type parent: WordHistory
+        :param parent: the history before ``word``, or ``None`` to create a
+                       history of one word
+        """
+
+        self.word = word
+        self.parent = parent
+        code = hash(word) % (_MODULUS - 1) + 1
+        if parent is None:
+            self.length = 1
+            self.prefix_hash = code
+            self._jump = self
+        else:
+            self.length = parent.length + 1
+            self.prefix_hash = (parent.prefix_hash * _BASE + code) % _MODULUS
+            # Skew-binary jump pointers guarantee logarithmic ancestor lookup.
+            jump = parent._jump
+            if parent.length - jump.length == jump.length - jump._jump.length:
+                self._jump = jump._jump
+            else:
+                self._jump = parent
+
+    @classmethod
+    def from_words(cls, words):
+        """Creates a history from a sequence of words.
+
+        :type words: list of ints or strs
+        :param words: word IDs (or OOV words) in the order they were seen
+
+        :rtype: WordHistory
+        :returns: a node that represents the last word, or ``None`` if
+                  ``words`` is empty
+        """
+
+        result = None
+        for word in words:
+            result = cls(word, result)
+        return result
+
+    def __len__(self):
+        """Returns the number of words in the history.
+
+        :rtype: int
+        :returns: length of the history
+        """
+
+        return self.length
+
+    def words(self):
+        """Reconstructs the word sequence.
+
+        :rtype: tuple
+        :returns: word IDs (or OOV words) from the first to the last
+        """
+
+        result = []
+        node = self
+        while node is not None:
+            result.append(node.word)
+            node = node.parent
+        result.reverse()
+        return tuple(result)
+
+    def ancestor(self, length):
+        """Returns the node that represents the beginning of this history.
+
+        :type length: int
+        :param length: length of the history to return; at least 1 and at most
+                       the length of this history
+
+        :rtype: WordHistory
+        :returns: the node that represents the first ``length`` words
+        """
+
+        node = self
+        while node.length > length:
+            if node._jump.length >= length:
+                node = node._jump
+            else:
+                node = node.parent
+        return node
+
+    def window_hash(self, order):
+        """Computes the hash of the last words of the history.
+
+        Two histories that end with the same ``order`` words have the same
+        hash. If a history is shorter than ``order`` words, all the words are
+        used.
+
+        :type order: int
+        :param order: number of words to consider, or ``None`` for the entire
+                      history
+
+        :rtype: int
+        :returns: hash of the last ``order`` words
+        """
+
+        if (order is None) or (order >= self.length):
+            return self.prefix_hash
+        prefix = self.ancestor(self.length - order)
+        result = self.prefix_hash - prefix.prefix_hash * pow(_BASE, order,
+                                                             _MODULUS)
+        return result % _MODULUS